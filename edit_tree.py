@@ -1,43 +1,376 @@
+import bisect
 import random
-from tree import TreeNode, preorder_traversal
+from collections.abc import Callable, Iterable, Iterator
+from typing import NamedTuple
 
+from tree import FlatTree, NodePath, TreeNode, preorder_traversal
+from zhang_shasha import EditMapping
+
+#: A node for apply_edits: its id, or for a node of the original tree, its path.
+NodeRef = int | NodePath
+
+
+class Delete(NamedTuple):
+    """Delete node, moving its children up into its place. See with_node_deleted."""
+
+    node: NodeRef
+
+
+class Insert(NamedTuple):
+    """Insert a node labeled label as parent's index-th child. See with_node_inserted."""
+
+    label: str
+    parent: NodeRef
+    index: int
+    num_children: int = 0
+
+
+class Relabel(NamedTuple):
+    """Relabel node. See with_node_relabeled."""
+
+    node: NodeRef
+    label: str
+
+
+Edit = Delete | Insert | Relabel
+
+
+class AppliedEdits(NamedTuple):
+    #: The edited tree.
+    tree: TreeNode
+    #: The id of each node of tree, in pre-order. See apply_edits.
+    node_ids: list[int]
 
-def with_node_deleted(root: TreeNode, delete: TreeNode) -> TreeNode:
-    """Return a copy of the tree, root, with the given node deleted."""
-    children = []
-    for child in root.children:
-        if child is not delete:
-            children.append(with_node_deleted(child, delete))
-            continue
 
-        # Shift the grandkids up as children of the new root.
-        for grandchild in child.children:
-            children.append(grandchild)
+def with_node_deleted(root: TreeNode, delete: TreeNode | NodePath) -> TreeNode:
+    """Return a copy of the tree, root, with the given node deleted.
 
-    return TreeNode(root.label, tuple(children), root.depth)
+    The node is given either as its path, or as itself, found by identity. As
+    subtrees can be shared, a node given as itself is deleted wherever it occurs,
+    and the tree is searched for it in O(n); if it doesn't occur, the tree is
+    returned as it is. Only the edited nodes' ancestors are copied; every other
+    subtree is shared with root. Deleting the root leaves the tree as it is, here
+    and in apply_edits.
+    """
+    if isinstance(delete, TreeNode):
+        # Last first, as a delete only moves the nodes after it in pre-order.
+        for path in reversed(_occurrence_paths(root, delete)):
+            root = with_node_deleted(root, path)
+        return root
 
+    path = tuple(delete)
+    if not path:
+        return root
 
-def with_node_inserted(root: TreeNode, insert_label: str, parent: TreeNode, index: int) -> TreeNode:
-    """Return a copy of the tree, root, with the given node inserted as a child of parent."""
-    if root is parent:
+    index = path[-1]
+
+    def edit(parent: TreeNode) -> TreeNode:
+        # Shift the grandkids up as children of the parent.
+        children = parent.children[:index] + parent.children[index].children
+        return TreeNode(parent.label, children + parent.children[index + 1 :], parent.depth)
+
+    return _with_node_replaced(root, path[:-1], edit)
+
+
+def with_node_inserted(
+    root: TreeNode,
+    insert_label: str,
+    parent: TreeNode | NodePath,
+    index: int,
+    num_children: int = 0,
+) -> TreeNode:
+    """Return a copy of the tree, root, with the given node inserted as a child of parent.
+
+    The new node adopts num_children of parent's children, starting from index, as
+    its own children. This is the inverse of with_node_deleted. As there, parent
+    is its path or itself, in which case the node is inserted into every
+    occurrence of it, and only the edited nodes and their ancestors are copied.
+    """
+
+    def edit(node: TreeNode) -> TreeNode:
         # Create a new tuple of children, with the new node inserted at the given index.
-        new_node = TreeNode(insert_label, (), root.depth + 1)
-        children = root.children[:index] + (new_node,) + root.children[index:]
-        return TreeNode(root.label, children, root.depth)
+        adopted = node.children[index : index + num_children]
+        new_node = TreeNode(insert_label, adopted, node.depth + 1)
+        children = node.children[:index] + (new_node,) + node.children[index + num_children :]
+        return TreeNode(node.label, children, node.depth)
+
+    return _with_node_edited(root, parent, edit)
+
+
+def with_node_relabeled(root: TreeNode, relabel: TreeNode | NodePath, label: str) -> TreeNode:
+    """Return a copy of the tree, root, with the given node relabeled.
+
+    As in with_node_deleted, relabel is its path or itself, in which case every
+    occurrence of it is relabeled, and only the edited nodes and their ancestors
+    are copied.
+    """
+
+    def edit(node: TreeNode) -> TreeNode:
+        return TreeNode(label, node.children, node.depth)
+
+    return _with_node_edited(root, relabel, edit)
+
+
+def with_mapping_applied(root: TreeNode, mapping: EditMapping) -> TreeNode:
+    """Return a copy of the tree, root, edited into mapping's b_tree by replaying the mapping.
 
-    children = tuple(
-        with_node_inserted(child, insert_label, parent, index) for child in root.children
+    The mapping's relabels, then deletes, then inserts are applied in one pass by
+    apply_edits, so only the edited nodes and their ancestors are copied.
+
+    Requires:
+    - root has the same shape as mapping's a_tree (or is it).
+    """
+    # Nodes are numbered by position, not identity, as equal subtrees may be shared.
+    a_post_to_pre = FlatTree.from_tree(root).post_ordered_indexes().tolist()
+
+    b_flat = mapping.b_tree
+    if not isinstance(b_flat, FlatTree):
+        b_flat = FlatTree.from_tree(b_flat)
+    b_post_to_pre = b_flat.post_ordered_indexes().tolist()
+    b_parents = b_flat.parent.tolist()
+    b_post_order = b_flat.post_order.tolist()
+    b_leftmost_leaf = b_flat.leftmost_leaf.tolist()
+
+    # Wrap the tree in a placeholder root, so that a's root can be deleted and b's
+    # root inserted. In between, the placeholder's children may be a forest. The
+    # placeholder has id 0, so a node's id is its pre-order index in root plus one.
+    tree = TreeNode("", (root,), root.depth - 1)
+    edits: list[Edit] = [
+        Relabel(a_post_to_pre[a_index] + 1, mapping.b_nodes[b_index].label)
+        for a_index, b_index in mapping.relabels()
+    ]
+    edits += [Delete(a_post_to_pre[a_index] + 1) for a_index in mapping.deletes]
+
+    # After the deletes, the tree is b with its inserted nodes deleted: each kept
+    # node is a child of its closest kept ancestor in b, in b's pre-order. The
+    # children of each node are tracked by b pre-order index, with -1 for the
+    # placeholder, to place each insert among its parent's children.
+    node_ids = {-1: 0}
+    node_ids.update(
+        (b_post_to_pre[b_index], a_post_to_pre[a_index] + 1) for a_index, b_index in mapping.matches
     )
-    return TreeNode(root.label, tuple(children), root.depth)
+    children: dict[int, list[int]] = {-1: []}
+    kept_ancestors = [-1] * len(b_flat)
+    for b_pre in range(len(b_flat)):
+        b_parent = b_parents[b_pre]
+        kept = b_parent if b_parent in node_ids else kept_ancestors[b_parent]
+        kept_ancestors[b_pre] = kept
+        if b_pre in node_ids:
+            children.setdefault(kept, []).append(b_pre)
+
+    # Inserting in b's pre-order means each node's parent is already present.
+    next_id = len(a_post_to_pre) + 1
+    for b_pre in sorted(b_post_to_pre[b_index] for b_index in mapping.inserts):
+        b_parent = b_parents[b_pre]
+        siblings = children.setdefault(b_parent, [])
+        # Of parent's current children, the new node goes after those before it in
+        # b's pre-order, and adopts those among its descendants.
+        b_subtree_size = b_post_order[b_pre] - b_post_order[b_leftmost_leaf[b_pre]] + 1
+        index = bisect.bisect_left(siblings, b_pre)
+        stop = bisect.bisect_left(siblings, b_pre + b_subtree_size)
+        children[b_pre] = siblings[index:stop]
+        siblings[index:stop] = [b_pre]
+        edits.append(Insert(b_flat.label(b_pre), node_ids[b_parent], index, stop - index))
+        node_ids[b_pre] = next_id
+        next_id += 1
+
+    (new_root,) = apply_edits(tree, edits).tree.children
+    return new_root
+
+
+def apply_edits(root: TreeNode, edits: Iterable[Edit]) -> AppliedEdits:
+    """Return a copy of the tree, root, with the edits applied in order, in one pass.
+
+    The result is the same as applying each edit in turn with the with_node_*
+    functions, and as there, only the edited nodes and their ancestors are copied.
+    Insert's index and num_children count the parent's children as they are when
+    the edit is reached, and a Delete of the root leaves the tree as it is.
+
+    Nodes are addressed by id, which is stable across the edits. A node of root has
+    its pre-order index as its id, and the k-th Insert's node has len(root) + k,
+    where len(root) is the number of nodes in root. A node of root may also be
+    addressed by its path in root.
+
+    Also returns the id of each node of the result. For example, node_ids.index(i)
+    is the pre-order index in the result of the node with id i.
+    """
+    # The nodes of root, with each node's parent id and number of descendants.
+    nodes: list[TreeNode] = []
+    parents: list[int] = []
+    stack: list[tuple[TreeNode, int]] = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        parents.append(parent)
+        stack.extend((child, len(nodes)) for child in reversed(node.children))
+        nodes.append(node)
+    sizes = [1] * len(nodes)
+    for node_id in range(len(nodes) - 1, 0, -1):
+        sizes[parents[node_id]] += sizes[node_id]
+
+    def original_children(node_id: int) -> list[int]:
+        children = []
+        child_id = node_id + 1
+        for _ in nodes[node_id].children:
+            children.append(child_id)
+            child_id += sizes[child_id]
+        return children
+
+    # The edited parts of the tree, by node id. Nodes in none of these are as in root.
+    labels: dict[int, str] = {}
+    depths: dict[int, int] = {}
+    edited_children: dict[int, list[int]] = {}
+    edited_parents: dict[int, int] = {}
+    deleted: set[int] = set()
+    next_id = len(nodes)
+
+    def children_of(node_id: int) -> list[int]:
+        """The node's children, copied into edited_children to be edited."""
+        if node_id not in edited_children:
+            edited_children[node_id] = original_children(node_id)
+        return edited_children[node_id]
+
+    def parent_of(node_id: int) -> int:
+        return edited_parents.get(node_id, parents[node_id] if node_id < len(nodes) else -1)
+
+    def depth_of(node_id: int) -> int:
+        return depths[node_id] if node_id in depths else nodes[node_id].depth
+
+    def resolve(node: NodeRef) -> int:
+        if isinstance(node, tuple):
+            # Follow the path down root, skipping over the subtrees of earlier siblings.
+            node_id = 0
+            for index in node:
+                if not 0 <= index < len(nodes[node_id].children):
+                    raise ValueError(f"There is no node at {node}")
+                node_id += 1
+                for _ in range(index):
+                    node_id += sizes[node_id]
+        else:
+            node_id = int(node)
+        if not 0 <= node_id < next_id or node_id in deleted:
+            raise ValueError(f"There is no node {node_id}")
+        return node_id
+
+    for edit in edits:
+        if isinstance(edit, Relabel):
+            labels[resolve(edit.node)] = edit.label
+        elif isinstance(edit, Delete):
+            node_id = resolve(edit.node)
+            parent = parent_of(node_id)
+            if parent == -1:
+                # As in with_node_deleted, deleting the root leaves the tree as it is.
+                continue
+            siblings = children_of(parent)
+            index = siblings.index(node_id)
+            grandchildren = children_of(node_id)
+            siblings[index : index + 1] = grandchildren
+            edited_parents.update((child, parent) for child in grandchildren)
+            deleted.add(node_id)
+        else:
+            parent = resolve(edit.parent)
+            node_id = next_id
+            next_id += 1
+            siblings = children_of(parent)
+            adopted = siblings[edit.index : edit.index + edit.num_children]
+            siblings[edit.index : edit.index + edit.num_children] = [node_id]
+            edited_children[node_id] = adopted
+            edited_parents.update((child, node_id) for child in adopted)
+            edited_parents[node_id] = parent
+            labels[node_id] = edit.label
+            depths[node_id] = depth_of(parent) + 1
+
+    # Rebuild the edited nodes and their ancestors. Every other node of root is
+    # kept, along with its subtree.
+    rebuild: set[int] = set()
+    for node_id in (*labels, *edited_children):
+        while node_id != -1 and node_id not in rebuild and node_id not in deleted:
+            rebuild.add(node_id)
+            node_id = parent_of(node_id)
+
+    node_ids: list[int] = []
+    # Each entry is a node id, an iterator over its children still to visit, and
+    # the rebuilt children so far.
+    build: list[tuple[int, Iterator[int], list[TreeNode]]] = []
+
+    def enter(node_id: int):
+        if node_id in rebuild:
+            node_ids.append(node_id)
+            build.append((node_id, iter(children_of(node_id)), []))
+        else:
+            node_ids.extend(range(node_id, node_id + sizes[node_id]))
+            build.append((node_id, iter(()), []))
+
+    enter(0)
+    while True:
+        node_id, children, new_children = build[-1]
+        child = next(children, None)
+        if child is not None:
+            enter(child)
+            continue
+
+        build.pop()
+        if node_id in rebuild:
+            label = labels[node_id] if node_id in labels else nodes[node_id].label
+            new_node = TreeNode(label, tuple(new_children), depth_of(node_id))
+        else:
+            new_node = nodes[node_id]
+        if not build:
+            return AppliedEdits(new_node, node_ids)
+        build[-1][2].append(new_node)
+
+
+def _with_node_edited(
+    root: TreeNode, target: TreeNode | NodePath, edit: Callable[[TreeNode], TreeNode]
+) -> TreeNode:
+    """Return a copy of the tree with target, or each occurrence of it, replaced by edit(node)."""
+    if not isinstance(target, TreeNode):
+        return _with_node_replaced(root, tuple(target), edit)
+    # Last first, as an edit only moves the nodes after it in pre-order.
+    for path in reversed(_occurrence_paths(root, target)):
+        root = _with_node_replaced(root, path, edit)
+    return root
+
+
+def _occurrence_paths(root: TreeNode, node: TreeNode) -> list[NodePath]:
+    """Return the path of each occurrence of node in root, by identity, in pre-order."""
+    if root is node:
+        return [()]
+    paths: list[NodePath] = []
+    # The path to the node whose children the top of the stack is iterating over.
+    path: list[int] = []
+    stack: list[Iterator[tuple[int, TreeNode]]] = [enumerate(root.children)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            if path:
+                path.pop()
+            continue
+        index, child = entry
+        if child is node:
+            # A node can't occur below itself, so its children aren't searched.
+            paths.append((*path, index))
+        elif child.children:
+            path.append(index)
+            stack.append(enumerate(child.children))
+    return paths
 
 
-def with_node_relabeled(root: TreeNode, relabel: TreeNode, label: str) -> TreeNode:
-    """Return a copy of the tree, root, with the given node relabeled."""
-    if root is relabel:
-        return TreeNode(label, root.children, root.depth)
+def _with_node_replaced(
+    root: TreeNode, path: NodePath, edit: Callable[[TreeNode], TreeNode]
+) -> TreeNode:
+    """Return a copy of the tree with the node at path replaced by edit(node).
 
-    children = tuple(with_node_relabeled(child, relabel, label) for child in root.children)
-    return TreeNode(root.label, tuple(children), root.depth)
+    Only the nodes on the path are copied, so this takes O(depth * fanout).
+    """
+    spine = [root]
+    for index in path:
+        spine.append(spine[-1].children[index])
+    new_node = edit(spine.pop())
+    for ancestor, index in zip(reversed(spine), reversed(path)):
+        children = ancestor.children[:index] + (new_node,) + ancestor.children[index + 1 :]
+        new_node = TreeNode(ancestor.label, children, ancestor.depth)
+    return new_node
 
 
 def with_random_edit(root: TreeNode) -> tuple[TreeNode, str]:
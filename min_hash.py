@@ -1,45 +1,300 @@
-from collections.abc import Iterable, Hashable, Callable
+import hashlib
+from collections import Counter
+from collections.abc import Iterable, Hashable, Callable, Mapping, Sequence
 from dataclasses import dataclass
-from typing import Generic, TypeVar
+from typing import Any, Generic, Literal, NamedTuple, TypeAlias, TypeVar
 import numpy as np
 
+from pq_grams import PQGramIndex
+
 T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
 HashFunction = Callable[[T], int]
 
+#: How a MinHasher computes its num_hashes minimums. See MinHasher.
+MinHashMode: TypeAlias = Literal["classic", "one_permutation"]
+
+
+class BagCounts(NamedTuple):
+    """A bag given as its distinct values, and an array of how many times each occurs."""
+
+    values: Sequence[Any]
+    counts: np.ndarray
+
+
+#: A bag, as its values with repeats, a mapping from each value to its count, a
+#: BagCounts, or a PQGramIndex, whose pq-grams are counted by their labels.
+Bag: TypeAlias = Iterable[T] | Mapping[T, int] | BagCounts | PQGramIndex
+
+
+def stable_hash(value: Any) -> int:
+    """A 64-bit hash of str, bytes, int and (nested) tuples of them, the same in every process.
+
+    Python's hash of str, bytes and tuples of them changes from process to
+    process (see PYTHONHASHSEED), and so can't be stored or sent to another.
+    """
+    digest = hashlib.blake2b(_stable_bytes(value), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _stable_bytes(value: Any) -> bytes:
+    """Encode the value, tagged with its type, so that different values have different bytes."""
+    if isinstance(value, str):
+        return b"s" + value.encode("utf-8", "surrogatepass")
+    if isinstance(value, bytes):
+        return b"b" + value
+    if isinstance(value, (int, np.integer)):
+        value = int(value)
+        return b"i" + value.to_bytes(value.bit_length() // 8 + 1, "little", signed=True)
+    if isinstance(value, tuple):
+        parts = [b"t"]
+        for item in value:
+            encoded = _stable_bytes(item)
+            parts.append(len(encoded).to_bytes(8, "little"))
+            parts.append(encoded)
+        return b"".join(parts)
+    raise TypeError(f"stable_hash can't hash {type(value).__name__} values")
+
+
+def hash_func_name(hash_func: HashFunction) -> str:
+    """Identify a hash function, so that MinHashes of different ones aren't compared.
 
-@dataclass
+    The builtin hash is identified along with a hash of a str, which differs
+    between processes whose str hashes differ.
+    """
+    if hash_func is stable_hash:
+        return "stable_hash"
+    if hash_func is hash:
+        return f"hash:{hash('MinHasher') & 0xFFFFFFFFFFFFFFFF:016x}"
+    module = getattr(hash_func, "__module__", None)
+    return f"{module}.{getattr(hash_func, '__qualname__', repr(hash_func))}"
+
+
+@dataclass(eq=False)
 class MinHash:
-    signature: tuple[int, ...]
+    #: The minimum hashes, as np.uint32, or the low _bits bits of them. See b_bit.
+    signature: np.ndarray
     _hash_seed: int
+    _hash_name: str = "stable_hash"
+    _mode: MinHashMode = "classic"
+    _bits: int = 32
+
+    def __post_init__(self):
+        self.signature = np.asarray(self.signature, dtype=_signature_dtype(self._bits))
+
+    def b_bit(self, bits: int) -> "MinHash":
+        """Keep only the low bits of each hash, as a "b-bit minwise hash" (Li and König, 2010).
+
+        With 8 bits, a signature takes a quarter of the memory. compare corrects
+        for the hashes that then match by chance, but its estimates are noisier.
+        """
+        if not 1 <= bits <= self._bits:
+            raise ValueError(f"bits must be between 1 and {self._bits}")
+        signature = self.signature & ((1 << bits) - 1)
+        return MinHash(signature, self._hash_seed, self._hash_name, self._mode, bits)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, MinHash):
+            return NotImplemented
+        return (
+            (self._hash_seed, self._hash_name, self._mode, self._bits)
+            == (other._hash_seed, other._hash_name, other._mode, other._bits)
+        ) and np.array_equal(self.signature, other.signature)
+
+    __hash__ = None  # type: ignore[assignment]
+
+
+def _signature_dtype(bits: int) -> np.dtype:
+    return np.dtype(np.uint8 if bits <= 8 else np.uint16 if bits <= 16 else np.uint32)
 
 
 class MinHasher(Generic[T]):
+    """Computes MinHash signatures of sets, which compare to estimate their Jaccard similarity.
+
+    In the "classic" mode, every value is hashed num_hashes times, by as many
+    hash functions, and the signature is the minimum of each. This costs
+    O(set size x num_hashes).
+
+    In the "one_permutation" mode, every value is hashed once, and the hash
+    both picks one of num_hashes bins and gives a value to take the minimum of
+    within the bin. Empty bins borrow from a non-empty bin chosen by hashing the
+    bin's index: "optimal densification" (Shrivastava, 2017), so the signatures
+    still estimate the Jaccard similarity. This costs O(set size + num_hashes),
+    so is much faster for large sets, but is less accurate for sets with fewer
+    values than num_hashes.
+    """
+
     num_hashes: int
     hash_func: HashFunction[T]
+    hash_name: str
     hash_parameters: list[tuple[int, int]]
     seed: int
+    mode: MinHashMode
 
     # For binning the hash values.
     LARGE_PRIME = 1073741827
 
-    def __init__(self, num_hashes: int, hash_func: HashFunction[T] = hash, seed: int = 1):
+    # The number of hashes computed at once. Small enough to keep the working
+    # arrays in cache, which is much faster than streaming them through memory.
+    CHUNK_HASHES = 2**15
+
+    # Marks an empty set in one_permutation signatures. Hashes stop just short of it.
+    EMPTY_BIN = 2**32 - 1
+
+    def __init__(
+        self,
+        num_hashes: int,
+        hash_func: HashFunction[T] = stable_hash,
+        seed: int = 1,
+        mode: MinHashMode = "classic",
+    ):
         self.num_hashes = num_hashes
         self.hash_func = hash_func
+        self.hash_name = hash_func_name(hash_func)
         self.seed = seed
+        self.mode = mode
 
         gen = np.random.default_rng(seed)
         parameters = gen.integers(0, 0xFFFFFFFF, size=(num_hashes, 2), dtype=np.uint32)
         self.hash_parameters = [(int(a), int(b)) for a, b in parameters]
+        # Drawn after the classic parameters, so that those don't depend on the mode.
+        self._bin_key, self._densify_key = gen.integers(0, 2**64, size=2, dtype=np.uint64)
+
+    @property
+    def parameters(self) -> tuple:
+        """Everything that affects the signatures, so that equal parameters give equal ones."""
+        return (self.num_hashes, self.hash_func, self.seed, self.mode)
 
     def __call__(self, values: Iterable[T]) -> MinHash:
-        # Hash each value and keep the num_hashes smallest of them
-        hashes = [self.LARGE_PRIME] * self.num_hashes
-        for value in values:
-            for i, params in enumerate(self.hash_parameters):
-                hashed = self._hash(value, params)
-                hashes[i] = min(hashes[i], hashed)
+        # Hash each value and keep the smallest of each of the num_hashes hashes.
+        return MinHash(self.signatures([values])[0], self.seed, self.hash_name, self.mode)
+
+    def signatures(self, batch: Iterable[Iterable[T]]) -> np.ndarray:
+        """Return the signature of each set of values, as the rows of a np.uint32 matrix.
+
+        Each value is passed to hash_func once, and then all num_hashes hashes of
+        all the values are computed together, with NumPy. In the classic mode,
+        the signatures are exactly those of hashing each value with _hash.
+        """
+        sets = [list(values) for values in batch]
+        lengths = [len(values) for values in sets]
+        hashes = (self.hash_func(value) for values in sets for value in values)
+        if self.mode == "one_permutation":
+            hashed = np.array([value & 0xFFFFFFFFFFFFFFFF for value in hashes], dtype=np.uint64)
+            return self._signatures_of_hashes(hashed, lengths)
+
+        try:
+            hashed = np.array(list(hashes), dtype=np.int64)
+        except OverflowError:
+            # hash_func returned a value too wide to be hashed exactly in limbs.
+            signatures = np.full((len(sets), self.num_hashes), self.LARGE_PRIME, dtype=np.uint32)
+            for row, values in enumerate(sets):
+                for value in values:
+                    for i, params in enumerate(self.hash_parameters):
+                        signatures[row, i] = min(signatures[row, i], self._hash(value, params))
+            return signatures
+        return self._signatures_of_hashes(hashed, lengths)
+
+    def bag(self, values: Bag[T]) -> MinHash:
+        """Return the MinHash of a bag (multiset) of values. See bag_signatures."""
+        return MinHash(self.bag_signatures([values])[0], self.seed, self.hash_name, self.mode)
+
+    def bag_signatures(self, batch: Iterable[Bag[T]]) -> np.ndarray:
+        """Return the signature of each bag of values, as the rows of a np.uint32 matrix.
+
+        A bag is any of the forms of Bag. The k-th occurrence of a value is hashed
+        as a value of its own, so compare estimates the bags' Jaccard similarity:
+        the sum of the minimum counts, over the sum of the maximum counts. The
+        first occurrence hashes as the value alone, so a bag without repeats has
+        the same signature as the set. Counts that aren't positive are a ValueError.
+        """
+        hashed = []
+        lengths = []
+        for bag in batch:
+            values, repeats = _bag_counts(bag)
+            value_hashes = np.array(
+                [self.hash_func(value) & 0xFFFFFFFFFFFFFFFF for value in values], dtype=np.uint64
+            )
+            occurrence_starts = np.cumsum(repeats) - repeats
+            occurrences = np.arange(repeats.sum()) - np.repeat(occurrence_starts, repeats)
+            # _mix64(0) == 0, so first occurrences keep their value's hash.
+            hashed.append(np.repeat(value_hashes, repeats) ^ _mix64(occurrences.astype(np.uint64)))
+            lengths.append(int(repeats.sum()))
+
+        all_hashed = np.concatenate(hashed) if hashed else np.zeros(0, dtype=np.uint64)
+        if self.mode == "classic":
+            all_hashed = all_hashed.view(np.int64)
+        return self._signatures_of_hashes(all_hashed, lengths)
 
-        return MinHash(tuple(hashes), self.seed)
+    def _signatures_of_hashes(self, hashed: np.ndarray, lengths: list[int]) -> np.ndarray:
+        """The signatures of sets given as the hash_func hashes of their values, end to end.
+
+        hashed is uint64 for one_permutation, and int64 for classic.
+        """
+        set_of_value = np.repeat(np.arange(len(lengths)), lengths)
+        if self.mode == "one_permutation":
+            return self._one_permutation_signatures(hashed, set_of_value, len(lengths))
+
+        signatures = np.full((len(lengths), self.num_hashes), self.LARGE_PRIME, dtype=np.uint32)
+        a, b = np.array(self.hash_parameters, dtype=np.uint64).reshape(-1, 2).T
+        chunk_size = max(1, self.CHUNK_HASHES // max(1, self.num_hashes))
+        for chunk_start in range(0, len(hashed), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            chunk_hashes = self._hash_array(hashed[chunk], a, b)
+
+            # Each set's values are contiguous, so reduce each run of them.
+            chunk_sets = set_of_value[chunk]
+            run_starts = np.flatnonzero(np.diff(chunk_sets, prepend=-1))
+            run_sets = chunk_sets[run_starts]
+            run_minimums = np.minimum.reduceat(chunk_hashes, run_starts, axis=0)
+            signatures[run_sets] = np.minimum(signatures[run_sets], run_minimums)
+        return signatures
+
+    def _one_permutation_signatures(
+        self, hashed: np.ndarray, set_of_value: np.ndarray, num_sets: int
+    ) -> np.ndarray:
+        """Bin each value by its one hash, and fill the empty bins. See MinHasher."""
+        num_bins = np.uint64(self.num_hashes)
+        mixed = _mix64(hashed ^ self._bin_key)
+        # The high half picks the bin, and the low half is the value to minimize.
+        bins = ((mixed >> np.uint64(32)) * num_bins) >> np.uint64(32)
+        binned = np.full((num_sets, self.num_hashes), self.EMPTY_BIN, dtype=np.uint32)
+        np.minimum.at(
+            binned.reshape(-1),
+            set_of_value * self.num_hashes + bins.astype(np.int64),
+            np.minimum(mixed & np.uint64(0xFFFFFFFF), self.EMPTY_BIN - 1).astype(np.uint32),
+        )
+
+        # Each empty bin probes bins in a fixed pseudo-random order, the same for
+        # every set, and takes the value of the first that isn't empty. Sets with
+        # no values at all are left empty.
+        empty = binned == self.EMPTY_BIN
+        signatures = binned.copy()
+        rows, empty_bins = np.nonzero(empty & ~empty.all(axis=1, keepdims=True))
+        attempt = np.uint64(0)
+        while len(rows):
+            probe_keys = (empty_bins.astype(np.uint64) << np.uint64(32)) + attempt
+            probe = _mix64(self._densify_key ^ probe_keys)
+            probe = (((probe >> np.uint64(32)) * num_bins) >> np.uint64(32)).astype(np.int64)
+            found = ~empty[rows, probe]
+            signatures[rows[found], empty_bins[found]] = binned[rows[found], probe[found]]
+            rows = rows[~found]
+            empty_bins = empty_bins[~found]
+            attempt += np.uint64(1)
+        return signatures
+
+    def _hash_array(self, hashed: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """_hash of every hash_func(value) with every (a, b), as a values x hashes matrix.
+
+        _hash works on unbounded Python ints, which here grow to 150 bits, so this
+        works on two's complement integers held as 32 bit limbs, adding a limb
+        with each multiplication.
+        """
+        value = _multiply_limbs(_to_limbs(hashed)[:, :, np.newaxis], a)
+        for _ in range(2):
+            value = _multiply_limbs(_shift_xor_limbs(value), 0x45D9F3B)
+        value = _limbs_mod(_shift_xor_limbs(value), self.LARGE_PRIME)
+        return ((value + b) % np.uint64(self.LARGE_PRIME)).astype(np.uint32)
 
     def _hash(self, value: T, hash_params: tuple[int, int]) -> int:
         a, b = hash_params
@@ -57,16 +312,283 @@ class MinHasher(Generic[T]):
         return value
 
 
+_LIMB_MASK = np.uint64(0xFFFFFFFF)
+_LIMB_BITS = np.uint64(32)
+_SIGN_BIT = np.uint64(31)
+
+
+def _bag_counts(bag: Bag[T]) -> tuple[Sequence[T], np.ndarray]:
+    """Return the bag's distinct values, and the count of each as an int64 array."""
+    if isinstance(bag, BagCounts):
+        values = bag.values
+        counts = np.asarray(bag.counts)
+        if counts.shape != (len(values),):
+            raise ValueError("A bag needs exactly one count per value")
+        if len(counts) and counts.dtype.kind not in "iu":
+            raise ValueError("Bag counts must be integers")
+        counts = counts.astype(np.int64)
+    else:
+        if isinstance(bag, PQGramIndex):
+            bag = Counter(bag.labeled_pq_grams())
+        elif not isinstance(bag, Mapping):
+            bag = Counter(bag)
+        values = list(bag)
+        counts = np.fromiter(bag.values(), dtype=np.int64, count=len(bag))
+    if (counts < 1).any():
+        raise ValueError("Bag counts must be positive")
+    return values, counts
+
+
+def _to_limbs(values: np.ndarray) -> np.ndarray:
+    """Split int64 values into two 32 bit limbs, least significant first.
+
+    The limbs are of a two's complement integer. However many limbs there are,
+    the top bit of the top one is the sign, as if repeated in infinitely more.
+    """
+    unsigned = values.astype(np.uint64)
+    return np.stack([unsigned & _LIMB_MASK, unsigned >> _LIMB_BITS])
+
+
+def _multiply_limbs(limbs: np.ndarray, factor: np.ndarray | int) -> np.ndarray:
+    """Multiply by factor, at most 32 bits, adding a limb to hold the product."""
+    factor = np.asarray(factor, dtype=np.uint64)
+    num_limbs = len(limbs) + 1
+    product = np.empty(
+        (num_limbs,) + np.broadcast_shapes(limbs.shape[1:], factor.shape), dtype=np.uint64
+    )
+    wide = np.empty(product.shape[1:], dtype=np.uint64)
+    carry = np.zeros(product.shape[1:], dtype=np.uint64)
+    sign_extension = (limbs[-1] >> _SIGN_BIT) * _LIMB_MASK
+    for i in range(num_limbs):
+        # Limb * factor + carry is at most 2**64 - 2**32, so doesn't overflow.
+        np.multiply(limbs[i] if i < len(limbs) else sign_extension, factor, out=wide)
+        wide += carry
+        np.bitwise_and(wide, _LIMB_MASK, out=product[i])
+        np.right_shift(wide, _LIMB_BITS, out=carry)
+    return product
+
+
+def _shift_xor_limbs(limbs: np.ndarray) -> np.ndarray:
+    """Return (value >> 16) ^ value, with >> shifting in the sign as Python's does."""
+    shifted = limbs >> np.uint64(16)
+    shifted[:-1] |= (limbs[1:] << np.uint64(16)) & _LIMB_MASK
+    shifted[-1] |= (limbs[-1] >> _SIGN_BIT) * np.uint64(0xFFFF0000)
+    shifted ^= limbs
+    return shifted
+
+
+def _limbs_mod(limbs: np.ndarray, modulus: int) -> np.ndarray:
+    """Return the signed value of the limbs modulo modulus, as Python's % does."""
+    limb_modulus = np.uint64(2**32 % modulus)
+    result = np.zeros(limbs.shape[1:], dtype=np.uint64)
+    for limb in limbs[::-1]:
+        # With modulus < 2**31, result * limb_modulus + limb stays below 2**64.
+        result *= limb_modulus
+        result += limb
+        result %= np.uint64(modulus)
+    wrap = np.uint64((modulus - 2 ** (32 * len(limbs)) % modulus) % modulus)
+    result += (limbs[-1] >> _SIGN_BIT) * wrap
+    result %= np.uint64(modulus)
+    return result
+
+
+def _mix64(values: np.ndarray) -> np.ndarray:
+    """The SplitMix64 finalizer: a fast bijection of uint64 values that mixes every bit."""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
 def compare(a: MinHash, b: MinHash) -> float:
     """Compare two MinHash signatures and return the fraction of hashes that match.
 
     This approximates the Jaccard similarity of the two sets used to create the MinHashes.
+    For b-bit signatures, the fraction is corrected for the chance matches.
     """
     if len(a.signature) != len(b.signature):
         raise ValueError("Signatures must be the same length")
+    _check_comparable(a, b)
+
+    # Count the number of hashes that are in both signatures
+    num_matches = np.count_nonzero(a.signature == b.signature)
+    return float(_corrected(num_matches / len(a.signature), a._bits))
+
+
+def compare_many(query: MinHash, signatures: np.ndarray) -> np.ndarray:
+    """compare the query with each row of a signature matrix, as from signature_matrix.
+
+    Requires:
+    - The rows are signatures of MinHashes comparable with query, and of its bits.
+    """
+    if signatures.ndim != 2 or signatures.shape[1] != len(query.signature):
+        raise ValueError("Signatures must be the same length")
+
+    # In chunks of rows, so the comparisons stay in cache.
+    chunk_size = max(1, 2**20 // max(1, signatures.shape[1]))
+    num_matches = np.empty(len(signatures), dtype=np.int64)
+    for start in range(0, len(signatures), chunk_size):
+        chunk = signatures[start : start + chunk_size]
+        num_matches[start : start + chunk_size] = (chunk == query.signature).sum(
+            axis=1, dtype=np.int32
+        )
+    return _corrected(num_matches / signatures.shape[1], query._bits)
+
+
+def signature_matrix(min_hashes: Sequence[MinHash]) -> np.ndarray:
+    """Stack the signatures of comparable MinHashes into a matrix, for compare_many."""
+    for min_hash in min_hashes[1:]:
+        _check_comparable(min_hashes[0], min_hash)
+    if not min_hashes:
+        return np.zeros((0, 0), dtype=np.uint32)
+    return np.stack([min_hash.signature for min_hash in min_hashes])
+
+
+def _corrected(match_fraction, bits: int):
+    """Remove the expected chance matches of b-bit hashes from the fraction that match.
+
+    Distinct b-bit hashes still match one time in 2**bits, so the fraction that
+    match is about J + (1 - J) / 2**bits. Negative estimates are clipped to 0.
+    """
+    if bits >= 32:
+        return match_fraction
+    chance = 2.0**-bits
+    return np.maximum((match_fraction - chance) / (1 - chance), 0.0)
+
+
+def estimate_pq_gram_distance(a: MinHash, b: MinHash) -> float:
+    """Estimate pq_grams(..., normalized=True) from the MinHasher.bag of each tree's pq-grams.
+
+    With J the bags' Jaccard similarity, |A ∩ B| / (|A| + |B| - |A ∩ B|), the
+    normalized pq-gram distance is (1 - J) / (1 + 2J).
+    """
+    jaccard = compare(a, b)
+    return (1 - jaccard) / (1 + 2 * jaccard)
+
+
+def _check_comparable(a: MinHash, b: MinHash):
     if a._hash_seed != b._hash_seed:
         raise ValueError("Signatures must be generated with the same seed")
+    if a._hash_name != b._hash_name:
+        raise ValueError("Signatures must be generated with the same hash function")
+    if a._mode != b._mode:
+        raise ValueError("Signatures must be generated with the same mode")
+    if a._bits != b._bits:
+        raise ValueError("Signatures must keep the same number of bits")
 
-    # Count the number of hashes that are in both signatures
-    num_matches = sum(a == b for a, b in zip(a.signature, b.signature))
-    return num_matches / len(a.signature)
+
+class LSHIndex(Generic[K]):
+    """Locality sensitive hashing of MinHashes, to find the similar ones without comparing all.
+
+    Each signature is split into num_bands bands of rows_per_band hashes, and
+    two MinHashes are candidates if all the hashes of any one band match. Sets
+    with Jaccard similarity s are then candidates with probability
+    1 - (1 - s**rows_per_band)**num_bands, an S-curve that is steepest around
+    (1 / num_bands)**(1 / rows_per_band). See lsh_parameters to choose them.
+    """
+
+    def __init__(self, num_bands: int, rows_per_band: int):
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self._bands: list[dict[bytes, set[K]]] = [{} for _ in range(num_bands)]
+        self._min_hashes: dict[K, MinHash] = {}
+
+    def insert(self, key: K, min_hash: MinHash):
+        """Add a MinHash, to be identified by key."""
+        if key in self._min_hashes:
+            raise ValueError(f"{key!r} is already in the index")
+        if len(min_hash.signature) < self.num_bands * self.rows_per_band:
+            raise ValueError("Signatures must have at least num_bands * rows_per_band hashes")
+        if self._min_hashes:
+            _check_comparable(next(iter(self._min_hashes.values())), min_hash)
+
+        self._min_hashes[key] = min_hash
+        for buckets, band in zip(self._bands, self._band_keys(min_hash)):
+            buckets.setdefault(band, set()).add(key)
+
+    def remove(self, key: K):
+        min_hash = self._min_hashes.pop(key)
+        for buckets, band in zip(self._bands, self._band_keys(min_hash)):
+            bucket = buckets[band]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[band]
+
+    def __len__(self) -> int:
+        return len(self._min_hashes)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._min_hashes
+
+    def query(self, min_hash: MinHash, threshold: float | None = None) -> set[K]:
+        """Return the keys of the candidates for min_hash.
+
+        If threshold is given, only those whose MinHash compares at least as
+        similar are kept. This can only remove candidates, so false negatives of
+        the banding remain.
+        """
+        candidates: set[K] = set()
+        for buckets, band in zip(self._bands, self._band_keys(min_hash)):
+            candidates.update(buckets.get(band, ()))
+        if threshold is not None:
+            candidates = {
+                key for key in candidates if compare(min_hash, self._min_hashes[key]) >= threshold
+            }
+        return candidates
+
+    def candidate_pairs(self, threshold: float | None = None) -> set[tuple[K, K]]:
+        """Return every pair of keys that share a bucket, each in the order they were inserted.
+
+        If threshold is given, only the pairs whose MinHashes compare at least as
+        similar are kept.
+        """
+        order = {key: index for index, key in enumerate(self._min_hashes)}
+        pairs: set[tuple[K, K]] = set()
+        for buckets in self._bands:
+            for bucket in buckets.values():
+                if len(bucket) < 2:
+                    continue
+                keys = sorted(bucket, key=order.__getitem__)
+                for i, a in enumerate(keys):
+                    pairs.update((a, b) for b in keys[i + 1 :])
+        if threshold is not None:
+            pairs = {
+                (a, b)
+                for a, b in pairs
+                if compare(self._min_hashes[a], self._min_hashes[b]) >= threshold
+            }
+        return pairs
+
+    def _band_keys(self, min_hash: MinHash) -> list[bytes]:
+        rows = self.rows_per_band
+        signature = min_hash.signature
+        return [
+            signature[band * rows : (band + 1) * rows].tobytes() for band in range(self.num_bands)
+        ]
+
+
+def lsh_parameters(
+    num_hashes: int, threshold: float, max_false_negative_rate: float = 0.05
+) -> tuple[int, int]:
+    """Choose (num_bands, rows_per_band) for an LSHIndex of num_hashes hash signatures.
+
+    Of the choices that miss a pair with Jaccard similarity threshold at most
+    max_false_negative_rate of the time, returns the one with the fewest false
+    positives: the lowest chance of a candidate, averaged over similarities
+    below threshold.
+    """
+    below = np.linspace(0.0, threshold, 256, endpoint=False)
+    best: tuple[float, int, int] | None = None
+    for rows_per_band in range(1, num_hashes + 1):
+        num_bands = num_hashes // rows_per_band
+        false_negative_rate = (1 - threshold**rows_per_band) ** num_bands
+        if false_negative_rate > max_false_negative_rate:
+            continue
+        false_positive_rate = float(np.mean(1 - (1 - below**rows_per_band) ** num_bands))
+        if best is None or false_positive_rate < best[0]:
+            best = (false_positive_rate, num_bands, rows_per_band)
+    if best is None:
+        raise ValueError(
+            f"No choice of bands for {num_hashes} hashes misses at most "
+            f"{max_false_negative_rate} of pairs at similarity {threshold}"
+        )
+    return best[1], best[2]
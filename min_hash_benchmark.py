@@ -0,0 +1,52 @@
+"""Compare the accuracy and speed of the classic and one_permutation MinHash modes.
+
+As in the min_hash_false_neg notebook, sets are random 32 bit ints. Each pair
+of sets is built with a known Jaccard similarity, and the error is the MinHash
+estimate minus it. Run with:
+    python min_hash_benchmark.py
+"""
+
+import random
+import timeit
+
+import numpy as np
+
+from min_hash import MinHasher, MinHashMode, compare
+
+
+def random_pair(size: int, jaccard: float) -> tuple[set[int], set[int]]:
+    """Two sets of the given size, with the given Jaccard similarity (rounded)."""
+    # |a & b| / |a | b| = shared / (2 * size - shared)
+    shared = round(2 * size * jaccard / (1 + jaccard))
+    values = random.sample(range(0xFFFFFFFF), 2 * size - shared)
+    return set(values[:size]), set(values[size - shared :])
+
+
+def accuracy(hasher: MinHasher, size: int, num_pairs: int = 200) -> tuple[float, float]:
+    """Return the mean error and root mean square error of the estimates."""
+    random.seed(size)
+    errors = []
+    for _ in range(num_pairs):
+        a, b = random_pair(size, jaccard=random.random())
+        errors.append(compare(hasher(a), hasher(b)) - len(a & b) / len(a | b))
+    return float(np.mean(errors)), float(np.sqrt(np.mean(np.square(errors))))
+
+
+def main():
+    num_hashes = 256
+    modes: tuple[MinHashMode, ...] = ("classic", "one_permutation")
+    hashers = {mode: MinHasher(num_hashes, mode=mode) for mode in modes}
+    print(f"{num_hashes} hashes")
+    for size in (16, 256, 4096):
+        for mode, hasher in hashers.items():
+            bias, rmse = accuracy(hasher, size)
+            values = set(random.sample(range(0xFFFFFFFF), size))
+            elapsed = min(timeit.repeat(lambda: hasher(values), number=5, repeat=3)) / 5
+            print(
+                f"size {size:>5}  {mode:<16} bias: {bias:+.4f}  rmse: {rmse:.4f}"
+                f"  time: {1e3 * elapsed:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
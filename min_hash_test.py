@@ -1,9 +1,26 @@
 import logging
+import os
 import random
+import subprocess
+import sys
 
+import numpy as np
 import pytest
 
-from min_hash import MinHasher, compare
+from min_hash import (
+    BagCounts,
+    LSHIndex,
+    MinHasher,
+    compare,
+    compare_many,
+    estimate_pq_gram_distance,
+    hash_func_name,
+    lsh_parameters,
+    signature_matrix,
+    stable_hash,
+)
+from pq_grams import PQGramIndex, pq_grams
+from tree import LabelTable, random_tree
 
 
 def test_same():
@@ -53,3 +70,209 @@ def test_seed_mismatch():
     hasher2 = MinHasher(num_hashes, seed=2)
 
     assert pytest.raises(ValueError, compare, hasher1(values_a), hasher2(values_b))
+
+
+def _scalar_signature(hasher: MinHasher, values) -> list[int]:
+    hashes = [hasher.LARGE_PRIME] * hasher.num_hashes
+    for value in values:
+        for i, params in enumerate(hasher.hash_parameters):
+            hashes[i] = min(hashes[i], hasher._hash(value, params))
+    return hashes
+
+
+def test_vectorized_matches_scalar():
+    random.seed(23)
+    extremes = {-(2**63), -1, 0, 1, 2**63 - 1}
+    for seed in range(4):
+        hasher = MinHasher(32, seed=seed)
+        sets = [
+            set(random.randint(-(2**63), 2**63 - 1) for _ in range(random.randint(0, 40)))
+            for _ in range(6)
+        ]
+        sets += [set(), extremes, {"a", "b"}, {(1, 2), (3, -4)}]
+        signatures = hasher.signatures(sets)
+        assert signatures.shape == (len(sets), 32)
+        for values, signature in zip(sets, signatures):
+            assert signature.tolist() == _scalar_signature(hasher, values)
+            assert hasher(values).signature.tolist() == signature.tolist()
+
+
+def test_wide_hash_func():
+    # Values too wide for int64 fall back to hashing each one exactly.
+    hasher = MinHasher(8, hash_func=lambda value: value * 2**70)
+    assert hasher([1, -3]).signature.tolist() == _scalar_signature(hasher, [1, -3])
+
+
+def test_lsh_finds_near_duplicates():
+    random.seed(24)
+    hasher = MinHasher(64)
+    bases = [set(random.sample(range(100000), 200)) for _ in range(20)]
+    # Each near duplicate shares 190 of its base's 200 values: a Jaccard of ~0.9.
+    near = [set(random.sample(sorted(base), 190)) | {-i - 1 for i in range(10)} for base in bases]
+    num_bands, rows_per_band = lsh_parameters(64, threshold=0.8, max_false_negative_rate=0.01)
+    assert num_bands * rows_per_band <= 64
+
+    index: LSHIndex[str] = LSHIndex(num_bands, rows_per_band)
+    for i, values in enumerate(bases):
+        index.insert(f"base{i}", hasher(values))
+    for i, values in enumerate(near):
+        index.insert(f"near{i}", hasher(values))
+    assert len(index) == 40
+
+    pairs = index.candidate_pairs(threshold=0.7)
+    assert {(f"base{i}", f"near{i}") for i in range(20)} <= pairs
+    # Unrelated sets share nothing, so aren't candidates.
+    assert len(pairs) == 20
+    assert index.query(hasher(bases[3])) == {"base3", "near3"}
+
+    index.remove("near3")
+    assert "near3" not in index
+    assert index.query(hasher(bases[3])) == {"base3"}
+    with pytest.raises(ValueError):
+        index.insert("base0", hasher(bases[0]))
+    with pytest.raises(ValueError):
+        index.insert("other", MinHasher(64, seed=2)(bases[0]))
+
+
+def test_lsh_parameters():
+    num_bands, rows_per_band = lsh_parameters(128, threshold=0.5, max_false_negative_rate=0.05)
+    assert (1 - 0.5**rows_per_band) ** num_bands <= 0.05
+    # A higher threshold allows more rows per band, so fewer false positives.
+    assert lsh_parameters(128, threshold=0.9)[1] > rows_per_band
+    with pytest.raises(ValueError):
+        lsh_parameters(4, threshold=0.1, max_false_negative_rate=0.001)
+
+
+def test_stable_hash_across_processes():
+    values = ["a", b"a", 1, -(2**70), ("a", 1, (2, b"b")), ()]
+    code = (
+        "from min_hash import MinHasher, stable_hash;"
+        f"print([stable_hash(v) for v in {values!r}], MinHasher(8)({values!r}).signature.tolist())"
+    )
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env={"PYTHONHASHSEED": seed, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in ("1", "2")
+    }
+    expected = [stable_hash(v) for v in values], MinHasher(8)(values).signature.tolist()
+    assert outputs == {"{} {}\n".format(*expected)}
+    # Each type is tagged, so equal looking values of different types differ.
+    assert len({stable_hash(v) for v in ("1", b"1", 1, (1,), ((1,),))}) == 5
+    with pytest.raises(TypeError):
+        stable_hash(1.5)
+
+
+def test_hash_func_mismatch():
+    values = ["a", "b", "c"]
+    assert MinHasher(10).hash_name == "stable_hash"
+    assert hash_func_name(hash) != "stable_hash"
+    with pytest.raises(ValueError):
+        compare(MinHasher(10)(values), MinHasher(10, hash_func=hash)(values))
+
+
+def test_one_permutation_estimates_jaccard():
+    random.seed(25)
+    hasher = MinHasher(128, mode="one_permutation")
+    errors = []
+    for size in (10, 100, 1000):
+        for _ in range(20):
+            values = random.sample(range(10**9), 2 * size)
+            a, b = set(values[: 3 * size // 2]), set(values[size // 2 :])
+            errors.append(compare(hasher(a), hasher(b)) - len(a & b) / len(a | b))
+    assert abs(sum(errors) / len(errors)) < 0.02
+    assert max(abs(error) for error in errors) < 0.25
+
+
+def test_one_permutation_signatures():
+    random.seed(26)
+    hasher = MinHasher(64, mode="one_permutation")
+    sets = [set(random.sample(range(1000), size)) for size in (1, 5, 100)] + [set()]
+    signatures = hasher.signatures(sets)
+    for values, signature in zip(sets, signatures):
+        assert hasher(values).signature.tolist() == signature.tolist()
+    # Every bin is filled, unless the set is empty.
+    assert (signatures[:-1] < MinHasher.EMPTY_BIN).all()
+    assert (signatures[-1] == MinHasher.EMPTY_BIN).all()
+    assert compare(hasher(sets[2]), hasher(set(sets[2]))) == 1.0
+
+    with pytest.raises(ValueError):
+        compare(hasher(sets[2]), MinHasher(64)(sets[2]))
+
+
+def test_bag_signatures():
+    hasher = MinHasher(64)
+    bag = ["a", "b", "b", "c", "c", "c"]
+    # Repeats count, and a bag can be given by its counts.
+    assert hasher.bag(bag) == hasher.bag({"a": 1, "b": 2, "c": 3})
+    assert hasher.bag(bag) != hasher.bag(["a", "b", "c"])
+    # Without repeats, a bag hashes as its set.
+    assert hasher.bag(["a", "b", "c"]) == hasher({"a", "b", "c"})
+    for mode in ("classic", "one_permutation"):
+        bag_hasher = MinHasher(16, mode=mode)
+        signatures = bag_hasher.bag_signatures([bag, [], {"x": 2}])
+        assert signatures[0].tolist() == bag_hasher.bag(bag).signature.tolist()
+        assert signatures[1].tolist() == bag_hasher([]).signature.tolist()
+
+    # Counts can also be given as an array, or by a PQGramIndex.
+    counts = BagCounts(["a", "b", "c"], np.array([1, 2, 3]))
+    assert hasher.bag(counts) == hasher.bag(bag)
+    tree = random_tree(max_depth=3, fanouts=(0, 3, 6), labels=("a", "b"))
+    index = PQGramIndex(tree, p=2, q=3)
+    assert hasher.bag(index) == hasher.bag(index.labeled_pq_grams())
+    for invalid in ({"a": 1, "b": 0}, {"a": -1}, BagCounts(["a"], np.array([1, 1]))):
+        with pytest.raises(ValueError):
+            hasher.bag(invalid)
+
+
+def test_bag_estimates_pq_gram_distance():
+    # Wide trees of few labels repeat many pq-grams.
+    random.seed(27)
+    hasher = MinHasher(256, mode="one_permutation")
+    errors = []
+    for _ in range(20):
+        a_tree = random_tree(max_depth=3, fanouts=(0, 3, 6), labels=("a", "b"))
+        b_tree = random_tree(max_depth=3, fanouts=(0, 3, 6), labels=("a", "b"))
+        table = LabelTable()
+        a_grams = PQGramIndex(a_tree, p=2, q=3, label_table=table).pq_grams
+        b_grams = PQGramIndex(b_tree, p=2, q=3, label_table=table).pq_grams
+        estimate = estimate_pq_gram_distance(hasher.bag(a_grams), hasher.bag(b_grams))
+        errors.append(estimate - pq_grams(a_tree, b_tree, normalized=True))
+    assert abs(sum(errors) / len(errors)) < 0.03
+    assert max(abs(error) for error in errors) < 0.15
+
+
+def test_compare_many():
+    random.seed(28)
+    hasher = MinHasher(64)
+    sets = [set(random.sample(range(300), 100)) for _ in range(30)]
+    min_hashes = [hasher(values) for values in sets]
+    matrix = signature_matrix(min_hashes)
+    assert matrix.dtype == np.uint32 and matrix.shape == (30, 64)
+    expected = [compare(min_hashes[0], min_hash) for min_hash in min_hashes]
+    assert compare_many(min_hashes[0], matrix).tolist() == expected
+    with pytest.raises(ValueError):
+        signature_matrix([min_hashes[0], MinHasher(64, seed=2)(sets[0])])
+
+
+def test_b_bit_signatures():
+    random.seed(29)
+    hasher = MinHasher(256)
+    a = set(random.sample(range(10**6), 1000))
+    b = set(list(a)[:600]) | set(random.sample(range(10**6, 2 * 10**6), 400))
+    jaccard = len(a & b) / len(a | b)
+
+    a_bits, b_bits = hasher(a).b_bit(8), hasher(b).b_bit(8)
+    assert a_bits.signature.dtype == np.uint8
+    assert abs(compare(a_bits, b_bits) - jaccard) < 0.1
+    assert compare(a_bits, a_bits) == 1.0
+    assert compare_many(a_bits, signature_matrix([a_bits, b_bits])).tolist() == [
+        1.0,
+        compare(a_bits, b_bits),
+    ]
+    with pytest.raises(ValueError):
+        compare(a_bits, hasher(b))
@@ -0,0 +1,292 @@
+"""Distance matrices over many trees, optionally computed by a pool of processes.
+
+Each tree is preprocessed once, in this process, into a compact form chosen by
+the metric. The preprocessed trees are sent once to each worker process, and
+the workers are then only handed ranges of rows to compute.
+"""
+
+import os
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Literal, TypeAlias
+
+import numpy as np
+
+from min_hash import MinHash, MinHasher
+from pq_grams import PQGramIndex, PQGramProfile, index_distance, profile_distance
+from tree import FlatTree, LabelTable, TreeNode
+from zhang_shasha import (
+    CostFunctions,
+    Engine,
+    SubForest,
+    forest_distance,
+    label_mismatch_cost,
+)
+
+__all__ = [
+    "MetricName",
+    "Metric",
+    "ZhangShashaMetric",
+    "PQGramsMetric",
+    "MinHashMetric",
+    "pairwise_distances",
+]
+
+MetricName: TypeAlias = Literal["zhang_shasha", "pq_grams", "min_hash"]
+
+
+class Metric(ABC):
+    """How to preprocess trees, and compute distances between the preprocessed trees.
+
+    Subclasses must be picklable to be used with more than one job.
+    """
+
+    @property
+    def symmetric(self) -> bool:
+        """Whether distance(a, b) == distance(b, a) and distance(a, a) == 0"""
+        return True
+
+    @abstractmethod
+    def prepare(self, tree: TreeNode | FlatTree) -> Any:
+        """Preprocess a tree into the form passed to distances."""
+
+    @abstractmethod
+    def distances(self, prepared: Sequence[Any], rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Return the distances between each pair of prepared[rows[k]] and prepared[cols[k]]."""
+
+
+@dataclass
+class ZhangShashaMetric(Metric):
+    """The zhang_shasha tree edit distance.
+
+    Trees are prepared as FlatTrees, so cost functions receive FlatNode views.
+    """
+
+    cost_funcs: CostFunctions = field(default_factory=CostFunctions)
+    engine: Engine = "keyroot"
+
+    #: None infers it from cost_funcs: symmetric if inserts and deletes share the
+    #: same cost function, and relabels use the default label_mismatch_cost.
+    is_symmetric: bool | None = None
+
+    @property
+    def symmetric(self) -> bool:
+        if self.is_symmetric is not None:
+            return self.is_symmetric
+        return (
+            self.cost_funcs.insert is self.cost_funcs.delete
+            and self.cost_funcs.relabel is label_mismatch_cost
+        )
+
+    def prepare(self, tree: TreeNode | FlatTree) -> FlatTree:
+        if isinstance(tree, FlatTree):
+            return tree
+        return FlatTree.from_tree(tree)
+
+    def distances(
+        self, prepared: Sequence[FlatTree], rows: np.ndarray, cols: np.ndarray
+    ) -> np.ndarray:
+        # Unpacking a FlatTree into a SubForest is linear, and so cheap next to
+        # the distance itself, but is still only done once per tree per call.
+        forests: dict[int, SubForest] = {}
+
+        def forest(index: int) -> SubForest:
+            if index not in forests:
+                forests[index] = SubForest.from_tree(prepared[index])
+            return forests[index]
+
+        return np.array(
+            [
+                forest_distance(forest(i), forest(j), self.cost_funcs, engine=self.engine)
+                for i, j in zip(rows.tolist(), cols.tolist())
+            ],
+            dtype=np.float64,
+        )
+
+
+@dataclass
+class PQGramsMetric(Metric):
+    """The pq_grams distance. See pq_grams for the parameters."""
+
+    p: int = 2
+    q: int = 3
+    normalized: bool = False
+    halved: bool = True
+    fingerprints: bool = False
+
+    def __post_init__(self):
+        # Shared by every prepared tree, since only those are comparable.
+        self._label_table: LabelTable = LabelTable()
+
+    def prepare(self, tree: TreeNode | FlatTree) -> PQGramIndex | PQGramProfile:
+        if self.fingerprints:
+            return PQGramProfile(tree, p=self.p, q=self.q, label_table=self._label_table)
+        return PQGramIndex(tree, p=self.p, q=self.q, label_table=self._label_table)
+
+    def distances(
+        self, prepared: Sequence[PQGramIndex | PQGramProfile], rows: np.ndarray, cols: np.ndarray
+    ) -> np.ndarray:
+        distance = profile_distance if self.fingerprints else index_distance
+        return np.array(
+            [
+                distance(prepared[i], prepared[j], normalized=self.normalized, halved=self.halved)
+                for i, j in zip(rows.tolist(), cols.tolist())
+            ],
+            dtype=np.float64,
+        )
+
+
+@dataclass
+class MinHashMetric(Metric):
+    """One minus the MinHash estimate of the Jaccard similarity of the trees' pq-gram sets.
+
+    If bag, the pq-grams are hashed as bags, repeats included, with MinHasher.bag.
+    Either way, the pq-grams are hashed with their labels, rather than label ids, so signatures
+    are the same whatever order labels were interned in.
+    """
+
+    num_hashes: int = 128
+    seed: int = 1
+    p: int = 2
+    q: int = 3
+    bag: bool = False
+
+    def __post_init__(self):
+        self._hasher: MinHasher = MinHasher(self.num_hashes, seed=self.seed)
+
+    def prepare(self, tree: TreeNode | FlatTree) -> np.ndarray:
+        index = PQGramIndex(tree, p=self.p, q=self.q)
+        if self.bag:
+            min_hash: MinHash = self._hasher.bag(index)
+        else:
+            min_hash = self._hasher(set(index.labeled_pq_grams()))
+        return min_hash.signature
+
+    def distances(
+        self, prepared: Sequence[np.ndarray], rows: np.ndarray, cols: np.ndarray
+    ) -> np.ndarray:
+        signatures = np.stack(prepared)
+        matches = signatures[rows] == signatures[cols]
+        return 1.0 - matches.mean(axis=1)
+
+
+_METRICS: dict[str, type[Metric]] = {
+    "zhang_shasha": ZhangShashaMetric,
+    "pq_grams": PQGramsMetric,
+    "min_hash": MinHashMetric,
+}
+
+
+def pairwise_distances(
+    trees: Sequence[TreeNode | FlatTree],
+    metric: MetricName | Metric = "zhang_shasha",
+    *,
+    n_jobs: int | None = 1,
+    square: bool = False,
+    chunk_size: int | None = None,
+) -> np.ndarray:
+    """Return the distances between every pair of trees.
+
+    Ensures:
+    - For symmetric metrics, returns the condensed distance matrix (the upper
+      triangle, row by row, as used by scipy.spatial.distance), unless square.
+    - For asymmetric metrics, square must be True, and every entry, including the
+      diagonal, is computed.
+    - n_jobs > 1 computes the distances in that many processes, and n_jobs=None
+      uses one per CPU. chunk_size is the approximate number of distances per task.
+    """
+    if isinstance(metric, str):
+        if metric not in _METRICS:
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {sorted(_METRICS)}")
+        metric = _METRICS[metric]()
+    if n_jobs is not None and n_jobs < 1:
+        raise ValueError(f"n_jobs must be None or at least 1, not {n_jobs}")
+    if not metric.symmetric and not square:
+        raise ValueError("The metric is not symmetric, so requires square=True")
+
+    rows_computer = _RowsComputer(metric, [metric.prepare(tree) for tree in trees])
+    num_trees = len(trees)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    row_ranges = _row_ranges(num_trees, metric.symmetric, n_jobs, chunk_size)
+    if n_jobs == 1:
+        chunks = [rows_computer(start, stop) for start, stop in row_ranges]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(rows_computer,)
+        ) as executor:
+            starts, stops = zip(*row_ranges) if row_ranges else ((), ())
+            chunks = list(executor.map(_compute_rows, starts, stops))
+
+    distances = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float64)
+    if not metric.symmetric:
+        return distances.reshape(num_trees, num_trees)
+    if not square:
+        return distances
+
+    matrix = np.zeros((num_trees, num_trees), dtype=np.float64)
+    upper_rows, upper_cols = np.triu_indices(num_trees, k=1)
+    matrix[upper_rows, upper_cols] = distances
+    matrix[upper_cols, upper_rows] = distances
+    return matrix
+
+
+@dataclass
+class _RowsComputer:
+    """Computes all the distances for a range of rows of the distance matrix."""
+
+    metric: Metric
+    prepared: list[Any]
+
+    def __call__(self, row_start: int, row_stop: int) -> np.ndarray:
+        num_trees = len(self.prepared)
+        rows = []
+        cols = []
+        for row in range(row_start, row_stop):
+            # Only the upper triangle is needed if the metric is symmetric.
+            first_col = row + 1 if self.metric.symmetric else 0
+            rows.append(np.full(num_trees - first_col, row, dtype=np.intp))
+            cols.append(np.arange(first_col, num_trees, dtype=np.intp))
+
+        if not rows:
+            return np.zeros(0, dtype=np.float64)
+        return self.metric.distances(self.prepared, np.concatenate(rows), np.concatenate(cols))
+
+
+def _row_ranges(
+    num_trees: int, symmetric: bool, n_jobs: int, chunk_size: int | None
+) -> list[tuple[int, int]]:
+    """Split the rows into ranges of roughly chunk_size distances each."""
+    num_distances = num_trees * (num_trees - 1) // 2 if symmetric else num_trees * num_trees
+    if chunk_size is None:
+        # A few chunks per job, so that uneven chunks still keep every job busy.
+        chunk_size = max(1, num_distances // (4 * n_jobs))
+
+    ranges = []
+    start = 0
+    size = 0
+    for row in range(num_trees):
+        size += num_trees - row - 1 if symmetric else num_trees
+        if size >= chunk_size:
+            ranges.append((start, row + 1))
+            start = row + 1
+            size = 0
+    if start < num_trees:
+        ranges.append((start, num_trees))
+    return ranges
+
+
+_worker_rows_computer: _RowsComputer | None = None
+
+
+def _init_worker(rows_computer: _RowsComputer):
+    global _worker_rows_computer
+    _worker_rows_computer = rows_computer
+
+
+def _compute_rows(row_start: int, row_stop: int) -> np.ndarray:
+    assert _worker_rows_computer is not None, "Worker was not initialized"
+    return _worker_rows_computer(row_start, row_stop)
@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+import pytest
+
+from min_hash import MinHasher, compare
+from pairwise import (
+    Metric,
+    MinHashMetric,
+    PQGramsMetric,
+    ZhangShashaMetric,
+    pairwise_distances,
+)
+from pq_grams import PQGramIndex, pq_grams
+from tree import random_tree
+from zhang_shasha import CostFunctions, zhang_shasha
+
+
+def _random_trees(count: int):
+    random.seed(11)
+    return [
+        random_tree(max_depth=3, fanouts=(0, 1, 2, 3), labels=("a", "b", "c")) for _ in range(count)
+    ]
+
+
+def test_zhang_shasha_condensed():
+    trees = _random_trees(8)
+    expected = [
+        zhang_shasha(trees[i], trees[j])
+        for i in range(len(trees))
+        for j in range(i + 1, len(trees))
+    ]
+    assert pairwise_distances(trees).tolist() == expected
+
+
+def test_square_matches_condensed():
+    trees = _random_trees(6)
+    condensed = pairwise_distances(trees, "pq_grams")
+    square = pairwise_distances(trees, "pq_grams", square=True)
+    assert np.all(square == square.T)
+    assert np.all(np.diag(square) == 0)
+    assert square[np.triu_indices(len(trees), k=1)].tolist() == condensed.tolist()
+    assert square[1, 4] == pq_grams(trees[1], trees[4])
+
+
+def test_asymmetric_costs():
+    trees = _random_trees(5)
+    cost_funcs = CostFunctions(insert=lambda node: 2)
+    metric = ZhangShashaMetric(cost_funcs)
+    assert not metric.symmetric
+    with pytest.raises(ValueError):
+        pairwise_distances(trees, metric)
+
+    square = pairwise_distances(trees, metric, square=True)
+    assert square[2, 3] == zhang_shasha(trees[2], trees[3], cost_funcs)
+    assert square[3, 2] == zhang_shasha(trees[3], trees[2], cost_funcs)
+
+
+def test_min_hash():
+    trees = _random_trees(5)
+    distances = pairwise_distances(trees, MinHashMetric(num_hashes=16), square=True)
+    hasher = MinHasher(16)
+    a_hash = hasher(set(PQGramIndex(trees[0], p=2, q=3).labeled_pq_grams()))
+    b_hash = hasher(set(PQGramIndex(trees[3], p=2, q=3).labeled_pq_grams()))
+    assert distances[0, 3] == pytest.approx(1 - compare(a_hash, b_hash))
+
+
+def test_process_pool():
+    trees = _random_trees(10)
+    for metric in (ZhangShashaMetric(), PQGramsMetric(normalized=True)):
+        serial = pairwise_distances(trees, metric)
+        parallel = pairwise_distances(trees, metric, n_jobs=2, chunk_size=5)
+        assert parallel.tolist() == serial.tolist()
+
+
+def test_invalid_arguments():
+    trees = _random_trees(3)
+    for n_jobs in (0, -1):
+        with pytest.raises(ValueError):
+            pairwise_distances(trees, n_jobs=n_jobs)
+    with pytest.raises(ValueError, match="pq_grams"):
+        pairwise_distances(trees, "pq_gram")  # type: ignore[arg-type]
+    with pytest.raises(TypeError):
+        Metric()  # type: ignore[abstract]
+
+
+def test_pq_gram_fingerprints():
+    trees = _random_trees(10)
+    expected = pairwise_distances(trees, PQGramsMetric())
+    assert pairwise_distances(trees, PQGramsMetric(fingerprints=True)).tolist() == expected.tolist()
@@ -0,0 +1,168 @@
+"""Nearest tree search over a corpus, by pq_grams distance.
+
+Rather than comparing a query against every tree, an inverted index maps each
+pq-gram fingerprint to the trees that contain it, and how many times. A query
+only visits the postings of its own pq-grams, so only the trees sharing at least
+one pq-gram with it are scored. Every other tree shares nothing, and so its
+distance follows from its size alone, by which the index sorts the trees. The cost
+of a query is then the total length of the postings it visits, which is small
+unless the query's pq-grams are ones that most of the corpus shares.
+
+    corpus = PQGramCorpusIndex(p=2, q=3)
+    ids = [corpus.add(tree) for tree in trees]
+    corpus.nearest(query, k=10)
+"""
+
+from collections import defaultdict
+from collections.abc import Iterator
+from typing import NamedTuple
+
+import numpy as np
+
+from pq_grams import PQGramProfile, bag_distance
+from tree import FlatTree, LabelTable, TreeNode
+
+__all__ = ["PQGramCorpusIndex", "Neighbor"]
+
+
+class Neighbor(NamedTuple):
+    distance: float
+    tree_id: int
+
+
+class PQGramCorpusIndex:
+    """An inverted index from pq-gram fingerprints to the corpus trees containing them.
+
+    The distances are those of pq_grams(..., fingerprints=True), with the index's
+    normalized and halved options.
+    """
+
+    def __init__(
+        self,
+        p: int = 2,
+        q: int = 3,
+        *,
+        normalized: bool = False,
+        halved: bool = True,
+        label_table: LabelTable | None = None,
+    ):
+        self.p = p
+        self.q = q
+        self.normalized = normalized
+        self.halved = halved
+        self.label_table = LabelTable() if label_table is None else label_table
+
+        #: For each fingerprint, the count of it in each tree that has it.
+        self._postings: defaultdict[int, dict[int, int]] = defaultdict(dict)
+        #: For each tree, its distinct fingerprints and their counts.
+        self._profiles: dict[int, tuple[list[int], list[int]]] = {}
+        #: The number of pq-grams of each tree.
+        self._sizes: dict[int, int] = {}
+        #: (number of pq-grams, tree id) of every tree, sorted. Sorted again by the
+        #: first query after trees are added or removed, rather than on each change.
+        self._by_size: list[tuple[int, int]] = []
+        self._by_size_is_stale = False
+        self._next_id = 0
+
+    def add(self, tree: TreeNode | FlatTree, tree_id: int | None = None) -> int:
+        """Add a tree to the corpus, and return its id. If tree_id is None, one is chosen."""
+        if tree_id is None:
+            tree_id = self._next_id
+        elif tree_id in self._profiles:
+            raise ValueError(f"Tree {tree_id} is already in the corpus")
+        self._next_id = max(self._next_id, tree_id + 1)
+
+        fingerprints, counts = self._profile(tree)
+        for fingerprint, count in zip(fingerprints, counts):
+            self._postings[fingerprint][tree_id] = count
+        self._profiles[tree_id] = (fingerprints, counts)
+        self._sizes[tree_id] = sum(counts)
+        self._by_size_is_stale = True
+        return tree_id
+
+    def remove(self, tree_id: int):
+        """Remove a tree from the corpus."""
+        fingerprints, _ = self._profiles.pop(tree_id)
+        del self._sizes[tree_id]
+        for fingerprint in fingerprints:
+            trees = self._postings[fingerprint]
+            del trees[tree_id]
+            if not trees:
+                del self._postings[fingerprint]
+        self._by_size_is_stale = True
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def __contains__(self, tree_id: int) -> bool:
+        return tree_id in self._profiles
+
+    def nearest(self, query: TreeNode | FlatTree, k: int) -> list[Neighbor]:
+        """Return the k trees nearest the query, nearest first.
+
+        Of trees tied at the k-th distance, which ones are returned is unspecified.
+        """
+        query_size, intersections = self._score(query)
+        scored = sorted(
+            Neighbor(self._distance(query_size, self._sizes[tree_id], shared), tree_id)
+            for tree_id, shared in intersections.items()
+        )[:k]
+
+        # The distance of a tree sharing nothing only grows with its size, so
+        # the smallest k of them are the only ones that could be nearer.
+        unshared = []
+        for size, tree_id in self._unshared(intersections):
+            if len(unshared) == k:
+                break
+            unshared.append(Neighbor(self._distance(query_size, size, 0), tree_id))
+        return sorted(scored + unshared)[:k]
+
+    def within(self, query: TreeNode | FlatTree, max_distance: float) -> list[Neighbor]:
+        """Return every tree within max_distance of the query, nearest first."""
+        query_size, intersections = self._score(query)
+        found = [
+            Neighbor(distance, tree_id)
+            for tree_id, shared in intersections.items()
+            if (distance := self._distance(query_size, self._sizes[tree_id], shared))
+            <= max_distance
+        ]
+        for size, tree_id in self._unshared(intersections):
+            distance = self._distance(query_size, size, 0)
+            if distance > max_distance:
+                break
+            found.append(Neighbor(distance, tree_id))
+        return sorted(found)
+
+    def _profile(self, tree: TreeNode | FlatTree) -> tuple[list[int], list[int]]:
+        profile = PQGramProfile(tree, p=self.p, q=self.q, label_table=self.label_table)
+        fingerprints, counts = np.unique(profile.fingerprints, return_counts=True)
+        return fingerprints.tolist(), counts.tolist()
+
+    def _score(self, query: TreeNode | FlatTree) -> tuple[int, defaultdict[int, int]]:
+        """Accumulate the bag intersection of the query with each tree it shares a pq-gram with.
+
+        Returns the query's number of pq-grams, and the intersections by tree id.
+        """
+        fingerprints, counts = self._profile(query)
+        intersections: defaultdict[int, int] = defaultdict(int)
+        for fingerprint, count in zip(fingerprints, counts):
+            trees = self._postings.get(fingerprint)
+            if trees is None:
+                continue
+            for tree_id, tree_count in trees.items():
+                intersections[tree_id] += min(count, tree_count)
+        return sum(counts), intersections
+
+    def _unshared(self, intersections: dict[int, int]) -> Iterator[tuple[int, int]]:
+        """Yield (size, id) of the trees sharing no pq-grams with the query, smallest first."""
+        if self._by_size_is_stale:
+            self._by_size = sorted((size, tree_id) for tree_id, size in self._sizes.items())
+            self._by_size_is_stale = False
+        for size, tree_id in self._by_size:
+            if tree_id not in intersections:
+                yield size, tree_id
+
+    def _distance(self, query_size: int, size: int, shared: int) -> float:
+        return bag_distance(
+            query_size + size, shared, normalized=self.normalized, halved=self.halved
+        )
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from pq_gram_corpus import PQGramCorpusIndex
+from pq_grams import pq_grams
+from tree import random_tree
+
+
+def _random_trees(count: int) -> list:
+    return [
+        random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c", "d"))
+        for _ in range(count)
+    ]
+
+
+def test_nearest_matches_scan():
+    random.seed(18)
+    trees = _random_trees(40)
+    queries = _random_trees(10) + trees[:3]
+    for normalized in (False, True):
+        corpus = PQGramCorpusIndex(normalized=normalized)
+        ids = [corpus.add(tree) for tree in trees]
+        assert ids == list(range(len(trees)))
+        for query in queries:
+            expected = sorted(pq_grams(query, tree, normalized=normalized) for tree in trees)
+            for k in (1, 5, 40, 50):
+                found = corpus.nearest(query, k)
+                assert [neighbor.distance for neighbor in found] == expected[:k]
+                for distance, tree_id in found:
+                    assert pq_grams(query, trees[tree_id], normalized=normalized) == distance
+
+            found = corpus.within(query, expected[10])
+            assert [neighbor.distance for neighbor in found] == [
+                distance for distance in expected if distance <= expected[10]
+            ]
+
+
+def test_query_shares_nothing():
+    random.seed(19)
+    trees = _random_trees(10)
+    corpus = PQGramCorpusIndex()
+    for tree in trees:
+        corpus.add(tree)
+    query = random_tree(max_depth=2, fanouts=(1, 2), labels=("x",))
+    expected = sorted(pq_grams(query, tree) for tree in trees)
+    assert [neighbor.distance for neighbor in corpus.nearest(query, 3)] == expected[:3]
+
+
+def test_add_and_remove():
+    random.seed(20)
+    trees = _random_trees(6)
+    corpus = PQGramCorpusIndex()
+    for tree_id, tree in enumerate(trees):
+        corpus.add(tree, tree_id=10 * tree_id)
+    with pytest.raises(ValueError):
+        corpus.add(trees[0], tree_id=0)
+
+    corpus.remove(0)
+    corpus.remove(30)
+    assert len(corpus) == 4 and 0 not in corpus and 10 in corpus
+    assert corpus.nearest(trees[0], 1)[0].tree_id != 0
+    assert corpus.nearest(trees[1], 1) == [(0, 10)]
+    assert {tree_id for _, tree_id in corpus.nearest(trees[0], 10)} == {10, 20, 40, 50}
+    assert corpus.add(trees[0]) == 51
+
+    # Trees added or removed after a query are seen by the next, even sharing nothing.
+    query = random_tree(max_depth=2, fanouts=(1, 2), labels=("x",))
+    assert {tree_id for _, tree_id in corpus.nearest(query, 10)} == {10, 20, 40, 50, 51}
+    corpus.remove(20)
+    assert {tree_id for _, tree_id in corpus.within(query, 100)} == {10, 40, 50, 51}
@@ -3,19 +3,31 @@ https://tinyurl.com/pq-grams-paper
 
 """
 
-from collections import deque
+from collections import Counter, deque
 from collections.abc import Sequence
-from typing import TypeAlias
-from tree import TreeNode
+from typing import TypeAlias, TypeVar
 
-PQGram: TypeAlias = tuple[str, ...]
+import numpy as np
+
+from tree import FlatTree, LabelTable, NodePath, TreeNode, path_to
+
+#: A pq-gram, as the label ids of its p stem nodes, followed by its q base nodes.
+PQGram: TypeAlias = tuple[int, ...]
 
 # Label value used for "dummy nodes". This implementation means that input
 # trees cannot have empty label strings.
 DUMMY = ""
 
+#: The label id used for "dummy nodes" in pq-grams.
+DUMMY_ID = -1
+
+#: The base of the polynomial hash folding a pq-gram's label ids into a fingerprint.
+FINGERPRINT_BASE = 0x100000001B3
 
-def shift_inplace(deq: deque[str], value: str) -> str:
+T = TypeVar("T")
+
+
+def shift_inplace(deq: deque[T], value: T) -> T:
     deq.append(value)
     return deq.popleft()
 
@@ -57,20 +69,45 @@ class PQGramIndex:
     #: The width of the generated PQ-grams
     q: int
 
-    # TODO: Doc
-    pq_grams: list[PQGram]
+    #: The table of the label ids in the pq-grams. A new table unless one is given.
+    label_table: LabelTable
 
-    def __init__(self, root: TreeNode, p: int, q: int):
+    def __init__(
+        self, root: TreeNode | FlatTree, p: int, q: int, label_table: LabelTable | None = None
+    ):
         self.p = p
         self.q = q
-        self.pq_grams = []
-        stem: deque[str] = deque([DUMMY] * p)
-
-        self._build_index(root, stem)
-        self.pq_grams.sort()
+        self.label_table = LabelTable() if label_table is None else label_table
+        # The pq-grams, sorted, unless edits have changed them since. Edits update
+        # the count of each pq-gram instead, which is built on the first edit, and
+        # the pq-grams are only sorted again if pq_grams is asked for.
+        self._sorted_grams: list[PQGram] = []
+        self._gram_counts: Counter[PQGram] | None = None
+        self._sorted_is_stale = False
+
+        if isinstance(root, FlatTree):
+            self._build_flat_index(root)
+        else:
+            self._build_index(root)
+        self._sorted_grams.sort()
+        self._num_grams = len(self._sorted_grams)
+
+    @property
+    def pq_grams(self) -> list[PQGram]:
+        """The bag of the tree's pq-grams, sorted. Don't modify it.
+
+        Labels are ids in label_table, not strings: see labeled_pq_grams for the
+        pq-grams with their labels. Ids depend on the order the table interned its
+        labels, so only compare the pq-grams of indexes that share a table.
+        """
+        if self._sorted_is_stale:
+            assert self._gram_counts is not None
+            self._sorted_grams = sorted(self._gram_counts.elements())
+            self._sorted_is_stale = False
+        return self._sorted_grams
 
-    def _build_index(self, node: TreeNode, stem: deque):
-        """Recursively build the actual PQ-Grams index of a tree.
+    def _build_index(self, root: TreeNode):
+        """Build the actual PQ-Grams index of a tree.
 
         The index-building part of the PQ-Grams technique is truly the core of the
         published technique. The rest is simply comparing sets of tuples, and proofs
@@ -82,63 +119,441 @@ class PQGramIndex:
         """
         # Corresponds to Algorithm 8.2
         #  - "node" is "a" in the paper
-        #  - self.pg_grams is an in-place edited equivalent to "I"
+        #  - self._sorted_grams is an in-place edited equivalent to "I"
         #
         # Drag a p-deep x q-wide window through the tree. The resulting "shape" is
         # an up-side-down T where the stem of the ⊥ captures "p" ancestor nodes,
         # and the base of the ⊥ captures the "q" children of the deepest node of
         # the stem.
-
+        #
+        # The paper's algorithm is recursive. Here, an explicit stack stands in
+        # for the call stack so that deep trees don't hit Python's recursion
+        # limit. Each entry holds a node's stem, its base, and an iterator over
+        # the children still to visit. Each label is interned once, as its node is
+        # reached, and only its id is carried in the stems and bases. Bases are
+        # tuples, shifted by slicing, so each pq-gram is one concatenation.
+        intern = self.label_table.intern
+        grams = self._sorted_grams
         # Algorithm 8.2: line 5
-        base: deque[str] = deque([DUMMY] * self.q)
+        empty_base: PQGram = (DUMMY_ID,) * self.q
+        closing_steps = range(self.q - 1)
 
-        if node.label == DUMMY:
+        if root.label == DUMMY:
             raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
-
         # Algorithm 8.2: line 6
-        stem = stem.copy()
-        shift_inplace(stem, node.label)
-
-        stem_gram = tuple(stem)  # Save re-tupling this multiple times.
-
-        if len(node.children) == 0:
-            # node is a leaf
-            self.pq_grams.append(stem_gram + tuple(base))
+        root_stem = (DUMMY_ID,) * (self.p - 1) + (intern(root.label),)
+        if not root.children:
+            grams.append(root_stem + empty_base)
             return
 
-        for child in node.children:
-            shift_inplace(base, child.label)
-            self.pq_grams.append(stem_gram + tuple(base))
-            self._build_index(child, stem)
+        stack: list[list] = [[root_stem, empty_base, iter(root.children)]]
+        while stack:
+            entry = stack[-1]
+            stem_gram, base, children = entry
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                for _ in closing_steps:
+                    base = base[1:] + (DUMMY_ID,)
+                    grams.append(stem_gram + base)
+                continue
+
+            if child.label == DUMMY:
+                raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
+            child_id = intern(child.label)
+            base = entry[1] = base[1:] + (child_id,)
+            grams.append(stem_gram + base)
+
+            child_stem = stem_gram[1:] + (child_id,)
+            if child.children:
+                stack.append([child_stem, empty_base, iter(child.children)])
+            else:
+                # child is a leaf
+                grams.append(child_stem + empty_base)
+
+    def _build_flat_index(self, tree: FlatTree):
+        """Build the same PQ-Grams as _build_index, but from a FlatTree's arrays.
+
+        Rather than passing the stem down through recursion, each node's stem is
+        read by walking up its parents, so the nodes can be visited in any order.
+        """
+        if DUMMY in tree.labels and (tree.label_ids == tree.labels.index(DUMMY)).any():
+            raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
 
+        labels = tree.label_ids_in(self.label_table).tolist()
+        parents = tree.parent.tolist()
+        first_child = tree.first_child.tolist()
+        next_sibling = tree.next_sibling.tolist()
+        for index in range(len(tree)):
+            stem: list[int] = []
+            ancestor = index
+            while ancestor != -1 and len(stem) < self.p:
+                stem.append(labels[ancestor])
+                ancestor = parents[ancestor]
+            stem_gram = (DUMMY_ID,) * (self.p - len(stem)) + tuple(reversed(stem))
+
+            base: deque[int] = deque([DUMMY_ID] * self.q)
+            child = first_child[index]
+            if child == -1:
+                # node is a leaf
+                self._sorted_grams.append(stem_gram + tuple(base))
+                continue
+
+            while child != -1:
+                shift_inplace(base, labels[child])
+                self._sorted_grams.append(stem_gram + tuple(base))
+                child = next_sibling[child]
+
+            for k in range(self.q - 1):
+                shift_inplace(base, DUMMY_ID)
+                self._sorted_grams.append(stem_gram + tuple(base))
+
+    def apply_relabel(self, root: TreeNode, relabel: TreeNode | NodePath, label: str):
+        """Update the index for edit_tree.with_node_relabeled(root, relabel, label).
+
+        Only the pq-grams that have the node in their stem or base are recomputed:
+        those of its parent, and of itself and its descendants up to p - 1 levels
+        down. As in with_node_relabeled, the node is given as itself, found by a
+        search of root, or as its path, which skips the search. Otherwise the cost
+        doesn't depend on the size of the tree.
+
+        Requires:
+        - The index is of root, or a tree of the same shape and labels.
+        """
+        if label == DUMMY:
+            raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
+        spine, path = _spine(root, relabel)
+        node = spine[-1]
+        parent_stem = self._parent_stem(spine)
+        relabeled = TreeNode(label, node.children, node.depth)
+        old = self._grams_below(parent_stem, node, self.p)
+        new = self._grams_below(parent_stem, relabeled, self.p)
+        if path:
+            siblings = spine[-2].children
+            index = path[-1]
+            old += self._node_grams(parent_stem, siblings)
+            children = siblings[:index] + (relabeled,) + siblings[index + 1 :]
+            new += self._node_grams(parent_stem, children)
+        self._replace_grams(old, new)
+
+    def apply_delete(self, root: TreeNode, delete: TreeNode | NodePath):
+        """Update the index for edit_tree.with_node_deleted(root, delete). See apply_relabel."""
+        spine, path = _spine(root, delete)
+        if not path:
+            raise ValueError("The root node cannot be deleted")
+        node = spine[-1]
+        parent_stem = self._parent_stem(spine)
+        siblings = spine[-2].children
+        index = path[-1]
+        children = siblings[:index] + node.children + siblings[index + 1 :]
+
+        old = self._node_grams(parent_stem, siblings)
+        old += self._grams_below(parent_stem, node, self.p)
+        new = self._node_grams(parent_stem, children)
+        for grandchild in node.children:
+            new += self._grams_below(parent_stem, grandchild, self.p - 1)
+        self._replace_grams(old, new)
+
+    def apply_insert(
+        self,
+        root: TreeNode,
+        insert_label: str,
+        parent: TreeNode | NodePath,
+        index: int,
+        num_children: int = 0,
+    ):
+        """Update the index for edit_tree.with_node_inserted with the same arguments.
+
+        See apply_relabel.
+        """
+        if insert_label == DUMMY:
+            raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
+        spine, _ = _spine(root, parent)
+        node = spine[-1]
+        parent_stem = self._stem(self._parent_stem(spine), node)
+        adopted = node.children[index : index + num_children]
+        inserted = TreeNode(insert_label, adopted, node.depth + 1)
+        children = node.children[:index] + (inserted,) + node.children[index + num_children :]
+
+        old = self._node_grams(parent_stem, node.children)
+        for child in adopted:
+            old += self._grams_below(parent_stem, child, self.p - 1)
+        new = self._node_grams(parent_stem, children)
+        new += self._grams_below(parent_stem, inserted, self.p)
+        self._replace_grams(old, new)
+
+    def _parent_stem(self, spine: list[TreeNode]) -> PQGram:
+        """Return the stem of the parent of the node at the end of spine (dummies for the root)."""
+        stem_gram = (DUMMY_ID,) * self.p
+        for ancestor in spine[max(0, len(spine) - self.p - 1) : -1]:
+            stem_gram = self._stem(stem_gram, ancestor)
+        return stem_gram
+
+    def _stem(self, parent_stem: PQGram, node: TreeNode) -> PQGram:
+        return (parent_stem + (self.label_table.intern(node.label),))[1:]
+
+    def _node_grams(self, stem_gram: PQGram, children: Sequence[TreeNode]) -> list[PQGram]:
+        """The pq-grams with the given stem, over the node's children. See _build_index."""
+        base: deque[int] = deque([DUMMY_ID] * self.q)
+        if not children:
+            return [stem_gram + tuple(base)]
+
+        grams = []
+        for child in children:
+            shift_inplace(base, self.label_table.intern(child.label))
+            grams.append(stem_gram + tuple(base))
         for k in range(self.q - 1):
-            shift_inplace(base, DUMMY)
-            self.pq_grams.append(stem_gram + tuple(base))
+            shift_inplace(base, DUMMY_ID)
+            grams.append(stem_gram + tuple(base))
+        return grams
+
+    def _grams_below(self, parent_stem: PQGram, top: TreeNode, levels: int) -> list[PQGram]:
+        """The pq-grams of top, and of its descendants fewer than levels below it."""
+        grams: list[PQGram] = []
+        if levels <= 0:
+            return grams
+        stack = [(self._stem(parent_stem, top), top, 0)]
+        while stack:
+            stem_gram, node, level = stack.pop()
+            grams += self._node_grams(stem_gram, node.children)
+            if level + 1 < levels:
+                stack.extend(
+                    (self._stem(stem_gram, child), child, level + 1) for child in node.children
+                )
+        return grams
+
+    def _counts(self) -> Counter[PQGram]:
+        """The count of each pq-gram. Built when first needed, and kept up to date by edits."""
+        if self._gram_counts is None:
+            self._gram_counts = Counter(self._sorted_grams)
+        return self._gram_counts
+
+    def _replace_grams(self, old: list[PQGram], new: list[PQGram]):
+        """Remove the old pq-grams from the bag, and add the new ones."""
+        counts = self._counts()
+        old_counts = Counter(old)
+        # Check first, so that the index is left as is if it's the wrong tree.
+        for gram, count in old_counts.items():
+            if counts[gram] < count:
+                raise ValueError("The index is not of the edited tree")
+        counts.subtract(old_counts)
+        for gram in old_counts:
+            if not counts[gram]:
+                del counts[gram]
+        counts.update(new)
+        self._num_grams += len(new) - len(old)
+        self._sorted_is_stale = True
+
+    def labeled_pq_grams(self) -> list[tuple[str, ...]]:
+        """Return the pq-grams with their labels, rather than label ids. Dummies are DUMMY.
+
+        They are in no particular order, as they aren't sorted again after edits.
+        """
+        grams = self._counts().elements() if self._sorted_is_stale else self._sorted_grams
+        # DUMMY_ID is -1, so indexes the DUMMY appended at the end.
+        labels = [*self.label_table.labels, DUMMY]
+        return [tuple(map(labels.__getitem__, pq_gram)) for pq_gram in grams]
+
+
+def _spine(root: TreeNode, node: TreeNode | NodePath) -> tuple[list[TreeNode], NodePath]:
+    """Return the nodes from root down to node, inclusive, and node's path."""
+    path = path_to(root, node) if isinstance(node, TreeNode) else tuple(node)
+    spine = [root]
+    for index in path:
+        if not 0 <= index < len(spine[-1].children):
+            raise ValueError(f"There is no node at {path}")
+        spine.append(spine[-1].children[index])
+    return spine, path
+
+
+def fingerprint(pq_gram: PQGram) -> int:
+    """Fold a pq-gram's label ids into the 64 bit fingerprint used by PQGramProfile."""
+    value = 0
+    for label_id in pq_gram:
+        value = (value * FINGERPRINT_BASE + label_id - DUMMY_ID) % 2**64
+    return value
+
+
+class PQGramProfile:
+    """A tree's bag of pq-grams, as sorted 64 bit fingerprints.
+
+    Each pq-gram is folded into one integer by a Karp-Rabin style polynomial hash
+    over its stem and base label ids, so the whole profile is a single uint64
+    array: a few bytes per pq-gram, rather than a tuple of p + q ids. Distinct
+    pq-grams can share a fingerprint, but with 64 bits this is vanishingly rare,
+    and only ever makes the distance smaller.
+    """
+
+    #: The depth/height of the generated PQ-Grams
+    p: int
+
+    #: The width of the generated PQ-grams
+    q: int
+
+    #: The fingerprint of each of the tree's pq-grams, sorted.
+    fingerprints: np.ndarray
+
+    #: The table of the label ids hashed into the fingerprints. A new table unless
+    #: one is given, and profiles can only be compared if they share a table.
+    label_table: LabelTable
+
+    def __init__(
+        self, root: TreeNode | FlatTree, p: int, q: int, label_table: LabelTable | None = None
+    ):
+        self.p = p
+        self.q = q
+        self.label_table = LabelTable() if label_table is None else label_table
+        tree = root if isinstance(root, FlatTree) else FlatTree.from_tree(root)
+        self.fingerprints = self._build_fingerprints(tree)
+        self.fingerprints.sort()
+
+    @classmethod
+    def from_fingerprints(
+        cls, fingerprints: np.ndarray, p: int, q: int, label_table: LabelTable
+    ) -> "PQGramProfile":
+        """Wrap an already built, sorted, array of fingerprints, such as one read from disk."""
+        profile = cls.__new__(cls)
+        profile.p = p
+        profile.q = q
+        profile.label_table = label_table
+        profile.fingerprints = fingerprints
+        return profile
+
+    def _build_fingerprints(self, tree: FlatTree) -> np.ndarray:
+        """Hash every pq-gram of the tree at once, with array operations.
+
+        Each node contributes the windows of q over its children, padded with
+        q - 1 dummies on both sides, or a single window of dummies for a leaf.
+        All of these padded child lists are laid end to end in one array, so the
+        hash of every window is a sum of q shifted slices of it.
+        """
+        if DUMMY in tree.labels and (tree.label_ids == tree.labels.index(DUMMY)).any():
+            raise TypeError("This implementation of PQ-Grams cannot handle empty node labels.")
+
+        p, q = self.p, self.q
+        num_nodes = len(tree)
+        # Dummies hash as 0, so labels start at 1.
+        digits = tree.label_ids_in(self.label_table).astype(np.uint64) + np.uint64(-DUMMY_ID)
+        powers = [np.uint64(pow(FINGERPRINT_BASE, k, 2**64)) for k in range(max(p, q) + 1)]
+
+        # The stem hash, with the node itself as the last (lowest) digit.
+        stem_hashes = np.zeros(num_nodes, dtype=np.uint64)
+        ancestors = np.arange(num_nodes, dtype=np.int64)
+        parents = tree.parent.astype(np.int64)
+        for k in range(p):
+            present = ancestors != -1
+            stem_hashes[present] += digits[ancestors[present]] * powers[k]
+            ancestors[present] = parents[ancestors[present]]
+
+        # Children in pre-order are grouped under their parent, left to right.
+        children = np.arange(1, num_nodes)
+        num_children = np.bincount(parents[1:], minlength=num_nodes)
+        is_leaf = num_children == 0
+        num_windows = np.where(is_leaf, 1, num_children + q - 1)
+        padded_sizes = np.where(is_leaf, q, num_children + 2 * (q - 1))
+        padded_starts = np.cumsum(padded_sizes) - padded_sizes
+
+        by_parent = np.argsort(parents[1:], kind="stable")
+        sorted_parents = parents[1:][by_parent]
+        child_starts = np.cumsum(num_children) - num_children
+        sibling_rank = np.arange(num_nodes - 1) - child_starts[sorted_parents]
+        padded = np.zeros(int(padded_sizes.sum()), dtype=np.uint64)
+        padded[padded_starts[sorted_parents] + q - 1 + sibling_rank] = digits[children[by_parent]]
+
+        window_nodes = np.repeat(np.arange(num_nodes), num_windows)
+        window_starts = np.cumsum(num_windows) - num_windows
+        window_offsets = np.arange(len(window_nodes)) - window_starts[window_nodes]
+        starts = padded_starts[window_nodes] + window_offsets
+
+        fingerprints = stem_hashes[window_nodes] * powers[q]
+        for k in range(q):
+            fingerprints += padded[starts + k] * powers[q - 1 - k]
+        return fingerprints
+
+
+def count_fingerprint_intersection(a: np.ndarray, b: np.ndarray) -> int:
+    """The size of the bag intersection of two sorted arrays, counting multiplicities."""
+    a_values, a_counts = np.unique(a, return_counts=True)
+    b_values, b_counts = np.unique(b, return_counts=True)
+    _, a_common, b_common = np.intersect1d(
+        a_values, b_values, assume_unique=True, return_indices=True
+    )
+    return int(np.minimum(a_counts[a_common], b_counts[b_common]).sum())
 
 
 def pq_grams(
-    a_tree_root: TreeNode,
-    b_tree_root: TreeNode,
+    a_tree_root: TreeNode | FlatTree,
+    b_tree_root: TreeNode | FlatTree,
     *,
     p: int = 2,
     q: int = 3,
     normalized=False,
     halved=True,
+    fingerprints=False,
 ) -> float:
     """
 
     Ensures:
     - If halved is true, then the *non-normalized* distance returned will be halved [1]
+    - If fingerprints is true, the pq-grams are compared as PQGramProfiles, which
+      is much faster and smaller for large trees, at the risk of hash collisions.
 
     [1] Why? See Section 7.3 which claims that half the pq-gram distance is a lower bound
         on fanout weighted tree edit distance.
     """
-    a_index = PQGramIndex(a_tree_root, p=p, q=q)
-    b_index = PQGramIndex(b_tree_root, p=p, q=q)
+    label_table = LabelTable()
+    if fingerprints:
+        a_profile = PQGramProfile(a_tree_root, p=p, q=q, label_table=label_table)
+        b_profile = PQGramProfile(b_tree_root, p=p, q=q, label_table=label_table)
+        return profile_distance(a_profile, b_profile, normalized=normalized, halved=halved)
+
+    a_index = PQGramIndex(a_tree_root, p=p, q=q, label_table=label_table)
+    b_index = PQGramIndex(b_tree_root, p=p, q=q, label_table=label_table)
+    return index_distance(a_index, b_index, normalized=normalized, halved=halved)
+
+
+def index_distance(
+    a_index: PQGramIndex, b_index: PQGramIndex, *, normalized=False, halved=True
+) -> float:
+    """The pq_grams distance between two already built indexes. See pq_grams."""
+    if (a_index.p, a_index.q) != (b_index.p, b_index.q):
+        raise ValueError("Indexes must be built with the same p and q")
+    if a_index.label_table is not b_index.label_table:
+        raise ValueError("Indexes must be built with the same label table")
 
     # Bag union size: |I1 ⊎ I2|
-    union_size = len(a_index.pq_grams) + len(b_index.pq_grams)
-    intersection_size = count_bag_intersection(a_index.pq_grams, b_index.pq_grams)
+    union_size = a_index._num_grams + b_index._num_grams
+    if a_index._sorted_is_stale or b_index._sorted_is_stale:
+        # After edits, intersect the counts rather than sorting the pq-grams again.
+        a_counts, b_counts = a_index._counts(), b_index._counts()
+        if len(b_counts) < len(a_counts):
+            a_counts, b_counts = b_counts, a_counts
+        intersection_size = sum(min(count, b_counts[gram]) for gram, count in a_counts.items())
+    else:
+        intersection_size = count_bag_intersection(a_index.pq_grams, b_index.pq_grams)
+    return bag_distance(union_size, intersection_size, normalized=normalized, halved=halved)
+
+
+def profile_distance(
+    a_profile: PQGramProfile, b_profile: PQGramProfile, *, normalized=False, halved=True
+) -> float:
+    """The pq_grams distance between two already built profiles. See pq_grams."""
+    if (a_profile.p, a_profile.q) != (b_profile.p, b_profile.q):
+        raise ValueError("Profiles must be built with the same p and q")
+    if a_profile.label_table is not b_profile.label_table:
+        raise ValueError("Profiles must be built with the same label table")
+
+    union_size = len(a_profile.fingerprints) + len(b_profile.fingerprints)
+    intersection_size = count_fingerprint_intersection(
+        a_profile.fingerprints, b_profile.fingerprints
+    )
+    return bag_distance(union_size, intersection_size, normalized=normalized, halved=halved)
+
+
+def bag_distance(
+    union_size: int, intersection_size: int, *, normalized: bool = False, halved: bool = True
+) -> float:
+    """The pq_grams distance, from the sizes of the bag union and intersection."""
     pq_dist = union_size - 2 * intersection_size
 
     if normalized:
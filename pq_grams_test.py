@@ -1,5 +1,28 @@
-from tree import TreeNode, tree_from_dict
-from pq_grams import pq_grams
+import random
+
+import numpy as np
+import pytest
+
+from edit_tree import with_node_deleted, with_node_inserted, with_node_relabeled
+from tree import (
+    FlatTree,
+    LabelTable,
+    TreeInterner,
+    TreeNode,
+    node_at,
+    preorder_paths,
+    preorder_traversal,
+    random_tree,
+    tree_from_dict,
+)
+from pq_grams import (
+    PQGramIndex,
+    PQGramProfile,
+    count_fingerprint_intersection,
+    fingerprint,
+    index_distance,
+    pq_grams,
+)
 from zhang_shasha import zhang_shasha, CostFunctions
 
 
@@ -63,3 +86,129 @@ def test_simple_rename():
 def test_medium_equal():
     tree = tree_from_dict({"root": {"a": {"f": {}}, "b": {"c": {"d": {}, "e": {}}}}})
     assert pq_grams(tree, tree) == 0
+
+
+def test_flat_tree_index():
+    random.seed(6)
+    for _ in range(20):
+        tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3))
+        for p, q in ((1, 2), (2, 3), (3, 2)):
+            table = LabelTable()
+            flat_index = PQGramIndex(FlatTree.from_tree(tree), p=p, q=q, label_table=table)
+            assert flat_index.pq_grams == PQGramIndex(tree, p=p, q=q, label_table=table).pq_grams
+
+
+def test_label_tables():
+    tree = tree_from_dict({"a": {"b": {}}})
+    table = LabelTable()
+    index = PQGramIndex(tree, p=1, q=2, label_table=table)
+    assert sorted(index.labeled_pq_grams()) == [("a", "", "b"), ("a", "b", ""), ("b", "", "")]
+    assert index_distance(index, PQGramIndex(tree, p=1, q=2, label_table=table)) == 0
+    with pytest.raises(ValueError):
+        index_distance(index, PQGramIndex(tree, p=1, q=2, label_table=LabelTable()))
+    # Without a table, each index gets its own, rather than sharing a global one.
+    assert PQGramIndex(tree, p=1, q=2).label_table is not PQGramIndex(tree, p=1, q=2).label_table
+
+
+def test_deep_tree_index():
+    depth = 5000
+    node = TreeNode("x", ())
+    for _ in range(depth):
+        node = TreeNode("x", (node,))
+
+    # Every node has a single gram for its one child (or none for the leaf),
+    # plus q - 1 trailing grams as the window slides off the last child.
+    index = PQGramIndex(node, p=2, q=3)
+    assert len(index.pq_grams) == depth * 3 + 1
+    flat_index = PQGramIndex(FlatTree.from_tree(node), p=2, q=3, label_table=index.label_table)
+    assert index.pq_grams == flat_index.pq_grams
+
+
+def test_fingerprint_profiles():
+    random.seed(16)
+    for _ in range(30):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        for p, q in ((1, 1), (1, 2), (2, 3), (3, 2)):
+            table = LabelTable()
+            profile = PQGramProfile(a_tree, p=p, q=q, label_table=table)
+            index = PQGramIndex(a_tree, p=p, q=q, label_table=table)
+            assert profile.fingerprints.tolist() == sorted(map(fingerprint, index.pq_grams))
+            for normalized in (False, True):
+                assert pq_grams(
+                    a_tree, b_tree, p=p, q=q, normalized=normalized, fingerprints=True
+                ) == pq_grams(a_tree, b_tree, p=p, q=q, normalized=normalized)
+
+
+def test_fingerprint_intersection_counts_multiplicities():
+    a = np.array([1, 2, 2, 2, 5], dtype=np.uint64)
+    b = np.array([2, 2, 3, 5, 5], dtype=np.uint64)
+    assert count_fingerprint_intersection(a, b) == 3
+    assert count_fingerprint_intersection(a, np.zeros(0, dtype=np.uint64)) == 0
+
+
+def test_incremental_edits_match_rebuild():
+    random.seed(17)
+    for p, q in ((1, 2), (2, 3), (3, 2)):
+        tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        index = PQGramIndex(tree, p=p, q=q)
+        original = PQGramIndex(tree, p=p, q=q, label_table=index.label_table)
+        for _ in range(40):
+            nodes = list(preorder_traversal(tree))
+            node = random.choice(nodes)
+            edit_kind = random.choice(("delete", "insert", "relabel"))
+            if edit_kind == "delete" and node is not tree:
+                index.apply_delete(tree, node)
+                tree = with_node_deleted(tree, node)
+            elif edit_kind == "insert":
+                start = random.randint(0, len(node.children))
+                num_children = random.randint(0, len(node.children) - start)
+                label = random.choice("abcd")
+                index.apply_insert(tree, label, node, start, num_children)
+                tree = with_node_inserted(tree, label, node, start, num_children)
+            else:
+                label = random.choice("abcd")
+                index.apply_relabel(tree, node, label)
+                tree = with_node_relabeled(tree, node, label)
+            rebuilt = PQGramIndex(tree, p=p, q=q, label_table=index.label_table)
+            # Distances from the edited counts, before pq_grams sorts them again.
+            assert index_distance(index, original) == index_distance(rebuilt, original)
+            assert index_distance(original, index) == index_distance(original, rebuilt)
+            assert sorted(index.labeled_pq_grams()) == sorted(rebuilt.labeled_pq_grams())
+            assert index.pq_grams == rebuilt.pq_grams
+
+
+def test_incremental_edits_by_path():
+    # Interned trees share equal subtrees, even between siblings, so only a node's
+    # path says which of them is edited.
+    random.seed(18)
+    interner = TreeInterner()
+    tree = interner.intern(random_tree(max_depth=5, fanouts=(0, 2, 3), labels=("a", "b")))
+    index = PQGramIndex(tree, p=2, q=3)
+    for _ in range(40):
+        path = random.choice([path for path, _ in preorder_paths(tree)])
+        edit_kind = random.choice(("delete", "insert", "relabel"))
+        if edit_kind == "delete" and path:
+            index.apply_delete(tree, path)
+            tree = with_node_deleted(tree, path)
+        elif edit_kind == "insert":
+            num_children = len(node_at(tree, path).children)
+            start = random.randint(0, num_children)
+            adopted = random.randint(0, num_children - start)
+            index.apply_insert(tree, "c", path, start, adopted)
+            tree = with_node_inserted(tree, "c", path, start, adopted)
+        else:
+            index.apply_relabel(tree, path, "c")
+            tree = with_node_relabeled(tree, path, "c")
+        rebuilt = PQGramIndex(tree, p=2, q=3, label_table=index.label_table)
+        assert index.pq_grams == rebuilt.pq_grams
+
+
+def test_incremental_edit_of_wrong_tree():
+    tree = tree_from_dict({"a": {"b": {}, "c": {}}})
+    index = PQGramIndex(tree, p=2, q=3)
+    expected = list(index.pq_grams)
+    other = tree_from_dict({"a": {"b": {}, "d": {}}})
+    with pytest.raises(ValueError):
+        index.apply_relabel(other, other.children[1], "e")
+    assert index.pq_grams == expected
@@ -0,0 +1,173 @@
+"""Trees preprocessed once, for comparing against many others.
+
+Each algorithm preprocesses its input trees: zhang_shasha into a SubForest,
+pq_grams into a PQGramIndex, and MinHash into a signature. When the same trees
+are compared over and over, wrap each in a PreparedTree so that this is only
+done once, and pass the parts to the functions that take them directly:
+
+    store = PreparedTreeStore(max_size=4096)
+    a, b = store.get(a_tree), store.get(b_tree)
+    forest_distance(a.forest, b.forest)
+    index_distance(a.pq_gram_index(2, 3), b.pq_gram_index(2, 3))
+    compare(a.min_hash(hasher), b.min_hash(hasher))
+"""
+
+import weakref
+from collections import OrderedDict
+from functools import cached_property
+from typing import NamedTuple
+
+import numpy as np
+
+from min_hash import MinHash, MinHasher
+from pq_grams import PQGramIndex
+from tree import FlatTree, InternedTreeNode, LabelTable, TreeInterner, TreeNode
+from zhang_shasha import SubForest
+
+__all__ = ["PreparedTree", "PreparedTreeStore", "StoreInfo"]
+
+
+class PreparedTree:
+    """A tree, with the preprocessing for each algorithm computed on first use and kept.
+
+    The tree is held as a FlatTree, so cost functions receive FlatNode views.
+    Like PQGramIndexes, the label ids, forests and pq-gram indexes of PreparedTrees
+    can only be compared if the trees share label_table. A PreparedTreeStore gives
+    its trees one.
+    """
+
+    def __init__(self, tree: TreeNode | FlatTree, label_table: LabelTable | None = None):
+        #: The table of every label id of the tree. A new table unless one is given.
+        self.label_table: LabelTable = LabelTable() if label_table is None else label_table
+        #: The tree, flattened. A given FlatTree is kept, even if it has a table of its own.
+        self.flat: FlatTree = (
+            tree if isinstance(tree, FlatTree) else FlatTree.from_tree(tree, self.label_table)
+        )
+        self._pq_gram_indexes: dict[tuple[int, int], PQGramIndex] = {}
+        self._min_hashes: dict[tuple, MinHash] = {}
+
+    def __len__(self) -> int:
+        return len(self.flat)
+
+    @property
+    def label_ids(self) -> np.ndarray:
+        """The label id of each node in label_table, in pre-order."""
+        return self.flat.label_ids_in(self.label_table)
+
+    @cached_property
+    def forest(self) -> SubForest:
+        """The post-ordered nodes and left-most leaves, as used by zhang_shasha."""
+        return SubForest.from_tree(self.flat, self.label_table)
+
+    @cached_property
+    def keyroots(self) -> list[int]:
+        """The post-ordered indexes of the keyroots. Also kept by forest."""
+        return self.forest.keyroot_indexes()
+
+    def pq_gram_index(self, p: int = 2, q: int = 3) -> PQGramIndex:
+        """Return the tree's pq-gram profile, as used by pq_grams."""
+        if (p, q) not in self._pq_gram_indexes:
+            self._pq_gram_indexes[p, q] = PQGramIndex(
+                self.flat, p=p, q=q, label_table=self.label_table
+            )
+        return self._pq_gram_indexes[p, q]
+
+    def min_hash(self, hasher: MinHasher, p: int = 2, q: int = 3) -> MinHash:
+        """Return the MinHash of the tree's set of pq-grams.
+
+        The pq-grams are hashed with their labels, as label ids depend on the order
+        labels were interned, and so would make the MinHash differ between runs.
+        """
+        key = (hasher.parameters, p, q)
+        if key not in self._min_hashes:
+            self._min_hashes[key] = hasher(set(self.pq_gram_index(p, q).labeled_pq_grams()))
+        return self._min_hashes[key]
+
+
+class StoreInfo(NamedTuple):
+    hits: int
+    misses: int
+    max_size: int
+    current_size: int
+
+
+class PreparedTreeStore:
+    """A bounded store of PreparedTrees, evicting the least recently used.
+
+    Trees are looked up by their structure (labels, shape and depths), so an equal
+    tree built separately still finds the PreparedTree, along with everything
+    already computed for it. Trees are keyed as InternedTreeNodes, whose hash is
+    computed once. Other trees are interned, in O(n), the first time each tree
+    object is looked up, and an equal tree that is a different object is compared
+    in full with the stored tree that has its hash. After that, looking up the same
+    object again is O(1), as is looking up the InternedTreeNode that was stored.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Each PreparedTree along with its key, so that lookups can be keyed on it.
+        self._prepared: OrderedDict[InternedTreeNode, tuple[InternedTreeNode, PreparedTree]] = (
+            OrderedDict()
+        )
+        #: Shared by the stored trees, so that their pq-gram indexes are comparable.
+        self.label_table = LabelTable()
+        # The key of each tree object looked up, by id, for as long as the tree lives.
+        self._keys: dict[int, tuple[weakref.ref, InternedTreeNode]] = {}
+
+    def get(self, tree: TreeNode | FlatTree) -> PreparedTree:
+        """Return the PreparedTree for the tree, preparing it if it isn't stored."""
+        key = self._key(tree)
+        stored = self._prepared.get(key)
+        if stored is not None:
+            self.hits += 1
+            self._prepared.move_to_end(key)
+            if stored[0] is not key:
+                self._remember(tree, stored[0])
+            return stored[1]
+
+        self.misses += 1
+        prepared = PreparedTree(tree, self.label_table)
+        self._prepared[key] = (key, prepared)
+        if len(self._prepared) > self.max_size:
+            self._prepared.popitem(last=False)
+        return prepared
+
+    def cache_info(self) -> StoreInfo:
+        """Report the hits and misses, as functools.lru_cache does."""
+        return StoreInfo(self.hits, self.misses, self.max_size, len(self._prepared))
+
+    def clear(self):
+        """Drop every stored tree, and reset the hits and misses."""
+        self._prepared.clear()
+        self._keys.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._prepared)
+
+    def __contains__(self, tree: TreeNode | FlatTree) -> bool:
+        return self._key(tree) in self._prepared
+
+    def _key(self, tree: TreeNode | FlatTree) -> InternedTreeNode:
+        """Return the tree as an InternedTreeNode, preferably the one it is stored as."""
+        known = self._keys.get(id(tree))
+        if known is not None and known[0]() is tree:
+            return known[1]
+        if isinstance(tree, InternedTreeNode):
+            return tree
+
+        # A throwaway interner, as a shared one would keep every tree ever looked up.
+        interner = TreeInterner()
+        key = interner.intern(tree.to_tree(interner) if isinstance(tree, FlatTree) else tree)
+        self._remember(tree, key)
+        return key
+
+    def _remember(self, tree: TreeNode | FlatTree, key: InternedTreeNode):
+        """Keep the key of the tree object for as long as the tree lives."""
+        tree_id, keys = id(tree), self._keys
+        keys[tree_id] = (weakref.ref(tree, lambda _: keys.pop(tree_id, None)), key)
@@ -0,0 +1,136 @@
+import os
+import random
+import subprocess
+import sys
+
+from min_hash import MinHasher, compare
+from pq_grams import index_distance, pq_grams
+from prepared import PreparedTree, PreparedTreeStore
+from tree import (
+    FlatTree,
+    InternedTreeNode,
+    LabelTable,
+    TreeInterner,
+    TreeNode,
+    random_tree,
+    tree_from_dict,
+)
+from zhang_shasha import forest_distance, zhang_shasha
+
+
+def test_prepared_distances_match():
+    hasher = MinHasher(32)
+    random.seed(15)
+    for _ in range(20):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        table = LabelTable()
+        a = PreparedTree(a_tree, table)
+        b = PreparedTree(b_tree, table)
+        assert forest_distance(a.forest, b.forest) == zhang_shasha(a_tree, b_tree)
+        assert index_distance(a.pq_gram_index(2, 3), b.pq_gram_index(2, 3)) == pq_grams(
+            a_tree, b_tree
+        )
+        assert compare(a.min_hash(hasher), b.min_hash(hasher)) == compare(
+            PreparedTree(a_tree).min_hash(hasher), PreparedTree(b_tree).min_hash(hasher)
+        )
+
+
+def test_prepared_parts_are_kept():
+    prepared = PreparedTree(tree_from_dict({"a": {"b": {}, "c": {}}}))
+    assert prepared.forest is prepared.forest
+    assert prepared.keyroots == [1, 2]
+    assert prepared.pq_gram_index(2, 3) is prepared.pq_gram_index(2, 3)
+    assert prepared.pq_gram_index(1, 2) is not prepared.pq_gram_index(2, 3)
+    hasher = MinHasher(8)
+    assert prepared.min_hash(hasher) is prepared.min_hash(hasher)
+    assert prepared.min_hash(MinHasher(8)) is prepared.min_hash(hasher)
+    # Any parameter that changes the signature must miss the cache.
+    for other in (MinHasher(8, mode="one_permutation"), MinHasher(8, seed=2), MinHasher(9)):
+        assert prepared.min_hash(other) == other(prepared.pq_gram_index().labeled_pq_grams())
+
+
+def test_store_hits_equal_trees():
+    store = PreparedTreeStore(max_size=2)
+    tree = {"a": {"b": {}, "c": {"d": {}}}}
+    first = store.get(tree_from_dict(tree))
+    # Built separately, and flattened, but the same structure.
+    assert store.get(FlatTree.from_tree(tree_from_dict(tree))) is first
+    assert store.get(tree_from_dict({"a": {"b": {}, "c": {"e": {}}}})) is not first
+    # Same labels, different shape.
+    assert store.get(tree_from_dict({"a": {"b": {"c": {}, "d": {}}}})) is not first
+    assert first.label_table is store.label_table
+    info = store.cache_info()
+    assert (info.hits, info.misses, info.current_size) == (1, 3, 2)
+
+
+def test_store_keys_by_structure():
+    store = PreparedTreeStore()
+    interner = TreeInterner()
+    tree = interner.intern(random_tree(max_depth=5, fanouts=(1, 2, 3), labels=("a", "b")))
+    first = store.get(tree)
+    assert store.get(tree) is first
+    assert store.get(interner.intern(tree)) is first
+    # An equal tree from another interner, or not interned, is found, here as well.
+    for equal in (TreeInterner().intern(tree), TreeNode(tree.label, tree.children, tree.depth)):
+        assert store.get(equal) is first
+        assert store.get(equal) is first
+    # Depth is part of the structure.
+    assert store.get(TreeNode("a", (), 0)) is not store.get(TreeNode("a", (), 1))
+    # Trees whose hashes collide are still told apart.
+    a_tree = InternedTreeNode("a", (), 0, 1, structural_hash=5)
+    b_tree = InternedTreeNode("b", (), 0, 1, structural_hash=5)
+    assert store.get(a_tree) is not store.get(b_tree)
+    assert store.get(a_tree).flat.label(0) == "a"
+
+
+def test_store_shares_label_ids():
+    store = PreparedTreeStore()
+    a = store.get(tree_from_dict({"x": {"y": {}}}))
+    b = store.get(tree_from_dict({"y": {"x": {}}}))
+    assert a.label_ids.tolist() == b.label_ids[::-1].tolist()
+    assert a.forest.label_table is b.forest.label_table
+    assert a.forest.label_ids == b.forest.label_ids[::-1]
+    # A FlatTree of its own table is translated into the store's.
+    c = store.get(FlatTree.from_tree(tree_from_dict({"z": {"x": {}}})))
+    assert c.label_ids[1] == a.label_ids[0]
+
+
+def test_store_evicts_least_recently_used():
+    store = PreparedTreeStore(max_size=2)
+    trees = [tree_from_dict({label: {}}) for label in "abc"]
+    store.get(trees[0])
+    store.get(trees[1])
+    store.get(trees[0])
+    store.get(trees[2])
+    assert trees[0] in store
+    assert trees[1] not in store
+    assert trees[2] in store
+    assert len(store) == 2
+
+
+def test_min_hashes_do_not_depend_on_interning_order():
+    # Labels get ids in the order they are first seen, so preparing another tree
+    # first numbers the tree's labels differently.
+    tree = {"a": {"b": {"c": {}}, "c": {}}}
+    other = {"c": {"b": {}, "a": {}}}
+    code = (
+        "import sys; from min_hash import MinHasher; from pairwise import MinHashMetric;"
+        "from prepared import PreparedTree; from tree import tree_from_dict;"
+        "trees = [tree_from_dict(tree) for tree in eval(sys.argv[1])];"
+        "metric = MinHashMetric(num_hashes=16); bag = MinHashMetric(num_hashes=16, bag=True);"
+        "prepared = [PreparedTree(tree).min_hash(MinHasher(16)) for tree in trees];"
+        "signatures = [(metric.prepare(tree), bag.prepare(tree)) for tree in trees];"
+        "print(prepared[-1].signature.tolist(), [s.tolist() for s in signatures[-1]])"
+    )
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", code, repr(trees)],
+            env={"PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for trees in ([tree], [other, tree])
+    }
+    assert len(outputs) == 1
@@ -3,6 +3,8 @@ from collections.abc import Callable, Sequence
 from dataclasses import dataclass, field
 from typing import Generator, Self, TypeAlias, TypeVar
 
+from tree import FlatTree
+
 __all__ = ["pretty_format"]
 
 Node = TypeVar("Node")
@@ -35,7 +37,12 @@ def pretty_format(
       │  └l └w
       └c─┬g
          └h
+
+    A FlatTree is formatted via its root FlatNode, which has the default attributes.
     """
+    if isinstance(tree, FlatTree):
+        tree = tree.root
+
     pretty_tree = _wrap_tree(tree, get_label, get_children)
 
     y_to_nodes: defaultdict[int, list[PrintNode]] = defaultdict(list)
@@ -139,27 +146,40 @@ class PrintNode:
 
 
 def _preorder_traversal(node: PrintNode) -> Generator[PrintNode, None, None]:
-    yield node
-    for child in node.children:
-        yield from _preorder_traversal(child)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
 
 
-def _wrap_tree(
-    node: Node, get_label: GetLabel[Node], get_children: GetChildren[Node], depth: int = 0
-) -> PrintNode:
+def _wrap_tree(node: Node, get_label: GetLabel[Node], get_children: GetChildren[Node]) -> PrintNode:
     """Wrap the tree nodes with PrintNode objects and calculate their positions"""
-    children = get_children(node)
-    children = tuple(_wrap_tree(child, get_label, get_children, depth + 1) for child in children)
-    pnode = PrintNode(get_label(node), children, depth=depth)
+    # Children must be wrapped and adjusted before their parent, so wrap in
+    # post-order. Each entry is a node, an iterator over its children still to
+    # wrap, and the wrapped children so far.
+    stack = [(node, iter(get_children(node)), [])]
+    while True:
+        node, children, wrapped_children = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            stack.append((child, iter(get_children(child)), []))
+            continue
 
-    for child in children:
-        child.parent = pnode
+        stack.pop()
+        pnode = PrintNode(get_label(node), tuple(wrapped_children), depth=len(stack))
 
-    _adjust_children_delta_y(pnode)
+        for child in pnode.children:
+            child.parent = pnode
 
-    if depth == 0:
-        # At the root, fill in the y positions by propagating the delta_y values.
-        _fill_y_positions(pnode, y=0)
+        _adjust_children_delta_y(pnode)
+
+        if not stack:
+            break
+        stack[-1][2].append(pnode)
+
+    # At the root, fill in the y positions by propagating the delta_y values.
+    _fill_y_positions(pnode, y=0)
 
     return pnode
 
@@ -212,10 +232,11 @@ def _adjust_children_delta_y(node: PrintNode, gap_size: int = 0):
 
 
 def _fill_y_positions(node: PrintNode, y: int = 0):
-    """Recursively fill in the y positions of each node from the relative delta_y values"""
+    """Fill in the y positions of each node from the relative delta_y values"""
     node.y = y
-    for child in node.children:
-        _fill_y_positions(child, y=node.y + child.delta_y)
+    for descendent in _preorder_traversal(node):
+        for child in descendent.children:
+            child.y = descendent.y + child.delta_y
 
 
 class BoxChar:
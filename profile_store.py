@@ -0,0 +1,229 @@
+"""An on-disk store of pq-gram profiles and MinHash signatures, opened with np.memmap.
+
+Profiling a large corpus takes a while, so this writes each tree's PQGramProfile
+and MinHash signature once, and any later process maps them straight from the
+files. Processes opening the same store share the pages, and a store pickles as
+just its path, so worker processes reopen it rather than copying it.
+
+A store is a directory of:
+ - header.json: the format version, and the p, q, num_hashes, seed and hash.
+ - labels.jsonl: the label table, one JSON string per line, in id order.
+ - offsets.u64: for tree i, its fingerprints are grams[offsets[i]:offsets[i + 1]].
+ - grams.u64: every tree's sorted fingerprints, end to end.
+ - signatures.u32: the num_hashes signature of each tree, row by row.
+
+Every file but the header is only appended to, and offsets last of all, so the
+trees in the store are those in offsets, even if an append was interrupted.
+"""
+
+import json
+import os
+from collections.abc import Iterable
+
+import numpy as np
+
+from min_hash import MinHash, MinHasher, stable_hash
+from pq_grams import PQGramIndex, PQGramProfile
+from tree import FlatTree, LabelTable, TreeNode
+
+__all__ = ["ProfileStore"]
+
+FORMAT = "pq-gram-profile-store"
+#: Version 2 stores signatures as uint32, in signatures.u32, rather than uint64.
+#: Version 3 signs the labeled pq-grams, rather than the fingerprints.
+VERSION = 3
+
+_DTYPE = np.dtype("<u8")
+_SIGNATURE_DTYPE = np.dtype("<u4")
+
+
+class ProfileStore:
+    """The pq-gram profiles, and optionally MinHash signatures, of a corpus of trees.
+
+    Signatures are MinHasher(num_hashes, seed=seed) of the set of each tree's
+    labeled pq-grams, hashed with stable_hash, so they are the same in every
+    process, and match those of PreparedTree.min_hash and MinHashMetric. Sign a
+    query tree with sign. num_hashes=0 stores no signatures.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        """Open an existing store. See create and open."""
+        self.path = os.fspath(path)
+        with open(self._file("header.json")) as file:
+            header = json.load(file)
+        if header.get("format") != FORMAT or header.get("version") != VERSION:
+            raise ValueError(
+                f"{self.path} is not a version {VERSION} {FORMAT}, so needs to be created again"
+            )
+
+        self.p: int = header["p"]
+        self.q: int = header["q"]
+        self.num_hashes: int = header["num_hashes"]
+        self.seed: int = header["seed"]
+        # Stores without a hash were written before stable_hash, with the builtin hash,
+        # whose signatures are only valid in the process that wrote them.
+        if "hash" not in header:
+            raise ValueError(f"{self.path} has signatures of the builtin hash, so can't be read")
+        if header["hash"] != "stable_hash":
+            raise ValueError(f"{self.path} has signatures of an unsupported hash function")
+        self.hasher = None
+        if self.num_hashes:
+            self.hasher = MinHasher(self.num_hashes, stable_hash, self.seed)
+
+        self.label_table = LabelTable()
+        with open(self._file("labels.jsonl")) as file:
+            for line in file:
+                self.label_table.intern(json.loads(line))
+        self._num_stored_labels = len(self.label_table)
+        self._map()
+
+    @classmethod
+    def create(
+        cls, path: str | os.PathLike, p: int = 2, q: int = 3, num_hashes: int = 128, seed: int = 1
+    ) -> "ProfileStore":
+        """Create an empty store in a new directory, path."""
+        path = os.fspath(path)
+        os.makedirs(path)
+        header = {
+            "format": FORMAT,
+            "version": VERSION,
+            "p": p,
+            "q": q,
+            "num_hashes": num_hashes,
+            "seed": seed,
+            "hash": "stable_hash",
+        }
+        with open(os.path.join(path, "header.json"), "w") as file:
+            json.dump(header, file)
+        for name in ("labels.jsonl", "offsets.u64", "grams.u64", "signatures.u32"):
+            open(os.path.join(path, name), "wb").close()
+        return cls(path)
+
+    @classmethod
+    def open(
+        cls,
+        path: str | os.PathLike,
+        *,
+        p: int | None = None,
+        q: int | None = None,
+        num_hashes: int | None = None,
+        seed: int | None = None,
+    ) -> "ProfileStore":
+        """Open an existing store, checking that it has each of the given parameters."""
+        store = cls(path)
+        expected = {"p": p, "q": q, "num_hashes": num_hashes, "seed": seed}
+        for name, value in expected.items():
+            if value is not None and getattr(store, name) != value:
+                raise ValueError(
+                    f"{store.path} has {name}={getattr(store, name)}, but {value} was expected"
+                )
+        return store
+
+    def __reduce__(self):
+        return (type(self), (self.path,))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def append(self, trees: Iterable[TreeNode | FlatTree]) -> range:
+        """Profile the trees and add them to the end of the store. Returns their indexes."""
+        start = len(self)
+        # Drop anything written by an append that was interrupted before its offsets.
+        os.truncate(self._file("grams.u64"), int(self.offsets[-1]) * _DTYPE.itemsize)
+        os.truncate(
+            self._file("signatures.u32"), start * self.num_hashes * _SIGNATURE_DTYPE.itemsize
+        )
+
+        offsets = [int(self.offsets[-1])]
+        grams = []
+        signed = []
+        for tree in trees:
+            flat = (
+                tree if isinstance(tree, FlatTree) else FlatTree.from_tree(tree, self.label_table)
+            )
+            fingerprints = PQGramProfile(
+                flat, p=self.p, q=self.q, label_table=self.label_table
+            ).fingerprints
+            grams.append(fingerprints)
+            offsets.append(offsets[-1] + len(fingerprints))
+            if self.hasher is not None:
+                signed.append(self._signed_grams(flat, self.label_table))
+
+        with open(self._file("labels.jsonl"), "a") as file:
+            for label in self.label_table.labels[self._num_stored_labels :]:
+                file.write(json.dumps(label) + "\n")
+        self._num_stored_labels = len(self.label_table)
+        if grams:
+            self._write("grams.u64", np.concatenate(grams).astype(_DTYPE))
+        if signed:
+            signatures = self.hasher.signatures(signed)
+            self._write("signatures.u32", signatures.astype(_SIGNATURE_DTYPE))
+        self._write("offsets.u64", np.array(offsets[1:], dtype=_DTYPE))
+        self._map()
+        return range(start, len(self))
+
+    def fingerprints(self, index: int) -> np.ndarray:
+        """The sorted pq-gram fingerprints of the tree at index, as a view of the file."""
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.grams[int(self.offsets[index]) : int(self.offsets[index + 1])]
+
+    def profile(self, index: int) -> PQGramProfile:
+        """The PQGramProfile of the tree at index. Profiles of one store can be compared."""
+        return PQGramProfile.from_fingerprints(
+            self.fingerprints(index), self.p, self.q, self.label_table
+        )
+
+    def min_hash(self, index: int) -> MinHash:
+        """The MinHash of the tree at index."""
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return MinHash(self.signatures[index], self.seed, "stable_hash")
+
+    def sign(self, tree: TreeNode | FlatTree) -> MinHash:
+        """The MinHash of a tree, as stored by append, to compare with those in the store."""
+        if self.hasher is None:
+            raise ValueError(f"{self.path} has no signatures, as num_hashes is 0")
+        # A table of its own, so that signing doesn't add the tree's labels to the store.
+        return self.hasher(self._signed_grams(tree, LabelTable()))
+
+    def _signed_grams(
+        self, tree: TreeNode | FlatTree, label_table: LabelTable
+    ) -> set[tuple[str, ...]]:
+        """The pq-grams signed for the tree: with labels, as label ids depend on the store."""
+        index = PQGramIndex(tree, p=self.p, q=self.q, label_table=label_table)
+        return set(index.labeled_pq_grams())
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _write(self, name: str, values: np.ndarray):
+        with open(self._file(name), "ab") as file:
+            file.write(values.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _map(self):
+        """Map the files, read-only, up to the trees listed in offsets."""
+        offsets = self._read("offsets.u64")
+        #: offsets[i] is the start of tree i's fingerprints in grams, after the initial 0.
+        self.offsets: np.ndarray = np.concatenate([np.zeros(1, dtype=_DTYPE), offsets])
+        num_trees = len(offsets)
+        #: The fingerprints of every tree, end to end.
+        self.grams: np.ndarray = self._read("grams.u64", int(self.offsets[-1]))
+        #: The signature of each tree, one per row.
+        self.signatures: np.ndarray = self._read(
+            "signatures.u32", num_trees * self.num_hashes, _SIGNATURE_DTYPE
+        ).reshape(num_trees, self.num_hashes)
+
+    def _read(self, name: str, length: int | None = None, dtype: np.dtype = _DTYPE) -> np.ndarray:
+        """Map the first length values of the file, or all of them if None."""
+        available = os.path.getsize(self._file(name)) // dtype.itemsize
+        if length is None:
+            length = available
+        elif available < length:
+            raise ValueError(f"{self._file(name)} is truncated")
+        if length == 0:
+            # mmap can't map an empty range.
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=(length,))
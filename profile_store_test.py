@@ -0,0 +1,115 @@
+import json
+import pickle
+import random
+
+import numpy as np
+import pytest
+
+from min_hash import MinHasher, compare
+from pq_grams import PQGramProfile, pq_grams, profile_distance
+from prepared import PreparedTree
+from profile_store import ProfileStore
+from tree import LabelTable, random_tree
+
+
+def _random_trees(count: int) -> list:
+    return [
+        random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c", "d"))
+        for _ in range(count)
+    ]
+
+
+def test_round_trip(tmp_path):
+    random.seed(21)
+    trees = _random_trees(12)
+    store = ProfileStore.create(tmp_path / "store", p=2, q=3, num_hashes=16, seed=3)
+    assert len(store) == 0
+    assert store.append(trees[:5]) == range(0, 5)
+    assert store.append([]) == range(5, 5)
+
+    # Reopened, it has the same label ids, so appending more matches in memory profiles.
+    store = ProfileStore.open(tmp_path / "store", p=2, q=3, num_hashes=16, seed=3)
+    assert store.append(trees[5:]) == range(5, 12)
+    store = pickle.loads(pickle.dumps(ProfileStore(tmp_path / "store")))
+    assert isinstance(store.grams, np.memmap)
+
+    table = LabelTable()
+    hasher = MinHasher(16, seed=3)
+    for index, tree in enumerate(trees):
+        expected = PQGramProfile(tree, p=2, q=3, label_table=table).fingerprints
+        assert store.fingerprints(index).tolist() == expected.tolist()
+        # Stored signatures are those of the same tree signed anywhere else.
+        assert store.min_hash(index) == store.sign(tree)
+        assert store.min_hash(index) == PreparedTree(tree).min_hash(hasher)
+    assert profile_distance(store.profile(0), store.profile(7)) == pq_grams(trees[0], trees[7])
+    assert compare(store.min_hash(0), store.min_hash(0)) == 1.0
+    with pytest.raises(IndexError):
+        store.fingerprints(12)
+
+
+def test_validates_parameters(tmp_path):
+    ProfileStore.create(tmp_path / "store", p=2, q=3, num_hashes=0)
+    with pytest.raises(ValueError):
+        ProfileStore.open(tmp_path / "store", p=3)
+    with pytest.raises(ValueError):
+        ProfileStore.open(tmp_path / "store", num_hashes=128)
+    store = ProfileStore.open(tmp_path / "store", p=2, q=3, num_hashes=0)
+    store.append(_random_trees(2))
+    assert store.signatures.shape == (2, 0)
+    with pytest.raises(ValueError):
+        store.sign(_random_trees(1)[0])
+
+
+def test_interrupted_append(tmp_path):
+    random.seed(22)
+    trees = _random_trees(4)
+    store = ProfileStore.create(tmp_path / "store", num_hashes=4)
+    store.append(trees[:2])
+    # Fingerprints and signatures written without their offsets aren't part of the store.
+    with open(tmp_path / "store" / "grams.u64", "ab") as file:
+        file.write(b"\xff" * 24)
+    with open(tmp_path / "store" / "signatures.u32", "ab") as file:
+        file.write(b"\xff" * 8)
+    store = ProfileStore.open(tmp_path / "store")
+    assert len(store) == 2
+    store.append(trees[2:])
+
+    expected = ProfileStore.create(tmp_path / "expected", num_hashes=4)
+    expected.append(trees)
+    assert store.grams.tolist() == expected.grams.tolist()
+    assert store.signatures.tolist() == expected.signatures.tolist()
+
+
+def test_rejects_unknown_hashes(tmp_path):
+    ProfileStore.create(tmp_path / "store")
+    header_path = tmp_path / "store" / "header.json"
+    header = json.loads(header_path.read_text())
+    header["hash"] = "builtin"
+    header_path.write_text(json.dumps(header))
+    with pytest.raises(ValueError, match="unsupported hash"):
+        ProfileStore.open(tmp_path / "store")
+
+    # Written before stable_hash, with the builtin hash.
+    del header["hash"]
+    header_path.write_text(json.dumps(header))
+    with pytest.raises(ValueError, match="builtin hash"):
+        ProfileStore.open(tmp_path / "store")
+
+
+def test_rejects_old_versions(tmp_path):
+    # Version 1 stored uint64 signatures, in signatures.u64.
+    ProfileStore.create(tmp_path / "store")
+    header_path = tmp_path / "store" / "header.json"
+    header = json.loads(header_path.read_text())
+    header["version"] = 1
+    header_path.write_text(json.dumps(header))
+    (tmp_path / "store" / "signatures.u32").rename(tmp_path / "store" / "signatures.u64")
+    with pytest.raises(ValueError, match="not a version 3"):
+        ProfileStore.open(tmp_path / "store")
+
+    # Version 2 signed the fingerprints, rather than the labeled pq-grams.
+    (tmp_path / "store" / "signatures.u64").rename(tmp_path / "store" / "signatures.u32")
+    header["version"] = 2
+    header_path.write_text(json.dumps(header))
+    with pytest.raises(ValueError, match="not a version 3"):
+        ProfileStore.open(tmp_path / "store")
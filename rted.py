@@ -0,0 +1,637 @@
+"""A path strategy tree edit distance, in the style of RTED.
+
+Zhang + Shasha always decompose both trees along their left-most paths. On
+trees that grow to the right, such as right-associative expressions, that
+makes them O(n²m²). Pawlik + Augsten showed that the choice of path can be
+made per pair of subtrees, from either tree, and that the cheapest choice of
+left, right or heavy (largest child) paths is never worse than O(n³).
+
+RTED: Pawlik + Augsten, "RTED: A Robust Algorithm for the Tree Edit Distance",
+PVLDB 5(4), 2011. https://arxiv.org/abs/1201.0230
+
+The algorithm, for a pair of subtrees, F and G, with a path, γ, chosen in F:
+ 1. Recursively compute the tree distances between every subtree hanging off
+    γ (the children of the path nodes not on the path) and G.
+ 2. Compute the distances between the relevant subforests of F (those obtained
+    by deleting F's roots, only ever from the side away from γ) and the
+    subforests of G. This is the single-path function. Along the way, it
+    produces the tree distance between every subtree rooted on γ and every
+    subtree of G.
+Paths in G work the same way, with the trees' roles swapped.
+
+The single-path functions used here are:
+ - Left paths: the Zhang + Shasha forestdist table for F against each
+   keyroot of G. This only needs the left decomposition of G.
+ - Right paths: the same, on the mirror images of the trees.
+ - Heavy (or any) paths: The general recursion of Demaine et al., over every
+   subforest of G.
+The strategy is picked to minimise the number of subproblems these solve, with
+the general function's counted double, as each of its subproblems takes about
+twice as long. When no strategy saves enough to pay for computing it, and for
+its slower subproblems, the distance is left to zhang_shasha's keyroot engine.
+
+Memory is O(nm) for the strategy and tree distances, and for one forestdist
+table per orientation of the trees, reused by every left and right path. The
+general single-path function also keeps a table of G's subforests for each of
+F's relevant subforests still to be read: usually a few, but as many as the
+nesting depth of the subtrees hanging off the path. These tables are pooled,
+and reused by the next general path, rather than allocated for each. APTED
+(Pawlik + Augsten, 2016) removes them with a more involved single-path function.
+"""
+
+from array import array
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import math
+
+from tree import FlatTree, LabelTable, TreeNode
+from zhang_shasha import CostFunctions, SubForest, forest_distance
+
+__all__ = ["rted", "rted_forest_distance"]
+
+
+def rted(
+    a_tree_root: TreeNode | FlatTree,
+    b_tree_root: TreeNode | FlatTree,
+    cost_funcs: CostFunctions = CostFunctions(),
+) -> float:
+    """Return the tree edit distance between two trees.
+
+    The same distance as zhang_shasha, for the same cost functions.
+    """
+    label_table = LabelTable()
+    a_forest = SubForest.from_tree(a_tree_root, label_table)
+    b_forest = SubForest.from_tree(b_tree_root, label_table)
+    return rted_forest_distance(a_forest, b_forest, cost_funcs)
+
+
+def rted_forest_distance(
+    a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions = CostFunctions()
+) -> float:
+    """Return the tree edit distance between two already preprocessed trees."""
+    a_side = _Side(a_forest)
+    b_side = _Side(b_forest)
+    num_a = len(a_side.sizes)
+    num_b = len(b_side.sizes)
+
+    strategy = _optimal_strategy(a_side, b_side)
+    if strategy is None:
+        return forest_distance(a_forest, b_forest, cost_funcs)
+
+    # Both orientations of the tree distances are kept, so that the single-path
+    # functions can run with the trees swapped without translating indexes.
+    treedist = [array("d", bytes(8 * num_b)) for _ in range(num_a)]
+    treedist_t = [array("d", bytes(8 * num_a)) for _ in range(num_b)]
+
+    def relabel_swapped(b_node, a_node):
+        return cost_funcs.relabel(a_node, b_node)
+
+    pair = _Pair(
+        a_side,
+        b_side,
+        [cost_funcs.delete(node) for node in a_side.nodes],
+        [cost_funcs.insert(node) for node in b_side.nodes],
+        cost_funcs.relabel,
+        treedist,
+        treedist_t,
+    )
+    swapped_pair = _Pair(
+        b_side,
+        a_side,
+        pair.insert_costs,
+        pair.delete_costs,
+        relabel_swapped,
+        treedist_t,
+        treedist,
+        free_rows=pair.free_rows,
+    )
+
+    # Each entry is a pair of subtrees, and whether the subtrees hanging off its
+    # path are done. An explicit stack avoids Python's recursion limit.
+    stack = [(num_a - 1, num_b - 1, False)]
+    while stack:
+        v, w, hanging_done = stack.pop()
+        path_in_b, path_kind = divmod(strategy[v][w], 3)
+        if path_in_b:
+            path = b_side.path(w, path_kind)
+        else:
+            path = a_side.path(v, path_kind)
+
+        if hanging_done:
+            if path_in_b:
+                _single_path(swapped_pair, path, path_kind, v)
+            else:
+                _single_path(pair, path, path_kind, w)
+            continue
+
+        stack.append((v, w, True))
+        if path_in_b:
+            stack.extend((v, y, False) for y in b_side.hanging(path))
+        else:
+            stack.extend((x, w, False) for x in a_side.hanging(path))
+
+    return treedist[num_a - 1][num_b - 1]
+
+
+#: The kinds of path, as used in the strategy.
+_LEFT = 0
+_RIGHT = 1
+_HEAVY = 2
+
+# The time of each step, in subproblems of zhang_shasha's keyroot engine, as
+# measured on random trees of a few hundred nodes: a subproblem of the left and
+# right single-path functions here, one of the general function relative to
+# those, and computing the strategy, per pair of subtrees.
+_SINGLE_PATH_WEIGHT = 1.25
+_GENERAL_PATH_WEIGHT = 2
+_STRATEGY_WEIGHT = 3
+
+
+class _Side:
+    """The structure of one of the trees, indexed by post-order index."""
+
+    def __init__(self, forest: SubForest):
+        self.nodes = forest.post_ordered_nodes
+        lefts = forest.subtree_start_index
+        num_nodes = len(lefts)
+
+        self.sizes = [index + 1 - left for index, left in enumerate(lefts)]
+        self.children: list[list[int]] = []
+        for index, left in enumerate(lefts):
+            # The last child ends just before its parent, and each child starts
+            # just after its left sibling ends.
+            children = []
+            child = index - 1
+            while child >= left:
+                children.append(child)
+                child = lefts[child] - 1
+            children.reverse()
+            self.children.append(children)
+
+        self.heavy_child = [
+            max(children, key=self.sizes.__getitem__) if children else -1
+            for children in self.children
+        ]
+
+        # Pre-order indexes: a parent is visited just before its children, and
+        # each child's subtree right after its left sibling's.
+        self.pre_of_post = [0] * num_nodes
+        for index in range(num_nodes - 1, -1, -1):
+            next_pre = self.pre_of_post[index] + 1
+            for child in self.children[index]:
+                self.pre_of_post[child] = next_pre
+                next_pre += self.sizes[child]
+        self.post_of_pre = [0] * num_nodes
+        for index, pre in enumerate(self.pre_of_post):
+            self.post_of_pre[pre] = index
+
+        self.left_order = _Order(list(range(num_nodes)), list(range(num_nodes)), list(lefts))
+        # The post-order of the mirror image is the reverse of the pre-order.
+        mirrored_nodes = self.post_of_pre[::-1]
+        mirrored_index = [num_nodes - 1 - pre for pre in self.pre_of_post]
+        self.right_order = _Order(
+            mirrored_nodes,
+            mirrored_index,
+            [mirrored_index[node] - self.sizes[node] + 1 for node in mirrored_nodes],
+        )
+
+    def path(self, root: int, kind: int) -> list[int]:
+        """Return the path of the kind from root down to a leaf."""
+        path = [root]
+        while self.children[path[-1]]:
+            children = self.children[path[-1]]
+            if kind == _LEFT:
+                path.append(children[0])
+            elif kind == _RIGHT:
+                path.append(children[-1])
+            else:
+                path.append(self.heavy_child[path[-1]])
+        return path
+
+    def hanging(self, path: list[int]) -> list[int]:
+        """Return the roots of the subtrees hanging off the path."""
+        return [
+            child
+            for node, next_node in zip(path, path[1:])
+            for child in self.children[node]
+            if child != next_node
+        ]
+
+
+@dataclass
+class _Order:
+    """A post-order of a tree: left to right, or of its mirror image."""
+
+    #: The post-order index of the node at each index of this order.
+    nodes: list[int]
+
+    #: The index in this order of each node, by post-order index.
+    index_of: list[int]
+
+    #: For each index of this order, the index of the left-most leaf of its subtree.
+    lefts: list[int]
+
+    def keyroots(self, root: int) -> list[int]:
+        """Return the keyroots of the subtree at root (an index of this order), ascending."""
+        highest_by_leaf: dict[int, int] = {}
+        lefts = self.lefts
+        for index in range(lefts[root], root + 1):
+            highest_by_leaf[lefts[index]] = index
+        return sorted(highest_by_leaf.values())
+
+
+@dataclass
+class _Pair:
+    """The two trees, costs and tables for computing the single-path functions.
+
+    The trees may be swapped, in which case so are the delete and insert costs,
+    the relabel arguments and the orientation of the tree distances.
+    """
+
+    a: _Side
+    b: _Side
+    delete_costs: list[float]
+    insert_costs: list[float]
+    relabel: Callable
+    treedist: list[array]
+    treedist_t: list[array]
+
+    #: The forestdist table of the left and right paths, grown to the largest a[v].
+    forestdist: list[array] = field(default_factory=list)
+
+    #: The general path's tables no longer in use, to be reused by the next.
+    #: Shared with the swapped pair.
+    free_rows: list[array] = field(default_factory=list)
+
+
+def _optimal_strategy(a_side: _Side, b_side: _Side) -> list[bytearray] | None:
+    """Return, for every pair of subtrees, the path that minimises the subproblems.
+
+    strategy[v][w] is 3 * (path in b) + path kind. The number of subproblems for
+    a path in F = a[v] against G = b[w] is |F| times the subforests of G that
+    its single-path function visits, plus the subproblems of the pairs of
+    subtrees hanging off the path and G (Pawlik + Augsten, Section 5).
+
+    Computing the sums of the hanging subtrees incrementally, from the path's
+    next node, makes this O(|a||b|) time and memory.
+
+    Returns None if the strategy, along with finding it, would take longer than
+    Zhang + Shasha's left paths throughout, in the keyroot engine. If even the
+    fewest subproblems possible, |a||b|, would, the strategy isn't computed.
+    """
+    num_a = len(a_side.sizes)
+    num_b = len(b_side.sizes)
+    a_counts = _subforest_counts(a_side)
+    b_counts = _subforest_counts(b_side)
+    keyroot_cost = a_counts[_LEFT][-1] * b_counts[_LEFT][-1]
+    if keyroot_cost <= (_SINGLE_PATH_WEIGHT + _STRATEGY_WEIGHT) * num_a * num_b:
+        return None
+    for counts in (a_counts, b_counts):
+        counts[_HEAVY] = [_GENERAL_PATH_WEIGHT * count for count in counts[_HEAVY]]
+
+    costs = [array("d", bytes(8 * num_b)) for _ in range(num_a)]
+    # The hanging sums of a's paths, for each kind of path, for every pair.
+    a_hanging = [[array("d", bytes(8 * num_b)) for _ in range(num_a)] for _ in range(3)]
+    strategy = [bytearray(num_b) for _ in range(num_a)]
+
+    b_path_children = [_path_children(b_side, kind) for kind in range(3)]
+    a_path_children = [_path_children(a_side, kind) for kind in range(3)]
+
+    for v in range(num_a):
+        a_size = a_side.sizes[v]
+        a_children = a_side.children[v]
+        costs_v = costs[v]
+        strategy_v = strategy[v]
+
+        # The sum over a's children of their costs against each of b's subtrees.
+        children_costs = array("d", bytes(8 * num_b))
+        for child in a_children:
+            child_costs = costs[child]
+            for w in range(num_b):
+                children_costs[w] += child_costs[w]
+        for kind in range(3):
+            path_child = a_path_children[kind][v]
+            if path_child == -1:
+                continue
+            hanging = a_hanging[kind][v]
+            path_hanging = a_hanging[kind][path_child]
+            path_costs = costs[path_child]
+            for w in range(num_b):
+                hanging[w] = path_hanging[w] + children_costs[w] - path_costs[w]
+
+        # The same, along b's paths, for this v.
+        b_hanging = [array("d", bytes(8 * num_b)) for _ in range(3)]
+        a_hanging_v = [a_hanging[kind][v] for kind in range(3)]
+        for w in range(num_b):
+            b_size = b_side.sizes[w]
+            children_cost = 0.0
+            for child in b_side.children[w]:
+                children_cost += costs_v[child]
+            for kind in range(3):
+                path_child = b_path_children[kind][w]
+                if path_child != -1:
+                    b_hanging[kind][w] = (
+                        b_hanging[kind][path_child] + children_cost - costs_v[path_child]
+                    )
+
+            best = math.inf
+            best_choice = 0
+            for kind in range(3):
+                cost = a_size * b_counts[kind][w] + a_hanging_v[kind][w]
+                if cost < best:
+                    best = cost
+                    best_choice = kind
+            for kind in range(3):
+                cost = b_size * a_counts[kind][v] + b_hanging[kind][w]
+                if cost < best:
+                    best = cost
+                    best_choice = 3 + kind
+            costs_v[w] = best
+            strategy_v[w] = best_choice
+
+    if _SINGLE_PATH_WEIGHT * costs[-1][-1] + _STRATEGY_WEIGHT * num_a * num_b >= keyroot_cost:
+        return None
+    return strategy
+
+
+def _path_children(side: _Side, kind: int) -> list[int]:
+    """Return the next node on the path of the kind for each node, or -1 for leaves."""
+    if kind == _LEFT:
+        return [children[0] if children else -1 for children in side.children]
+    if kind == _RIGHT:
+        return [children[-1] if children else -1 for children in side.children]
+    return side.heavy_child
+
+
+def _subforest_counts(side: _Side) -> list[list[int]]:
+    """Return how many of each subtree's subforests each kind of single-path function visits.
+
+    For left (right) paths, this is the summed sizes of the subtree's left
+    (right) keyroots. For heavy paths, every subforest is visited.
+    """
+    num_nodes = len(side.sizes)
+    sizes = side.sizes
+    # Summed sizes of the keyroots within each subtree, not counting its root.
+    left_inner = [0] * num_nodes
+    right_inner = [0] * num_nodes
+    for index in range(num_nodes):
+        children = side.children[index]
+        if not children:
+            continue
+        # Every child but the first (last) is a left (right) keyroot.
+        left_inner[index] = left_inner[children[0]] + sum(
+            sizes[child] + left_inner[child] for child in children[1:]
+        )
+        right_inner[index] = right_inner[children[-1]] + sum(
+            sizes[child] + right_inner[child] for child in children[:-1]
+        )
+
+    return [
+        [size + inner for size, inner in zip(sizes, left_inner)],
+        [size + inner for size, inner in zip(sizes, right_inner)],
+        [size * (size + 3) // 2 for size in sizes],
+    ]
+
+
+def _single_path(pair: _Pair, path: list[int], kind: int, w: int):
+    """Fill the tree distances between the subtrees rooted on path and those of b[w].
+
+    Requires:
+    - The tree distances between the subtrees hanging off the path and b[w].
+    """
+    if kind == _LEFT:
+        _keyroot_path(pair, pair.a.left_order, pair.b.left_order, path[0], w)
+    elif kind == _RIGHT:
+        _keyroot_path(pair, pair.a.right_order, pair.b.right_order, path[0], w)
+    else:
+        _general_path(pair, path, w)
+
+
+def _keyroot_path(pair: _Pair, a_order: _Order, b_order: _Order, v: int, w: int):
+    """The single-path function for the left-most path of a[v], in the given orders.
+
+    It's the Zhang + Shasha dynamic program, for a[v] against each keyroot of b[w].
+    See zhang_shasha._KeyrootTables for the tables. a's rows only run over a[v]
+    itself, so the tree distances are only filled along its left-most path.
+    """
+    a_nodes = pair.a.nodes
+    b_nodes = pair.b.nodes
+    a_order_nodes = a_order.nodes
+    b_order_nodes = b_order.nodes
+    a_lefts = a_order.lefts
+    b_lefts = b_order.lefts
+    delete_costs = pair.delete_costs
+    insert_costs = pair.insert_costs
+    relabel = pair.relabel
+    treedist = pair.treedist
+    treedist_t = pair.treedist_t
+
+    # Translate from post-order indexes to indexes in these orders.
+    i = a_order.index_of[v]
+    j = b_order.index_of[w]
+    a_left = a_lefts[i]
+    a_size = i + 1 - a_left
+    # Every cell read is first written for the keyroot, so the table is reused as is.
+    forestdist = pair.forestdist
+    while len(forestdist) <= a_size:
+        forestdist.append(array("d", bytes(8 * (len(pair.b.sizes) + 1))))
+
+    for keyroot in b_order.keyroots(j):
+        b_left = b_lefts[keyroot]
+        first_row = forestdist[0]
+        first_row[0] = 0.0
+        for y, j1 in enumerate(range(b_left, keyroot + 1), start=1):
+            first_row[y] = first_row[y - 1] + insert_costs[b_order_nodes[j1]]
+
+        for x, i1 in enumerate(range(a_left, i + 1), start=1):
+            prev_row = forestdist[x - 1]
+            row = forestdist[x]
+            a_node = a_order_nodes[i1]
+            cost_delete = delete_costs[a_node]
+            row[0] = prev_row[0] + cost_delete
+            i1_left = a_lefts[i1]
+            treedist_i1 = treedist[a_node]
+
+            for y, j1 in enumerate(range(b_left, keyroot + 1), start=1):
+                b_node = b_order_nodes[j1]
+                dist_delete = prev_row[y] + cost_delete
+                dist_insert = row[y - 1] + insert_costs[b_node]
+
+                j1_left = b_lefts[j1]
+                if i1_left == a_left and j1_left == b_left:
+                    dist_relabel = prev_row[y - 1] + relabel(a_nodes[a_node], b_nodes[b_node])
+                    dist = min(dist_delete, dist_insert, dist_relabel)
+                    treedist_i1[b_node] = dist
+                    treedist_t[b_node][a_node] = dist
+                else:
+                    dist_relabel = (
+                        forestdist[i1_left - a_left][j1_left - b_left] + treedist_i1[b_node]
+                    )
+                    dist = min(dist_delete, dist_insert, dist_relabel)
+                row[y] = dist
+
+
+def _general_path(pair: _Pair, path: list[int], w: int):
+    """The single-path function for any path in a, against every subforest of b[w].
+
+    Demaine et al., "An Optimal Decomposition Algorithm for Tree Edit Distance".
+    For forests F and G, with v and w both the left-most (or both the right-most)
+    roots:
+        d(F, G) = min(d(F - v, G) + delete(v),
+                      d(F, G - w) + insert(w),
+                      d(a[v], b[w]) + d(F - a[v], G - b[w]))
+    where, if F and G are the trees a[v] and b[w] themselves, the last option is
+    instead d(F - v, G - w) + relabel(v, w).
+
+    F's relevant subforests are visited from the empty forest up to the tree at
+    path[0]: each is one node bigger than the last. The nodes left of the path
+    are deleted from the left, and those right of it from the right, so that
+    F - a[v] is always an earlier relevant subforest.
+
+    G's subforests are the forests left after deleting any roots from either
+    side. Each is identified by (p, q): the nodes whose pre-order index is at
+    least p, and post-order index at most q (both relative to b[w]).
+    """
+    a = pair.a
+    b = pair.b
+    a_nodes = a.nodes
+    b_nodes = b.nodes
+    delete_costs = pair.delete_costs
+    insert_costs = pair.insert_costs
+    relabel = pair.relabel
+    treedist = pair.treedist
+    treedist_t = pair.treedist_t
+
+    # F's deletions, from the whole tree down to the empty forest. Each is a
+    # node and whether it is the left-most root (rather than the right-most).
+    deletions: list[tuple[int, bool]] = []
+    for node, next_node in zip(path, path[1:] + [-1]):
+        deletions.append((node, True))
+        children = a.children[node]
+        if next_node == -1:
+            break
+        split = children.index(next_node)
+        # Left-most roots are deleted in pre-order, and right-most roots in
+        # reverse post-order.
+        for child in children[:split]:
+            start = a.pre_of_post[child]
+            for pre in range(start, start + a.sizes[child]):
+                deletions.append((a.post_of_pre[pre], True))
+        for child in reversed(children[split + 1 :]):
+            for post in range(child, child - a.sizes[child], -1):
+                deletions.append((post, False))
+    path_nodes = set(path)
+    num_steps = len(deletions)
+
+    # G's subforests. Local pre-order (p) and post-order (q) indexes within b[w].
+    b_size = b.sizes[w]
+    b_first_pre = b.pre_of_post[w]
+    b_first_post = w + 1 - b_size
+    b_post_of_pre = [b.post_of_pre[b_first_pre + p] - b_first_post for p in range(b_size)]
+    b_sizes = [b.sizes[b_first_post + q] for q in range(b_size)]
+    b_pre_of_post = [0] * b_size
+    for p, q in enumerate(b_post_of_pre):
+        b_pre_of_post[q] = p
+
+    # Tables are flat, indexed by p * width + q + 1, with q = -1 for empty forests.
+    width = b_size + 1
+    num_cells = width * width
+    # The local pre-order index of the left-most root of each subforest, and
+    # local post-order index of its right-most root. -1 for the empty forest.
+    left_root = array("i", [-1]) * num_cells
+    right_root = array("i", [-1]) * num_cells
+    for p in range(b_size - 1, -1, -1):
+        for q in range(b_size):
+            index = p * width + q + 1
+            if b_post_of_pre[p] <= q:
+                left_root[index] = p
+            else:
+                left_root[index] = left_root[index + width]
+            if b_pre_of_post[q] >= p:
+                right_root[index] = q
+            else:
+                right_root[index] = right_root[index - 1]
+
+    # Every cell of a row is written before it's read, so rows are reused as is.
+    free_rows = pair.free_rows
+
+    def new_row() -> array:
+        for index in range(len(free_rows) - 1, -1, -1):
+            if len(free_rows[index]) >= num_cells:
+                return free_rows.pop(index)
+        return array("d", bytes(8 * num_cells))
+
+    # The empty forest of a against G: only inserts.
+    rows: dict[int, array] = {}
+    empty_row = array("d", bytes(8 * num_cells))
+    for p in range(b_size - 1, -1, -1):
+        for q in range(b_size):
+            index = p * width + q + 1
+            root = left_root[index]
+            if root != -1:
+                empty_row[index] = (
+                    empty_row[(root + 1) * width + q + 1]
+                    + insert_costs[b_first_post + b_post_of_pre[root]]
+                )
+    rows[num_steps] = empty_row
+
+    # Drop each row once the last row that reads it is done.
+    last_reader = {step: step - 1 for step in range(1, num_steps + 1)}
+    for step, (node, _) in enumerate(deletions):
+        after_subtree = step + a.sizes[node]
+        last_reader[after_subtree] = min(last_reader[after_subtree], step)
+
+    deleted_cost = 0.0
+    for step in range(num_steps - 1, -1, -1):
+        node, from_left = deletions[step]
+        cost_delete = delete_costs[node]
+        deleted_cost += cost_delete
+        prev_row = rows[step + 1]
+        after_row = rows[step + a.sizes[node]]
+        is_tree = node in path_nodes
+        treedist_node = treedist[node]
+        a_node = a_nodes[node]
+
+        row = new_row()
+        # Every subforest with p == b_size is empty: only deletes.
+        for q in range(-1, b_size):
+            row[b_size * width + q + 1] = deleted_cost
+        for p in range(b_size - 1, -1, -1):
+            row[p * width] = deleted_cost
+            for q in range(b_size):
+                index = p * width + q + 1
+                if from_left:
+                    root_pre = left_root[index]
+                    if root_pre == -1:
+                        row[index] = deleted_cost
+                        continue
+                    root_post = b_post_of_pre[root_pre]
+                    is_b_tree = root_post == q
+                    without_root = (root_pre + 1) * width + q + 1
+                    without_tree = (root_pre + b_sizes[root_post]) * width + q + 1
+                else:
+                    root_post = right_root[index]
+                    if root_post == -1:
+                        row[index] = deleted_cost
+                        continue
+                    root_pre = b_pre_of_post[root_post]
+                    is_b_tree = left_root[index] == root_pre
+                    without_root = p * width + root_post
+                    without_tree = p * width + root_post - b_sizes[root_post] + 1
+
+                b_index = b_first_post + root_post
+                dist = min(
+                    prev_row[index] + cost_delete, row[without_root] + insert_costs[b_index]
+                )
+                if is_tree and is_b_tree:
+                    dist = min(dist, prev_row[without_root] + relabel(a_node, b_nodes[b_index]))
+                    treedist_node[b_index] = dist
+                    treedist_t[b_index][node] = dist
+                else:
+                    dist = min(dist, treedist_node[b_index] + after_row[without_tree])
+                row[index] = dist
+
+        rows[step] = row
+        for finished in [key for key in rows if last_reader.get(key) == step]:
+            free_rows.append(rows.pop(finished))
+    free_rows.extend(rows.values())
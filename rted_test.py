@@ -0,0 +1,87 @@
+import random
+
+import rted as rted_module
+from rted import rted
+from tree import FlatTree, TreeNode, random_tree, tree_from_dict
+from zhang_shasha import CostFunctions, SubForest, zhang_shasha
+
+
+def right_comb(size: int, label: str) -> TreeNode:
+    tree = TreeNode(label, ())
+    for index in range(size):
+        tree = TreeNode("+", (TreeNode(f"{label}{index % 3}", ()), tree))
+    return tree
+
+
+def test_medium_mixed():
+    a_tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}}}})
+    b_tree = tree_from_dict({"a": {"b": {"d": {}, "f": {}}, "z": {"g": {}, "h": {}}}})
+    assert rted(a_tree, b_tree) == zhang_shasha(a_tree, b_tree) == 3
+
+
+def test_matches_zhang_shasha_random():
+    cost_funcs = CostFunctions(
+        delete=lambda node: len(node.children) + 1,
+        insert=lambda node: 2,
+        relabel=lambda a, b: 3 * (a.label != b.label),
+    )
+    random.seed(13)
+    for costs in (CostFunctions(), cost_funcs):
+        for _ in range(50):
+            a_tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+            b_tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+            assert rted(a_tree, b_tree, costs) == zhang_shasha(a_tree, b_tree, costs)
+
+
+def test_every_path_kind(monkeypatch):
+    # Asymmetric relabels catch the trees' roles being mixed up when swapped.
+    cost_funcs = CostFunctions(relabel=lambda a, b: 2 * (a.label != b.label) + (a.label < b.label))
+    random.seed(14)
+    pairs = [
+        (
+            random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c")),
+            random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c")),
+        )
+        for _ in range(20)
+    ]
+    for choice in range(6):
+        monkeypatch.setattr(
+            rted_module,
+            "_optimal_strategy",
+            lambda a_side, b_side: [bytearray([choice]) * len(b_side.sizes) for _ in a_side.sizes],
+        )
+        for a_tree, b_tree in pairs:
+            assert rted(a_tree, b_tree, cost_funcs) == zhang_shasha(a_tree, b_tree, cost_funcs)
+
+
+def test_right_heavy():
+    a_tree = right_comb(25, "x")
+    b_tree = right_comb(20, "y")
+    expected = zhang_shasha(a_tree, b_tree)
+    assert rted(a_tree, b_tree) == expected
+    assert rted(FlatTree.from_tree(a_tree), FlatTree.from_tree(b_tree)) == expected
+
+
+def test_deep_chain():
+    # Deep enough to exceed Python's recursion limit if anything recursed.
+    depth = 2000
+    a_tree = TreeNode("a", ())
+    for _ in range(depth):
+        a_tree = TreeNode("a", (a_tree,))
+    b_tree = TreeNode("b", (TreeNode("a", ()),))
+    assert rted(a_tree, b_tree) == depth
+
+
+def test_strategy_only_when_it_pays():
+    # Bushy trees are cheapest for Zhang + Shasha's keyroot engine, combs aren't.
+    random.seed(15)
+    a_tree = random_tree(max_depth=5, fanouts=(2, 3), labels=("a", "b"))
+    b_tree = random_tree(max_depth=5, fanouts=(2, 3), labels=("a", "b"))
+    a_side = rted_module._Side(SubForest.from_tree(a_tree))
+    b_side = rted_module._Side(SubForest.from_tree(b_tree))
+    assert rted_module._optimal_strategy(a_side, b_side) is None
+    assert rted(a_tree, b_tree) == zhang_shasha(a_tree, b_tree)
+
+    a_side = rted_module._Side(SubForest.from_tree(right_comb(25, "x")))
+    b_side = rted_module._Side(SubForest.from_tree(right_comb(20, "y")))
+    assert rted_module._optimal_strategy(a_side, b_side) is not None
@@ -1,7 +1,13 @@
-from collections import defaultdict
+import codecs
+from collections import defaultdict, deque
 from dataclasses import dataclass, field
+import json
+import os
 import random
-from typing import Generator
+import re
+from collections.abc import Iterable, Iterator, Sequence
+from typing import IO, Generator
+from xml.etree import ElementTree
 import numpy as np
 
 
@@ -17,9 +23,111 @@ class TreeNode:
 
 
 def preorder_traversal(tree: TreeNode) -> Generator[TreeNode, None, None]:
-    yield tree
-    for child in tree.children:
-        yield from preorder_traversal(child)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        # Reversed so that the left-most child is popped (visited) first.
+        stack.extend(reversed(node.children))
+
+
+def postorder_traversal(tree: TreeNode) -> Generator[TreeNode, None, None]:
+    # Each entry is a node and an iterator over its children still to visit.
+    stack = [(tree, iter(tree.children))]
+    while stack:
+        node, children = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            stack.append((child, iter(child.children)))
+            continue
+
+        stack.pop()
+        yield node
+
+
+def levelorder_traversal(tree: TreeNode) -> Generator[TreeNode, None, None]:
+    """Yield the nodes breadth-first: each level left to right, from the root down."""
+    queue = deque([tree])
+    while queue:
+        node = queue.popleft()
+        yield node
+        queue.extend(node.children)
+
+
+#: The child indexes from the root down to a node. The root's path is ().
+NodePath = tuple[int, ...]
+
+
+def preorder_paths(tree: TreeNode) -> Generator[tuple[NodePath, TreeNode], None, None]:
+    """Yield the path to each node along with it, in pre-order.
+
+    Every path is a tuple of its own, so this takes O(nodes x depth). To find a
+    single node's path, use preorder_path or path_to.
+    """
+    stack: list[tuple[NodePath, TreeNode]] = [((), tree)]
+    while stack:
+        path, node = stack.pop()
+        yield path, node
+        stack.extend(
+            (path + (index,), child) for index, child in reversed(list(enumerate(node.children)))
+        )
+
+
+def preorder_path(tree: TreeNode, index: int) -> NodePath:
+    """Return the path to the node with the given pre-order index, without recursion.
+
+    Only this path is built, so this takes O(index + depth).
+    """
+    if index < 0:
+        raise IndexError(index)
+    # Iterators over the children still to visit, of each node on the path.
+    stack = [enumerate(tree.children)]
+    path: list[int] = []
+    for _ in range(index):
+        child_index, child = next(stack[-1], (None, None))
+        while child is None:
+            stack.pop()
+            if not stack:
+                raise IndexError(index)
+            path.pop()
+            child_index, child = next(stack[-1], (None, None))
+        path.append(child_index)
+        stack.append(enumerate(child.children))
+    return tuple(path)
+
+
+def path_to(tree: TreeNode, node: TreeNode) -> NodePath:
+    """Return the path to node, by identity, without recursion.
+
+    If the same node object occurs more than once, this is the path to the first
+    in pre-order.
+    """
+    if tree is node:
+        return ()
+    # Each entry is a node and an iterator over its children still to visit.
+    stack: list[tuple[TreeNode, Iterator[TreeNode]]] = [(tree, iter(tree.children))]
+    while stack:
+        child = next(stack[-1][1], None)
+        if child is None:
+            stack.pop()
+            continue
+        if child is node:
+            # Only now find the child indexes, along the one path that needs them.
+            spine = [ancestor for ancestor, _ in stack] + [child]
+            return tuple(
+                next(index for index, sibling in enumerate(parent.children) if sibling is below)
+                for parent, below in zip(spine, spine[1:])
+            )
+        stack.append((child, iter(child.children)))
+    raise ValueError("The node is not in the tree")
+
+
+def node_at(tree: TreeNode, path: NodePath) -> TreeNode:
+    """Return the node at the end of the path."""
+    node = tree
+    for index in path:
+        node = node.children[index]
+    return node
 
 
 def tree_from_dict(root: dict[str, dict]) -> TreeNode:
@@ -74,33 +182,721 @@ def random_tree(
 
 def _random_tree(
     *,
-    depth: int = 0,
     max_depth: int,
     fanouts: tuple[int, ...],
     labels: tuple[str, ...] | None = None,
 ) -> TreeNode:
-    if labels:
-        label = random.choice(labels)
-    else:
-        label = chr(ord("a") + random.randint(0, 25))
+    def random_label() -> str:
+        if labels:
+            return random.choice(labels)
+        return chr(ord("a") + random.randint(0, 25))
+
+    # Nodes are generated in pre-order, drawing from random in the same order
+    # as a recursive generator would. Each entry of the stack is a node that
+    # is still generating its children: label, depth, number of children, and
+    # the children built so far.
+    root_label = random_label()
+    if max_depth == 0:
+        return TreeNode(root_label, (), 0)
+
+    stack: list[tuple[str, int, int, list[TreeNode]]] = [
+        (root_label, 0, random.choice(fanouts), [])
+    ]
+    while True:
+        label, depth, num_children, children = stack[-1]
+        if len(children) < num_children:
+            child_label = random_label()
+            if depth + 1 == max_depth:
+                children.append(TreeNode(child_label, (), depth + 1))
+            else:
+                stack.append((child_label, depth + 1, random.choice(fanouts), []))
+            continue
+
+        stack.pop()
+        node = TreeNode(label, tuple(children), depth)
+        if not stack:
+            return node
+        stack[-1][3].append(node)
+
+
+def _node_from_sub_dict(name: str, children_dict: dict | None) -> TreeNode:
+    # Each entry of the stack is a node whose children are still being built:
+    # name, an iterator over the children's dict items, and the built children.
+    stack = [(name, iter((children_dict or {}).items()), [])]
+    while True:
+        node_name, children_items, children_nodes = stack[-1]
+        depth = len(stack)
+        for child_name, child_children in children_items:
+            if child_children:
+                # Come back to the rest of the children once this child is built.
+                stack.append((child_name, iter(child_children.items()), []))
+                break
+            children_nodes.append(TreeNode(child_name, (), depth))
+        else:
+            stack.pop()
+            node = TreeNode(node_name, tuple(children_nodes), len(stack))
+            if not stack:
+                return node
+            stack[-1][2].append(node)
+
+
+class LabelTable:
+    """A symbol table of labels: each distinct label gets a dense integer id, from 0.
+
+    Share one between trees, such as all those of a corpus, so that their label
+    ids can be compared directly, rather than their label strings.
+    """
+
+    def __init__(self, labels: Iterable[str] = ()):
+        #: The labels, indexed by id. Only ever appended to.
+        self.labels: list[str] = []
+        self._ids: dict[str, int] = {}
+        for label in labels:
+            self.intern(label)
+
+    def intern(self, label: str) -> int:
+        """Return the id of the label, adding it to the table if it's new."""
+        label_id = self._ids.get(label)
+        if label_id is None:
+            label_id = self._ids[label] = len(self.labels)
+            self.labels.append(label)
+        return label_id
+
+    def label_id(self, label: str) -> int:
+        """Return the id of a label already in the table."""
+        return self._ids[label]
+
+    def label(self, label_id: int) -> str:
+        return self.labels[label_id]
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __contains__(self, label: str) -> bool:
+        return label in self._ids
+
+
+@dataclass(frozen=True, eq=False)
+class InternedTreeNode(TreeNode):
+    """A TreeNode made by a TreeInterner, which returns this same node for every equal subtree.
+
+    Its size and hash are computed once, from its children's, and the hash is that
+    of an equal TreeNode. So hashing is O(1), and so is comparing with a node from
+    the same interner, which is equal only if it is the same node.
+    """
+
+    #: The number of nodes in the subtree.
+    size: int = field(default=1, repr=False)
+    structural_hash: int = field(default=0, repr=False)
+
+    def __hash__(self) -> int:
+        return self.structural_hash
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, TreeNode):
+            return NotImplemented
+        return _equal_trees(self, other)
+
+    def __reduce__(self):
+        # Hashes of strings differ between processes, so unpickle as a plain TreeNode.
+        return (TreeNode, (self.label, self.children, self.depth))
+
+
+class TreeInterner:
+    """Hash-conses trees: every equal subtree built by one interner is one shared node.
+
+    Repeated subtrees, as in generated code, are then stored once. A node's depth
+    is part of its equality, so equal subtrees at different depths are not shared.
+    The interner keeps every node it has made, until it is discarded.
+
+        interner = TreeInterner()
+        leaf = interner.node("x")
+        tree = interner.node("+", (leaf, leaf))
+        interner.intern(tree_from_dict(...))
+    """
+
+    def __init__(self):
+        self._nodes: dict[tuple[str, tuple[TreeNode, ...], int], InternedTreeNode] = {}
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def node(
+        self, label: str, children: Iterable[TreeNode] = (), depth: int = 0
+    ) -> InternedTreeNode:
+        """Return the shared node with the given label, children and depth."""
+        return self._node(label, tuple(self.intern(child) for child in children), depth)
+
+    def intern(self, tree: TreeNode) -> InternedTreeNode:
+        """Return the shared copy of the tree, without recursion."""
+        if self._owns(tree):
+            return tree
+        # The copy of each node already interned, by id, for trees sharing subtrees.
+        done: dict[int, InternedTreeNode] = {}
+        # Each entry is a node, an iterator over its children still to visit, and
+        # the interned children so far.
+        stack: list[tuple[TreeNode, Iterator[TreeNode], list[InternedTreeNode]]] = [
+            (tree, iter(tree.children), [])
+        ]
+        while True:
+            node, children, new_children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                if id(child) in done:
+                    new_children.append(done[id(child)])
+                elif self._owns(child):
+                    new_children.append(child)
+                else:
+                    stack.append((child, iter(child.children), []))
+                continue
+
+            stack.pop()
+            new_node = self._node(node.label, tuple(new_children), node.depth)
+            done[id(node)] = new_node
+            if not stack:
+                return new_node
+            stack[-1][2].append(new_node)
+
+    def _node(
+        self, label: str, children: tuple[InternedTreeNode, ...], depth: int
+    ) -> InternedTreeNode:
+        key = (label, children, depth)
+        node = self._nodes.get(key)
+        if node is None:
+            # As the children's hashes are kept, hashing the key is O(fanout). It's
+            # also the hash TreeNode's dataclass __hash__ gives.
+            size = 1 + sum(child.size for child in children)
+            node = InternedTreeNode(label, children, depth, size, hash(key))
+            self._nodes[key] = node
+        return node
+
+    def _owns(self, node: TreeNode) -> bool:
+        return (
+            isinstance(node, InternedTreeNode)
+            and self._nodes.get((node.label, node.children, node.depth)) is node
+        )
+
+
+def _equal_trees(a: TreeNode, b: TreeNode) -> bool:
+    """Compare the trees without recursion, skipping subtrees that are the same node."""
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        if (
+            isinstance(a, InternedTreeNode)
+            and isinstance(b, InternedTreeNode)
+            and (a.structural_hash != b.structural_hash or a.size != b.size)
+        ):
+            return False
+        if a.label != b.label or a.depth != b.depth or len(a.children) != len(b.children):
+            return False
+        stack.extend(zip(a.children, b.children))
+    return True
+
+
+@dataclass(eq=False)
+class FlatTree:
+    """A compact, array-backed tree.
+
+    Nodes are identified by their pre-order index (the root is 0), and each of
+    the per-node arrays below is indexed by it. Labels are interned, so each
+    node only stores an integer id into the labels table. Trees built with the
+    same LabelTable share its labels list, and so their label ids.
+
+    Compared to a TreeNode tree, this needs no Python object per node, so very
+    large trees fit in a few dozen bytes per node.
+    """
+
+    #: The distinct labels of the tree, or the shared LabelTable's labels. Index
+    #: with label_ids.
+    labels: list[str]
+
+    #: The label id for each node.
+    label_ids: np.ndarray
+
+    #: The parent of each node, or -1 for the root.
+    parent: np.ndarray
+
+    #: The first (left-most) child of each node, or -1 for leaves.
+    first_child: np.ndarray
+
+    #: The next sibling to the right of each node, or -1 for the last child.
+    next_sibling: np.ndarray
+
+    #: The post-order index of each node.
+    post_order: np.ndarray
 
-    if depth == max_depth:
-        return TreeNode(label, (), depth)
+    #: The (pre-order) index of each node's left-most leaf descendant.
+    leftmost_leaf: np.ndarray
 
-    num_children = random.choice(fanouts)
-    children = tuple(
-        _random_tree(depth=depth + 1, max_depth=max_depth, fanouts=fanouts, labels=labels)
-        for _ in range(num_children)
-    )
+    #: The depth of each node.
+    depth: np.ndarray
 
-    return TreeNode(label, children, depth)
+    @classmethod
+    def from_preorder(
+        cls,
+        labels: Sequence[str],
+        parents: Sequence[int],
+        depths: Sequence[int] | None = None,
+        label_table: LabelTable | None = None,
+    ) -> "FlatTree":
+        """Construct a FlatTree from per-node labels and parents, listed in pre-order.
 
+        Requires:
+         - parents[0] == -1, and every other parent precedes its child.
+         - Siblings are listed left to right.
+        If depths is None, each node's depth is its number of ancestors. If
+        label_table is None, the tree gets a table of its own.
+        """
+        num_nodes = len(parents)
+        if num_nodes == 0:
+            raise TypeError("Empty trees not supported")
 
-def _node_from_sub_dict(name: str, children_dict: dict | None, depth: int = 0) -> TreeNode:
-    if children_dict is None:
-        return TreeNode(name, (), depth)
+        if label_table is None:
+            label_table = LabelTable()
+        intern = label_table.intern
+        label_ids = np.array([intern(label) for label in labels], dtype=np.int32)
+        parent = np.array(parents, dtype=np.int32)
+
+        first_child = np.full(num_nodes, -1, dtype=np.int32)
+        next_sibling = np.full(num_nodes, -1, dtype=np.int32)
+        last_child = np.full(num_nodes, -1, dtype=np.int32)
+        num_ancestors = np.zeros(num_nodes, dtype=np.int32)
+        parent_list = parent.tolist()
+        for index in range(1, num_nodes):
+            parent_index = parent_list[index]
+            if last_child[parent_index] == -1:
+                first_child[parent_index] = index
+            else:
+                next_sibling[last_child[parent_index]] = index
+            last_child[parent_index] = index
+            num_ancestors[index] = num_ancestors[parent_index] + 1
+
+        # Accumulate subtree sizes and left-most leaves from the bottom up.
+        # Descendants always come after their ancestors in pre-order.
+        subtree_size = np.ones(num_nodes, dtype=np.int32)
+        leftmost_leaf = np.arange(num_nodes, dtype=np.int32)
+        for index in range(num_nodes - 1, 0, -1):
+            subtree_size[parent_list[index]] += subtree_size[index]
+        has_children = first_child != -1
+        for index in np.flatnonzero(has_children)[::-1].tolist():
+            leftmost_leaf[index] = leftmost_leaf[index + 1]
+
+        # Before a node is reached in post-order, its whole subtree (minus
+        # itself) has been visited, as has everything before it in pre-order,
+        # except for its ancestors.
+        post_order = np.arange(num_nodes, dtype=np.int32) - num_ancestors + subtree_size - 1
+
+        if depths is None:
+            depth = num_ancestors
+        else:
+            depth = np.array(depths, dtype=np.int32)
+
+        return cls(
+            labels=label_table.labels,
+            label_ids=label_ids,
+            parent=parent,
+            first_child=first_child,
+            next_sibling=next_sibling,
+            post_order=post_order,
+            leftmost_leaf=leftmost_leaf,
+            depth=depth,
+        )
+
+    @classmethod
+    def from_tree(cls, root: TreeNode, label_table: LabelTable | None = None) -> "FlatTree":
+        """Flatten a TreeNode tree. Each node's depth attribute is kept as-is."""
+        labels: list[str] = []
+        parents: list[int] = []
+        depths: list[int] = []
+        stack: list[tuple[TreeNode, int]] = [(root, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            index = len(labels)
+            labels.append(node.label)
+            parents.append(parent_index)
+            depths.append(node.depth)
+            # Reversed so that the left-most child is popped (visited) first.
+            stack.extend((child, index) for child in reversed(node.children))
+
+        return cls.from_preorder(labels, parents, depths, label_table)
+
+    def to_tree(self, interner: TreeInterner | None = None) -> TreeNode:
+        """Rebuild the equivalent TreeNode tree, with shared subtrees if given an interner."""
+        make_node = TreeNode if interner is None else interner.node
+        first_child = self.first_child.tolist()
+        next_sibling = self.next_sibling.tolist()
+        depth = self.depth.tolist()
+        labels = [self.labels[label_id] for label_id in self.label_ids.tolist()]
+
+        # Descendants come after their ancestors in pre-order, so build backwards.
+        nodes: list[TreeNode | None] = [None] * len(self)
+        for index in range(len(self) - 1, -1, -1):
+            children = []
+            child = first_child[index]
+            while child != -1:
+                children.append(nodes[child])
+                nodes[child] = None
+                child = next_sibling[child]
+            nodes[index] = make_node(labels[index], tuple(children), depth[index])
+
+        root = nodes[0]
+        assert root is not None
+        return root
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    @property
+    def root(self) -> "FlatNode":
+        return FlatNode(self, 0)
+
+    def label(self, index: int) -> str:
+        return self.labels[self.label_ids[index]]
+
+    def label_ids_in(self, label_table: LabelTable) -> np.ndarray:
+        """Return the label id of each node in label_table, adding any labels it's missing."""
+        if label_table.labels is self.labels:
+            return self.label_ids
+        table_ids = np.array([label_table.intern(label) for label in self.labels], dtype=np.int32)
+        return table_ids[self.label_ids]
+
+    def children(self, index: int) -> Generator[int, None, None]:
+        """Yield the indexes of the children of the node at index, left to right."""
+        child = int(self.first_child[index])
+        while child != -1:
+            yield child
+            child = int(self.next_sibling[child])
+
+    def post_ordered_indexes(self) -> np.ndarray:
+        """Return the (pre-order) index of each node, ordered by post-order traversal."""
+        indexes = np.empty(len(self), dtype=np.int32)
+        indexes[self.post_order] = np.arange(len(self), dtype=np.int32)
+        return indexes
+
+
+class FlatNode:
+    """A lightweight view of a single node of a FlatTree.
+
+    Provides the same label, children and depth attributes as TreeNode, so it can
+    be used wherever a TreeNode is only read, such as in cost functions.
+    """
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: FlatTree, index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def label(self) -> str:
+        return self.tree.label(self.index)
+
+    @property
+    def children(self) -> tuple["FlatNode", ...]:
+        return tuple(FlatNode(self.tree, child) for child in self.tree.children(self.index))
+
+    @property
+    def depth(self) -> int:
+        return int(self.tree.depth[self.index])
+
+    def __eq__(self, other):
+        if not isinstance(other, FlatNode):
+            return NotImplemented
+        return self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return f"FlatNode(label={self.label!r}, index={self.index})"
+
+
+#: A file name, or a file object of text or UTF-8 bytes.
+Source = str | os.PathLike | IO
+
+#: The number of characters read at a time by the JSON and s-expression parsers.
+_CHUNK_SIZE = 1 << 16
+
+
+def trees_from_xml(
+    source: Source, *, records: bool = False, label_table: LabelTable | None = None
+) -> Generator[FlatTree, None, None]:
+    """Parse an XML document incrementally into a tree of its element tags.
+
+    Text, attributes and comments are left out. If records is True, the document
+    root is taken as a list of records, and each of its children is a tree of its
+    own. Each element is dropped once it has been read, so memory use is only
+    that of the tree being built. The trees share label_table, or a new table.
+    """
+    if label_table is None:
+        label_table = LabelTable()
+    labels: list[str] = []
+    parents: list[int] = []
+    # The pre-order index of each element started but not yet ended.
+    open_nodes: list[int] = []
+    # The elements themselves, along with the document root, even for records.
+    open_elements: list[ElementTree.Element] = []
+    for event, element in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            open_elements.append(element)
+            if records and len(open_elements) == 1:
+                continue
+            parents.append(open_nodes[-1] if open_nodes else -1)
+            open_nodes.append(len(labels))
+            labels.append(element.tag)
+            continue
+
+        open_elements.pop()
+        # Its children are already recorded. Drop it from its parent too, with any
+        # later siblings the parser has read ahead: only their events are used.
+        element.clear()
+        if open_elements:
+            del open_elements[-1][:]
+        if records and not open_elements:
+            continue
+
+        open_nodes.pop()
+        if not open_nodes:
+            yield FlatTree.from_preorder(labels, parents, label_table=label_table)
+            labels, parents = [], []
+
+
+_JSON_TOKEN = re.compile(
+    r"""[ \t\n\r]*
+    (?:
+        (?P<punctuation>[{}\[\]:,])
+        | (?P<string>"(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))*")
+        | (?P<scalar>-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null)
+        | (?P<error>[^ \t\n\r])
+    )""",
+    re.VERBOSE,
+)
+
+
+def trees_from_json(
+    source: Source, *, records: bool = False, label_table: LabelTable | None = None
+) -> Generator[FlatTree, None, None]:
+    """Parse JSON incrementally, into a tree for each top-level value.
+
+    Several top-level values, as in JSON Lines, give a tree each. If records is
+    True, each top-level value must be an array, and each of its elements is a
+    tree of its own. The text is read in chunks, and tokenized without building
+    any of the values, so memory use is only that of the tree being built.
+
+    As in tree_from_dict, an object's keys are nodes whose children are their
+    values' members. For the other values:
+     - An array value's elements are the key's children.
+     - A scalar value is the key's only child, labeled with the string, or with
+       the JSON text of a number, true, false or null.
+     - An object or array with no key, at the top level or in an array, is a
+       node labeled "{}" or "[]".
+    So {"a": {"b": {}}, "c": [1, {}]} is the tree: {}(a(b), c(1, {})).
+    The trees share label_table, or a new table.
+    """
+    if label_table is None:
+        label_table = LabelTable()
+    labels: list[str] = []
+    parents: list[int] = []
+
+    # Each entry is an open object or array: its opening token, the node its
+    # members are children of, and what it expects next. An object also keeps the
+    # node of its current key.
+    stack: list[list] = []
+    # With records, the open top-level array, whose elements each start a tree.
+    records_frame: list | None = None
+
+    def add(label: str, parent: int) -> int:
+        labels.append(label)
+        parents.append(parent)
+        return len(labels) - 1
+
+    def start_value(kind: str, text: str, parent: int, key: bool):
+        """Add a value to the tree. If it's an object or array, open it."""
+        if kind == "string":
+            text = _json_string(text)
+        elif kind not in ("scalar", "{", "["):
+            raise ValueError(f"Expected a JSON value, not {text!r}")
+        if not key:
+            # Nothing else labels this value, so it gets a node of its own.
+            parent = add({"{": "{}", "[": "[]"}.get(kind, text), parent)
+        elif kind in ("string", "scalar"):
+            add(text, parent)
+        if kind == "{":
+            stack.append(["{", parent, "key or end", -1])
+        elif kind == "[":
+            stack.append(["[", parent, "value or end"])
+
+    for match in _tokens(_read_text(source), _JSON_TOKEN):
+        kind = match.lastgroup
+        text = match[kind]
+        if kind == "punctuation":
+            kind = text
+
+        if not stack:
+            if records:
+                if kind != "[":
+                    raise ValueError(f"Expected an array of records, not {text!r}")
+                records_frame = ["[", -1, "value or end"]
+                stack.append(records_frame)
+            else:
+                start_value(kind, text, -1, key=False)
+        else:
+            frame = stack[-1]
+            container, parent, expected = frame[:3]
+            if kind == {"{": "}", "[": "]"}[container] and expected in (
+                "key or end",
+                "value or end",
+                "comma or end",
+            ):
+                stack.pop()
+                if frame is records_frame:
+                    continue
+            elif expected == "comma or end":
+                if kind != ",":
+                    raise ValueError(f"Expected ',' in the JSON {container}, not {text!r}")
+                frame[2] = "key" if container == "{" else "value"
+                continue
+            elif expected == ":":
+                if kind != ":":
+                    raise ValueError(f"Expected ':' after the JSON key, not {text!r}")
+                frame[2] = "value"
+                continue
+            elif container == "{" and expected in ("key or end", "key"):
+                if kind != "string":
+                    raise ValueError(f"Expected a JSON key, not {text!r}")
+                frame[3] = add(_json_string(text), parent)
+                frame[2] = ":"
+                continue
+            elif container == "{":
+                frame[2] = "comma or end"
+                start_value(kind, text, frame[3], key=True)
+            else:
+                frame[2] = "comma or end"
+                start_value(kind, text, parent, key=False)
+
+        # A value is complete. If it's a whole tree, emit it.
+        if labels and (not stack or (len(stack) == 1 and stack[0] is records_frame)):
+            yield FlatTree.from_preorder(labels, parents, label_table=label_table)
+            labels, parents = [], []
+
+    if stack:
+        raise ValueError("Unexpected end of JSON")
+
+
+def _json_string(text: str) -> str:
+    return json.loads(text) if "\\" in text else text[1:-1]
+
+
+_SEXP_TOKEN = re.compile(
+    r"""(?:\s+|;[^\n]*(?:\n|\Z))*
+    (?:
+        (?P<open>\() | (?P<close>\)) | (?P<string>"(?:[^"\\]|\\.)*") | (?P<atom>[^\s()";]+)
+        | (?P<error>[^\s;])
+    )""",
+    re.VERBOSE | re.DOTALL,
+)
+_SEXP_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+
+
+def trees_from_sexp(
+    source: Source, *, label_table: LabelTable | None = None
+) -> Generator[FlatTree, None, None]:
+    """Parse s-expressions incrementally, into a tree for each top-level expression.
+
+    A list's first element is the node's label, and the rest are its children. An
+    atom is a leaf, so (a (b c) d) is the tree: a(b(c), d). Atoms may be double
+    quoted, with backslash escapes, and ; starts a comment to the end of the line.
+    The trees share label_table, or a new table.
+    """
+    if label_table is None:
+        label_table = LabelTable()
+    labels: list[str] = []
+    parents: list[int] = []
+    # The pre-order index of each open list.
+    open_nodes: list[int] = []
+    expecting_label = False
+
+    for match in _tokens(_read_text(source), _SEXP_TOKEN):
+        kind = match.lastgroup
+        if kind == "open":
+            if expecting_label:
+                raise ValueError("Expected a label after '('")
+            expecting_label = True
+            continue
+        if kind == "close":
+            if expecting_label or not open_nodes:
+                raise ValueError("Unexpected ')'")
+            open_nodes.pop()
+        else:
+            label = match[kind]
+            if kind == "string":
+                label = _SEXP_ESCAPE.sub(r"\1", label[1:-1])
+            parents.append(open_nodes[-1] if open_nodes else -1)
+            labels.append(label)
+            if expecting_label:
+                open_nodes.append(len(labels) - 1)
+                expecting_label = False
+
+        if not open_nodes and not expecting_label:
+            yield FlatTree.from_preorder(labels, parents, label_table=label_table)
+            labels, parents = [], []
+
+    if open_nodes or expecting_label:
+        raise ValueError("Unexpected end of s-expression")
+
+
+def _read_text(source: Source) -> Generator[str, None, None]:
+    """Yield the text of the file in chunks. Bytes are decoded as UTF-8."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding="utf-8") as file:
+            yield from iter(lambda: file.read(_CHUNK_SIZE), "")
+        return
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while chunk := source.read(_CHUNK_SIZE):
+        yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+
+def _tokens(chunks: Iterable[str], token: re.Pattern) -> Generator[re.Match, None, None]:
+    """Yield the match of each token in the text, read chunk by chunk.
+
+    token matches any space and then a token, whose group is named by its kind,
+    or else any other character, as the group "error". Space alone at the end of
+    the text must not match, and nor may it match in part. A match ending near the
+    end of the text read so far may be cut short by it, so more is read before
+    trusting it. Near is within 2 characters, as a number such as 1e+5 needs.
+    """
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    # The number of characters dropped from the front of buffer, for error messages.
+    offset = 0
+    at_end = False
+    while True:
+        while match := token.match(buffer, position):
+            if match.lastgroup == "error":
+                if not at_end:
+                    # It may be the start of a token that's cut short.
+                    break
+                raise ValueError(
+                    f"Unexpected {match['error']!r} at character {offset + match.start('error')}"
+                )
+            if not at_end and match.end() + 2 >= len(buffer):
+                break
+            yield match
+            position = match.end()
 
-    children_nodes = []
-    for node_name, node_children in children_dict.items():
-        children_nodes.append(_node_from_sub_dict(node_name, node_children, depth + 1))
-    return TreeNode(name, tuple(children_nodes), depth)
+        if at_end:
+            return
+        chunk = next(chunks, None)
+        if chunk is None:
+            at_end = True
+        else:
+            buffer = buffer[position:] + chunk
+            offset += position
+            position = 0
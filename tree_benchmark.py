@@ -0,0 +1,174 @@
+"""Compare the iterative traversals and builders against their recursive forms.
+
+The recursive forms below are the original implementations, kept only as
+references. Run with:
+    python tree_benchmark.py
+"""
+
+import random
+import timeit
+from collections import deque
+
+from edit_tree import with_node_deleted, with_node_inserted, with_node_relabeled
+from pq_grams import DUMMY, PQGramIndex, shift_inplace
+from tree import TreeNode, _node_from_sub_dict, _random_tree, path_to, preorder_traversal
+from zhang_shasha import SubForest
+
+
+def recursive_preorder_traversal(tree: TreeNode):
+    yield tree
+    for child in tree.children:
+        yield from recursive_preorder_traversal(child)
+
+
+def recursive_random_tree(*, depth=0, max_depth, fanouts, labels=None) -> TreeNode:
+    if labels:
+        label = random.choice(labels)
+    else:
+        label = chr(ord("a") + random.randint(0, 25))
+
+    if depth == max_depth:
+        return TreeNode(label, (), depth)
+
+    num_children = random.choice(fanouts)
+    children = tuple(
+        recursive_random_tree(depth=depth + 1, max_depth=max_depth, fanouts=fanouts, labels=labels)
+        for _ in range(num_children)
+    )
+    return TreeNode(label, children, depth)
+
+
+def recursive_node_from_sub_dict(name, children_dict, depth=0) -> TreeNode:
+    if children_dict is None:
+        return TreeNode(name, (), depth)
+
+    children_nodes = []
+    for node_name, node_children in children_dict.items():
+        children_nodes.append(recursive_node_from_sub_dict(node_name, node_children, depth + 1))
+    return TreeNode(name, tuple(children_nodes), depth)
+
+
+def recursive_process_tree(subforest: SubForest, node: TreeNode):
+    left_most_subtree_index = len(subforest.post_ordered_nodes)
+    for child in node.children:
+        recursive_process_tree(subforest, child)
+
+    subforest.post_ordered_nodes.append(node)
+    subforest.subtree_start_index.append(left_most_subtree_index)
+
+
+def recursive_pq_grams(node: TreeNode, stem: deque, p: int, q: int, pq_grams: list):
+    base: deque[str] = deque([DUMMY] * q)
+    stem = stem.copy()
+    shift_inplace(stem, node.label)
+    stem_gram = tuple(stem)
+
+    if len(node.children) == 0:
+        pq_grams.append(stem_gram + tuple(base))
+        return
+
+    for child in node.children:
+        shift_inplace(base, child.label)
+        pq_grams.append(stem_gram + tuple(base))
+        recursive_pq_grams(child, stem, p, q, pq_grams)
+
+    for k in range(q - 1):
+        shift_inplace(base, DUMMY)
+        pq_grams.append(stem_gram + tuple(base))
+
+
+def recursive_with_node_relabeled(root: TreeNode, relabel: TreeNode, label: str) -> TreeNode:
+    if root is relabel:
+        return TreeNode(label, root.children, root.depth)
+
+    children = tuple(
+        recursive_with_node_relabeled(child, relabel, label) for child in root.children
+    )
+    return TreeNode(root.label, tuple(children), root.depth)
+
+
+def compare(name: str, iterative, recursive, number: int = 50, *, result=lambda value: value):
+    """Time both, after checking that they agree. result converts what iterative returns."""
+    assert result(iterative()) == recursive(), name
+    iterative_time = min(timeit.repeat(iterative, number=number, repeat=7))
+    recursive_time = min(timeit.repeat(recursive, number=number, repeat=7))
+    print(
+        f"{name:<24} iterative: {1e3 * iterative_time / number:8.3f} ms"
+        f"  recursive: {1e3 * recursive_time / number:8.3f} ms"
+        f"  ratio: {iterative_time / recursive_time:5.2f}"
+    )
+
+
+def main():
+    random.seed(1)
+    # Shallow, bushy trees: the recursive code's best case.
+    tree = recursive_random_tree(max_depth=8, fanouts=(1, 2, 3, 4))
+    nodes = list(preorder_traversal(tree))
+    print(f"Tree with {len(nodes)} nodes")
+
+    nested = {"a": {str(i): {str(j): None for j in range(20)} for i in range(200)}}
+
+    def seeded(func, **kwargs):
+        def run():
+            random.seed(2)
+            return func(max_depth=8, fanouts=(1, 2, 3, 4), **kwargs)
+
+        return run
+
+    def process_tree():
+        forest = SubForest(tree)
+        forest._process_tree(tree)
+        return forest.post_ordered_nodes, forest.subtree_start_index
+
+    def recursive_process():
+        forest = SubForest(tree)
+        recursive_process_tree(forest, tree)
+        return forest.post_ordered_nodes, forest.subtree_start_index
+
+    def recursive_index():
+        pq_grams: list = []
+        recursive_pq_grams(tree, deque([DUMMY] * 2), 2, 3, pq_grams)
+        return sorted(pq_grams)
+
+    target = nodes[len(nodes) // 2]
+
+    compare(
+        "preorder_traversal",
+        lambda: list(preorder_traversal(tree)),
+        lambda: list(recursive_preorder_traversal(tree)),
+    )
+    compare("random_tree", seeded(_random_tree), seeded(recursive_random_tree))
+    compare(
+        "tree_from_dict",
+        lambda: _node_from_sub_dict("a", nested["a"]),
+        lambda: recursive_node_from_sub_dict("a", nested["a"]),
+    )
+    compare("SubForest.from_tree", process_tree, recursive_process)
+    # Both build a sorted bag of pq-grams: of label ids, and of labels. Converting
+    # the ids to labels is only done to check them.
+    compare(
+        "PQGramIndex",
+        lambda: PQGramIndex(tree, p=2, q=3),
+        recursive_index,
+        result=lambda index: sorted(index.labeled_pq_grams()),
+    )
+    compare(
+        "with_node_relabeled",
+        lambda: with_node_relabeled(tree, target, "zz"),
+        lambda: recursive_with_node_relabeled(tree, target, "zz"),
+    )
+
+    # Not compared, but shown for reference.
+    target_path = path_to(tree, target)
+    for name, func in (
+        ("with_node_deleted", lambda: with_node_deleted(tree, target)),
+        ("with_node_inserted", lambda: with_node_inserted(tree, "zz", target, 0)),
+        # Given its path, the target isn't searched for, and only its ancestors are copied.
+        ("with_node_relabeled path", lambda: with_node_relabeled(tree, target_path, "zz")),
+    ):
+        elapsed = min(timeit.repeat(func, number=20, repeat=3))
+        print(f"{name:<24} iterative: {1e3 * elapsed / 20:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
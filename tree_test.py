@@ -0,0 +1,368 @@
+import io
+import json
+import pickle
+import random
+
+import pytest
+
+from edit_tree import (
+    Delete,
+    Insert,
+    Relabel,
+    apply_edits,
+    with_node_deleted,
+    with_node_inserted,
+    with_node_relabeled,
+)
+import tree as tree_module
+from tree import (
+    FlatTree,
+    LabelTable,
+    TreeInterner,
+    TreeNode,
+    levelorder_traversal,
+    node_at,
+    path_to,
+    postorder_traversal,
+    preorder_path,
+    preorder_paths,
+    preorder_traversal,
+    random_tree,
+    tree_from_dict,
+    trees_from_json,
+    trees_from_sexp,
+    trees_from_xml,
+)
+
+
+def test_flat_tree_round_trip():
+    random.seed(5)
+    for _ in range(20):
+        tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3))
+        assert FlatTree.from_tree(tree).to_tree() == tree
+
+
+def test_flat_tree_arrays():
+    #       a                  7
+    #    b     c      post     3     6
+    #  d e f   g  h    =>    0 1 2   4 5
+    tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}, "h": {}}}})
+    flat = FlatTree.from_tree(tree)
+
+    # Pre-order: a b d e f c g h
+    assert [flat.label(i) for i in range(len(flat))] == list("abdefcgh")
+    assert flat.parent.tolist() == [-1, 0, 1, 1, 1, 0, 5, 5]
+    assert flat.first_child.tolist() == [1, 2, -1, -1, -1, 6, -1, -1]
+    assert flat.next_sibling.tolist() == [-1, 5, 3, 4, -1, -1, 7, -1]
+    assert flat.post_order.tolist() == [7, 3, 0, 1, 2, 6, 4, 5]
+    assert flat.leftmost_leaf.tolist() == [2, 2, 2, 3, 4, 6, 6, 7]
+    assert flat.depth.tolist() == [0, 1, 2, 2, 2, 1, 2, 2]
+    assert list(flat.children(0)) == [1, 5]
+    assert flat.labels == list("abdefcgh")
+
+
+def test_flat_tree_interns_labels():
+    tree = TreeNode("a", (TreeNode("b", ()), TreeNode("a", ()), TreeNode("b", ())))
+    flat = FlatTree.from_tree(tree)
+    assert flat.labels == ["a", "b"]
+    assert flat.label_ids.tolist() == [0, 1, 0, 1]
+
+
+def test_flat_trees_share_label_table():
+    table = LabelTable(["c"])
+    a = FlatTree.from_tree(tree_from_dict({"a": {"b": {}}}), label_table=table)
+    b = FlatTree.from_tree(tree_from_dict({"b": {"c": {}, "a": {}}}), label_table=table)
+    assert a.labels is b.labels is table.labels
+    assert table.labels == ["c", "a", "b"]
+    assert a.label_ids.tolist() == [1, 2]
+    assert b.label_ids.tolist() == [2, 0, 1]
+    assert b.label_ids_in(table) is b.label_ids
+
+    # A tree with its own table is remapped, interning its new labels.
+    other = FlatTree.from_tree(tree_from_dict({"d": {"a": {}}}))
+    assert other.label_ids_in(table).tolist() == [3, 1]
+    assert table.label(3) == "d" and table.label_id("d") == 3 and len(table) == 4
+
+
+def _chain(depth: int) -> TreeNode:
+    node = TreeNode("x", (), depth)
+    for d in range(depth - 1, -1, -1):
+        node = TreeNode("x", (node,), d)
+    return node
+
+
+def test_traversal_orders():
+    tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}, "h": {}}}})
+    assert [node.label for node in preorder_traversal(tree)] == list("abdefcgh")
+    assert [node.label for node in postorder_traversal(tree)] == list("defbghca")
+    assert [node.label for node in levelorder_traversal(tree)] == list("abcdefgh")
+
+
+def test_deep_trees():
+    depth = 5000
+    tree = _chain(depth)
+    assert [node.depth for node in preorder_traversal(tree)] == list(range(depth + 1))
+    assert [node.depth for node in postorder_traversal(tree)] == list(range(depth, -1, -1))
+    assert sum(1 for _ in levelorder_traversal(tree)) == depth + 1
+
+    nested: dict = {}
+    root = {"x": nested}
+    for _ in range(depth):
+        nested["x"] = {}
+        nested = nested["x"]
+    from_dict = tree_from_dict(root)
+    assert [node.depth for node in preorder_traversal(from_dict)] == list(range(depth + 1))
+
+    leaf = list(preorder_traversal(tree))[-1]
+    deleted = with_node_deleted(tree, leaf)
+    assert sum(1 for _ in preorder_traversal(deleted)) == depth
+    inserted = with_node_inserted(tree, "y", leaf, 0)
+    assert list(preorder_traversal(inserted))[-1].label == "y"
+    relabeled = with_node_relabeled(tree, leaf, "y")
+    assert [node.label for node in postorder_traversal(relabeled)][0] == "y"
+
+
+def test_paths():
+    tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}}, "c": {"g": {}}}})
+    paths = list(preorder_paths(tree))
+    assert [path for path, _ in paths] == [(), (0,), (0, 0), (0, 1), (1,), (1, 0)]
+    assert [node for _, node in paths] == list(preorder_traversal(tree))
+    for index, (path, node) in enumerate(paths):
+        assert path_to(tree, node) == path
+        assert node_at(tree, path) is node
+        assert preorder_path(tree, index) == path
+    with pytest.raises(IndexError):
+        preorder_path(tree, len(paths))
+
+
+def test_edits_share_untouched_subtrees():
+    tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}, "h": {}}}})
+    b, c = tree.children
+    d, e, f = b.children
+    g, h = c.children
+
+    relabeled = with_node_relabeled(tree, g, "x")
+    assert relabeled == tree_from_dict(
+        {"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"x": {}, "h": {}}}}
+    )
+    assert relabeled.children[0] is b
+    assert relabeled.children[1].children[1] is h
+    assert with_node_relabeled(tree, (1, 0), "x") == relabeled
+
+    deleted = with_node_deleted(tree, c)
+    assert deleted.children == (b, g, h)
+    assert with_node_deleted(tree, (1,)) == deleted
+
+    inserted = with_node_inserted(tree, "x", (0,), 1, 2)
+    new_b, new_c = inserted.children
+    assert new_c is c
+    assert new_b.children[0] is d
+    assert new_b.children[1].label == "x"
+    assert new_b.children[1].children == (e, f)
+    assert with_node_inserted(tree, "x", b, 1, 2) == inserted
+
+
+def test_edits_of_shared_and_missing_nodes():
+    shared = tree_from_dict({"s": {"t": {}}})
+    tree = TreeNode("a", (shared, TreeNode("b", (shared,), 0)), 0)
+
+    # A node given as itself is edited wherever it occurs.
+    relabeled = with_node_relabeled(tree, shared, "x")
+    assert [node.label for node in preorder_traversal(relabeled)] == ["a", "x", "t", "b", "x", "t"]
+    deleted = with_node_deleted(tree, shared)
+    assert [node.label for node in preorder_traversal(deleted)] == ["a", "t", "b", "t"]
+    inserted = with_node_inserted(tree, "x", shared, 0)
+    assert [node.label for node in preorder_traversal(inserted)] == [
+        "a", "s", "x", "t", "b", "s", "x", "t"
+    ]
+    # Given its path, only that occurrence is.
+    relabeled = with_node_relabeled(tree, (1, 0), "x")
+    assert [node.label for node in preorder_traversal(relabeled)] == ["a", "s", "t", "b", "x", "t"]
+
+    # A node that isn't in the tree leaves it as it is.
+    missing = TreeNode("m", (), 1)
+    assert with_node_relabeled(tree, missing, "x") is tree
+    assert with_node_deleted(tree, missing) is tree
+    assert with_node_inserted(tree, "x", missing, 0) is tree
+
+
+def test_apply_edits_matches_one_at_a_time():
+    random.seed(7)
+    for _ in range(20):
+        root = random_tree(max_depth=4, fanouts=(0, 1, 2, 3))
+        tree = root
+        node_ids = list(range(sum(1 for _ in preorder_traversal(root))))
+        next_id = len(node_ids)
+        edits = []
+        for _ in range(15):
+            paths = [path for path, _ in preorder_paths(tree)]
+            position = random.randrange(len(paths))
+            path = paths[position]
+            kind = random.choice(("delete", "insert", "relabel"))
+            if kind == "delete":
+                # Deleting the root leaves the tree as it is, in both.
+                tree = with_node_deleted(tree, path)
+                edits.append(Delete(node_ids[position]))
+            elif kind == "insert":
+                num_children = len(node_at(tree, path).children)
+                index = random.randint(0, num_children)
+                adopted = random.randint(0, num_children - index)
+                tree = with_node_inserted(tree, "x", path, index, adopted)
+                edits.append(Insert("x", node_ids[position], index, adopted))
+                next_id += 1
+            else:
+                tree = with_node_relabeled(tree, path, "y")
+                edits.append(Relabel(node_ids[position], "y"))
+
+            applied = apply_edits(root, edits)
+            assert applied.tree == tree
+            node_ids = applied.node_ids
+            assert sorted(node_ids) == sorted(set(node_ids))
+            assert max(node_ids) < next_id
+
+
+def test_apply_edits_shares_untouched_subtrees():
+    root = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}, "h": {}}}})
+    b, c = root.children
+    d, _, f = b.children
+    # Pre-order ids: a=0 b=1 d=2 e=3 f=4 c=5 g=6 h=7, and the inserted i=8.
+    applied = apply_edits(root, [Relabel((1, 0), "x"), Insert("i", 6, 0), Delete(3)])
+    assert applied.tree == tree_from_dict(
+        {"a": {"b": {"d": {}, "f": {}}, "c": {"x": {"i": {}}, "h": {}}}}
+    )
+    assert applied.node_ids == [0, 1, 2, 4, 5, 6, 8, 7]
+    new_b, new_c = applied.tree.children
+    assert new_b.children[0] is d and new_b.children[1] is f
+    assert new_c.children[1] is c.children[1]
+    assert apply_edits(root, []).tree is root
+    assert apply_edits(root, [Delete(0)]).tree is with_node_deleted(root, root)
+    assert apply_edits(root, [Delete((1, 1))]) == apply_edits(root, [Delete(7)])
+    for path in ((2,), (0, 3), (0, 0, 0)):
+        with pytest.raises(ValueError):
+            apply_edits(root, [Relabel(path, "x")])
+
+
+def test_interned_trees_share_equal_subtrees():
+    random.seed(9)
+    interner = TreeInterner()
+    for _ in range(10):
+        tree = random_tree(max_depth=6, fanouts=(0, 1, 2, 3), labels=("a", "b"))
+        interned = interner.intern(tree)
+        assert interned == tree and tree == interned
+        assert hash(interned) == hash(tree)
+        assert interned.size == sum(1 for _ in preorder_traversal(tree))
+        assert interner.intern(tree) is interned
+        assert FlatTree.from_tree(tree).to_tree(interner) is interned
+
+        nodes = list(preorder_traversal(interned))
+        for node in nodes:
+            for other in nodes:
+                assert (node == other) == (node is other)
+        assert pickle.loads(pickle.dumps(interned)) == tree
+
+    leaf = interner.node("x", (), 1)
+    assert interner.node("+", (leaf, TreeNode("x", (), 1))).children == (leaf, leaf)
+    assert interner.node("+", (leaf,)) != TreeInterner().node("+", (TreeNode("y", (), 1),))
+
+
+def test_interning_deep_trees():
+    tree = _chain(5000)
+    interned = TreeInterner().intern(tree)
+    assert interned.size == 5001
+    assert interned == tree
+    assert hash(interned) == hash(TreeInterner().intern(tree))
+
+
+def test_trees_from_json(monkeypatch):
+    text = '{"a": {"b": {}}, "c": [1.5e3, {}], "d": "x\\"y", "e": null} [] "s"'
+    trees = [flat.to_tree() for flat in trees_from_json(io.StringIO(text))]
+    assert trees == [
+        tree_from_dict(
+            {
+                "{}": {
+                    "a": {"b": {}},
+                    "c": {"1.5e3": {}, "{}": {}},
+                    "d": {'x"y': {}},
+                    "e": {"null": {}},
+                }
+            }
+        ),
+        TreeNode("[]", ()),
+        TreeNode("s", ()),
+    ]
+
+    records = [{f"k{i}": [i * 1e-3, "v\u00e9\n", {"x": None, "y": [True]}]} for i in range(20)]
+    text = json.dumps(records)
+    expected = [flat.to_tree() for flat in trees_from_json(io.StringIO(text), records=True)]
+    assert len(expected) == 20
+    # Tokens cut by the ends of chunks are read whole.
+    monkeypatch.setattr(tree_module, "_CHUNK_SIZE", 3)
+    chunked = trees_from_json(io.BytesIO(text.encode()), records=True)
+    assert [flat.to_tree() for flat in chunked] == expected
+
+    for bad in ('{"a" 1}', "[1,]", '{"a": 1,}', "[1}", "{", "[tru]", '"a'):
+        with pytest.raises(ValueError):
+            list(trees_from_json(io.StringIO(bad)))
+
+
+def test_trees_from_xml(tmp_path):
+    path = tmp_path / "doc.xml"
+    path.write_text('<r><a x="1"><b/>text</a><!-- c --><d/></r>')
+    assert [flat.to_tree() for flat in trees_from_xml(path)] == [
+        tree_from_dict({"r": {"a": {"b": {}}, "d": {}}})
+    ]
+    records = trees_from_xml(io.BytesIO(path.read_bytes()), records=True)
+    assert [flat.to_tree() for flat in records] == [
+        TreeNode("a", (TreeNode("b", (), 1),)),
+        TreeNode("d", ()),
+    ]
+
+
+def test_trees_from_xml_drops_elements(monkeypatch):
+    iterparse = tree_module.ElementTree.iterparse
+    most_kept = 0
+
+    def counting_iterparse(*args, **kwargs):
+        nonlocal most_kept
+        document_root = None
+        for event, element in iterparse(*args, **kwargs):
+            if document_root is None:
+                document_root = element
+            most_kept = max(most_kept, sum(1 for _ in document_root.iter()))
+            yield event, element
+
+    monkeypatch.setattr(tree_module.ElementTree, "iterparse", counting_iterparse)
+    text = "<r>" + "<a><b><c/></b><d/></a>" * 20000 + "</r>"
+    for records in (False, True):
+        most_kept = 0
+        flats = list(trees_from_xml(io.StringIO(text), records=records))
+        assert sum(len(flat) for flat in flats) == 80000 + (not records)
+        # The parser reads ahead by a chunk, but the elements already read are dropped.
+        assert most_kept < 5000
+
+
+def test_trees_from_sexp(monkeypatch):
+    text = '(a (b c) d) x ; (not a tree)\n("q r" "s\\"t") (z) ; c'
+    expected = [
+        tree_from_dict({"a": {"b": {"c": {}}, "d": {}}}),
+        TreeNode("x", ()),
+        tree_from_dict({"q r": {'s"t': {}}}),
+        TreeNode("z", ()),
+    ]
+    assert [flat.to_tree() for flat in trees_from_sexp(io.StringIO(text))] == expected
+    monkeypatch.setattr(tree_module, "_CHUNK_SIZE", 2)
+    assert [flat.to_tree() for flat in trees_from_sexp(io.StringIO(text))] == expected
+
+    for bad in ("(", ")", "(()", "(a))", '("x'):
+        with pytest.raises(ValueError):
+            list(trees_from_sexp(io.StringIO(bad)))
+
+
+def test_parsing_deep_trees():
+    depth = 20000
+    (flat,) = trees_from_json(io.StringIO("[" * depth + "]" * depth))
+    assert len(flat) == depth
+    (flat,) = trees_from_sexp(io.StringIO("(a " * depth + ")" * depth))
+    assert len(flat) == depth
+    (flat,) = trees_from_xml(io.StringIO("<a>" * depth + "</a>" * depth))
+    assert len(flat) == depth
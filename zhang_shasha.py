@@ -11,12 +11,19 @@ which confused me greatly.
 The original paper by Zhang and Shasha: https://tinyurl.com/zhang-shasha-ted
 """
 
-from collections.abc import Callable
+from array import array
+from collections import Counter
+from collections.abc import Callable, Iterator
 from dataclasses import dataclass, field
 import dataclasses
 from functools import cache
+import math
+from typing import Literal, TypeAlias
 
-from tree import TreeNode
+import numpy as np
+
+from pq_grams import pq_grams
+from tree import FlatNode, FlatTree, LabelTable, TreeNode
 
 
 @dataclass
@@ -52,26 +59,46 @@ class SubForest:
     """
 
     #: The root node of the source tree for this SubForest.
-    source_tree: TreeNode
+    source_tree: TreeNode | FlatTree
 
-    #: All nodes from the source tree in post-order traversal order.
-    post_ordered_nodes: list[TreeNode] = field(default_factory=list)
+    #: All nodes from the source tree in post-order traversal order. For a
+    #: FlatTree, these are FlatNode views.
+    post_ordered_nodes: list[TreeNode | FlatNode] = field(default_factory=list)
 
     #: For post-order indexes, the nodes in the slice [subtree_start_index[i], i]
     #: give us the entire subtree for the node at index i.
     subtree_start_index: list[int] = field(default_factory=list)
 
+    #: The table of the labels' ids.
+    label_table: LabelTable = field(default_factory=LabelTable)
+
+    #: The label id of each node in post-order, from label_table.
+    label_ids: list[int] = field(default_factory=list)
+
     #: Reference the post-ordered index range of the source tree's nodes with
     #: start and stop indexes.
     start_index: int = 0
     #: Non-inclusive.
     stop_index: int = 0
 
+    #: The source tree's keyroots, once computed. Shared by copies of the SubForest.
+    _keyroots: list[int] | None = field(default=None, repr=False)
+
     @classmethod
-    def from_tree(cls, root: TreeNode):
-        """Preprocess a Tree to initialize a top-level SubForest."""
+    def from_tree(cls, root: TreeNode | FlatTree, label_table: LabelTable | None = None):
+        """Preprocess a Tree to initialize a top-level SubForest.
+
+        Share label_table between SubForests to make their label ids comparable.
+        """
         subforest = cls(root)
-        subforest._process_tree(root)
+        if label_table is not None:
+            subforest.label_table = label_table
+        if isinstance(root, FlatTree):
+            subforest._process_flat_tree(root)
+        else:
+            subforest._process_tree(root)
+            intern = subforest.label_table.intern
+            subforest.label_ids = [intern(node.label) for node in subforest.post_ordered_nodes]
         subforest.stop_index = len(subforest.post_ordered_nodes)
         return subforest
 
@@ -130,6 +157,23 @@ class SubForest:
             stop_index=self.stop_index - 1,
         )
 
+    def keyroot_indexes(self) -> list[int]:
+        """Return the post-ordered indexes of the keyroots of the source tree, ascending.
+
+        A keyroot is either the root, or a node with a left sibling. Equivalently,
+        it is the highest node for each distinct left-most leaf (Zhang + Shasha,
+        Section 3.2, LR_keyroots). Every node lies on the left-most path of exactly
+        one keyroot, which is what lets the dynamic program visit each subtree
+        pair only once.
+        """
+        if self._keyroots is None:
+            highest_by_leaf: dict[int, int] = {}
+            for index, leaf_index in enumerate(self.subtree_start_index):
+                # Post-order guarantees ancestors come later, so the last write wins.
+                highest_by_leaf[leaf_index] = index
+            self._keyroots = sorted(highest_by_leaf.values())
+        return self._keyroots
+
     def __hash__(self):
         """Used for the cache/memoization"""
         return hash((id(self.source_tree), self.start_index, self.stop_index))
@@ -144,34 +188,316 @@ class SubForest:
             and self.stop_index == other.stop_index
         )
 
-    def _process_tree(self, node: TreeNode):
+    def _process_flat_tree(self, tree: FlatTree):
+        # The FlatTree already knows the post-order and left-most leaves, they
+        # only need mapping from pre-order to post-order indexes.
+        post_ordered_indexes = tree.post_ordered_indexes()
+        self.post_ordered_nodes = [FlatNode(tree, index) for index in post_ordered_indexes.tolist()]
+        self.subtree_start_index = tree.post_order[
+            tree.leftmost_leaf[post_ordered_indexes]
+        ].tolist()
+        self.label_ids = tree.label_ids_in(self.label_table)[post_ordered_indexes].tolist()
+
+    def _process_tree(self, root: TreeNode):
         # In a post-order iteration of the tree, the next registered node will
         # be the left-most leaf of this node's subtree. And so the current
         # length of the post_ordered_nodes will be the index of that node.
-        left_most_subtree_index = len(self.post_ordered_nodes)
-        for child in node.children:
-            self._process_tree(child)
+        #
+        # An explicit stack is used instead of recursion so that deep trees do
+        # not hit Python's recursion limit. The node being visited is kept in
+        # locals: the node, an iterator over the children still to visit, and
+        # the index of its left-most leaf. Its ancestors wait on the stack.
+        post_ordered_nodes = self.post_ordered_nodes
+        append_node = post_ordered_nodes.append
+        append_start = self.subtree_start_index.append
+        stack: list[tuple[TreeNode, Iterator[TreeNode], int]] = []
+        node, children, left_most_subtree_index = root, iter(root.children), len(post_ordered_nodes)
+        while True:
+            for child in children:
+                if child.children:
+                    # Come back to the rest of the children once this subtree is done.
+                    stack.append((node, children, left_most_subtree_index))
+                    node, children = child, iter(child.children)
+                    left_most_subtree_index = len(post_ordered_nodes)
+                    break
+                # A leaf is its own left-most leaf.
+                append_start(len(post_ordered_nodes))
+                append_node(child)
+            else:
+                append_node(node)
+                append_start(left_most_subtree_index)
+                if not stack:
+                    return
+                node, children, left_most_subtree_index = stack.pop()
+
 
-        self.post_ordered_nodes.append(node)
-        self.subtree_start_index.append(left_most_subtree_index)
+def unit_cost(node: TreeNode) -> float:
+    """The default cost to delete or insert any node."""
+    return 1
+
+
+def label_mismatch_cost(a: TreeNode, b: TreeNode) -> float:
+    """The default cost to relabel: free if the labels already match, 1 otherwise."""
+    return int(a.label != b.label)
 
 
 @dataclass
 class CostFunctions:
-    """Override these to customize the cost functions."""
+    """Override these to customize the cost functions.
+
+    The *_costs methods provide the same costs as arrays for the "vectorized"
+    engine. The defaults derive them from the per-node functions, but are
+    computed without Python-level calls for the built-in cost functions. When
+    costs come from per-node arrays, override these methods to return them
+    directly.
+
+    When relabel costs only depend on the labels, override relabel_label_costs
+    too, so that the engines can look them up by label id rather than calling
+    relabel for each pair of nodes.
+    """
+
+    delete: Callable[[TreeNode], float] = unit_cost
+    insert: Callable[[TreeNode], float] = unit_cost
+    relabel: Callable[[TreeNode, TreeNode], float] = label_mismatch_cost
+
+    def delete_costs(self, nodes: list[TreeNode]) -> np.ndarray:
+        """Return the cost to delete each of the nodes, as a float array."""
+        return _node_costs(self.delete, nodes)
+
+    def insert_costs(self, nodes: list[TreeNode]) -> np.ndarray:
+        """Return the cost to insert each of the nodes, as a float array."""
+        return _node_costs(self.insert, nodes)
+
+    def relabel_costs(self, a_nodes: list[TreeNode], b_nodes: list[TreeNode]) -> np.ndarray:
+        """Return the (len(a_nodes), len(b_nodes)) float matrix of relabel costs."""
+        label_table = LabelTable()
+        a_ids = np.array([label_table.intern(node.label) for node in a_nodes], dtype=np.intp)
+        b_ids = np.array([label_table.intern(node.label) for node in b_nodes], dtype=np.intp)
+        label_costs = self.relabel_label_costs(label_table.labels, label_table.labels)
+        if label_costs is not None:
+            return label_costs[np.ix_(a_ids, b_ids)]
+
+        relabel = self.relabel
+        costs = np.empty((len(a_nodes), len(b_nodes)), dtype=np.float64)
+        for i, a_node in enumerate(a_nodes):
+            costs[i] = [relabel(a_node, b_node) for b_node in b_nodes]
+        return costs
+
+    def relabel_label_costs(self, a_labels: list[str], b_labels: list[str]) -> np.ndarray | None:
+        """Return the (len(a_labels), len(b_labels)) float matrix of the costs to relabel
+        a node with each a_label to each b_label.
 
-    delete: Callable[[TreeNode], float] = lambda node: 1
-    insert: Callable[[TreeNode], float] = lambda node: 1
-    relabel: Callable[[TreeNode, TreeNode], float] = lambda a, b: int(a.label != b.label)
+        Returns None if relabel costs depend on more than the nodes' labels.
+        """
+        if self.relabel is label_mismatch_cost:
+            a_array = np.array(a_labels, dtype=object)
+            b_array = np.array(b_labels, dtype=object)
+            return (a_array[:, np.newaxis] != b_array[np.newaxis, :]).astype(np.float64)
+        return None
+
+
+def _node_costs(cost_func: Callable[[TreeNode], float], nodes: list[TreeNode]) -> np.ndarray:
+    if cost_func is unit_cost:
+        return np.ones(len(nodes), dtype=np.float64)
+    return np.array([cost_func(node) for node in nodes], dtype=np.float64)
+
+
+#: The available implementations of zhang_shasha.
+#:  - "keyroot": The paper's iterative dynamic program over keyroot pairs.
+#:  - "vectorized": The same dynamic program, but each forestdist row is
+#:    computed with NumPy from precomputed cost arrays. Exact for integer-valued
+#:    costs; otherwise it may differ from "keyroot" by floating point rounding.
+#:  - "recursive": The memoized recursive definitions. Easier to follow, but
+#:    limited by Python's recursion depth and memory hungry.
+Engine: TypeAlias = Literal["keyroot", "vectorized", "recursive"]
 
 
 def zhang_shasha(
-    a_tree_root: TreeNode,
-    b_tree_root: TreeNode,
+    a_tree_root: TreeNode | FlatTree,
+    b_tree_root: TreeNode | FlatTree,
+    cost_funcs: CostFunctions = CostFunctions(),
+    *,
+    engine: Engine = "keyroot",
+) -> float:
+    """Return the tree edit distance between two trees.
+
+    All engines return the same distance; see Engine for how they differ.
+    """
+    label_table = LabelTable()
+    a_forest = SubForest.from_tree(a_tree_root, label_table)
+    b_forest = SubForest.from_tree(b_tree_root, label_table)
+    return forest_distance(a_forest, b_forest, cost_funcs, engine=engine)
+
+
+def forest_distance(
+    a_forest: SubForest,
+    b_forest: SubForest,
     cost_funcs: CostFunctions = CostFunctions(),
+    *,
+    engine: Engine = "keyroot",
+) -> float:
+    """Return the tree edit distance between two already preprocessed trees.
+
+    Use this to avoid repeating SubForest.from_tree for trees compared many times.
+    """
+    if engine == "keyroot":
+        return _keyroot_distance(a_forest, b_forest, cost_funcs)
+    if engine == "vectorized":
+        return _vectorized_distance(a_forest, b_forest, cost_funcs)
+    if engine == "recursive":
+        return _recursive_distance(a_forest, b_forest, cost_funcs)
+    raise ValueError(f"Unknown engine: {engine!r}")
+
+
+@dataclass
+class EditMapping:
+    """An optimal alignment between the nodes of two trees.
+
+    Nodes are referred to by their post-order index in their tree. Every node of
+    a is either matched or deleted, and every node of b is either matched or
+    inserted. Replay it onto a with edit_tree.with_mapping_applied.
+    """
+
+    #: The tree edit distance, ie. the total cost of the edits.
+    distance: float
+
+    #: The source trees the mapping was computed between.
+    a_tree: TreeNode | FlatTree
+    b_tree: TreeNode | FlatTree
+
+    #: All nodes of each tree, in post-order traversal order.
+    a_nodes: list[TreeNode | FlatNode]
+    b_nodes: list[TreeNode | FlatNode]
+
+    #: Pairs of matched (a, b) nodes, ascending. Matched nodes are relabeled to b's
+    #: label if they differ.
+    matches: list[tuple[int, int]] = field(default_factory=list)
+
+    #: The nodes of a that are deleted, ascending.
+    deletes: list[int] = field(default_factory=list)
+
+    #: The nodes of b that are inserted, ascending.
+    inserts: list[int] = field(default_factory=list)
+
+    def relabels(self) -> list[tuple[int, int]]:
+        """Return the matched (a, b) pairs whose labels differ."""
+        return [
+            (i, j) for i, j in self.matches if self.a_nodes[i].label != self.b_nodes[j].label
+        ]
+
+
+def zhang_shasha_mapping(
+    a_tree_root: TreeNode | FlatTree,
+    b_tree_root: TreeNode | FlatTree,
+    cost_funcs: CostFunctions = CostFunctions(),
+) -> EditMapping:
+    """Return an optimal mapping between two trees, along with their tree edit distance.
+
+    The distance is computed as by the "keyroot" engine. Rather than keeping
+    backpointers for every forestdist table, only the tree distances are kept.
+    The forestdist tables of the tree pairs on the optimal path are recomputed
+    while tracing it back, so the extra memory is a single forestdist table.
+    """
+    label_table = LabelTable()
+    a_forest = SubForest.from_tree(a_tree_root, label_table)
+    b_forest = SubForest.from_tree(b_tree_root, label_table)
+    tables = _KeyrootTables(a_forest, b_forest, cost_funcs)
+    tables.fill_keyroots()
+
+    mapping = EditMapping(
+        distance=tables.treedist[-1][-1],
+        a_tree=a_tree_root,
+        b_tree=b_tree_root,
+        a_nodes=a_forest.post_ordered_nodes,
+        b_nodes=b_forest.post_ordered_nodes,
+    )
+    _trace_mapping(tables, mapping)
+    mapping.matches.sort()
+    mapping.deletes.sort()
+    mapping.inserts.sort()
+    return mapping
+
+
+#: Returned by zhang_shasha_bounded when the distance is greater than max_distance.
+BOUND_EXCEEDED = math.inf
+
+
+def zhang_shasha_bounded(
+    a_tree_root: TreeNode | FlatTree,
+    b_tree_root: TreeNode | FlatTree,
+    max_distance: float,
+    cost_funcs: CostFunctions = CostFunctions(),
+    *,
+    pq_gram_q: int | None = None,
+) -> float:
+    """Return the tree edit distance if it is at most max_distance, otherwise BOUND_EXCEEDED.
+
+    Cheaper than zhang_shasha when most distances are over the bound:
+     - Lower bounds are checked upfront, from cheapest to most expensive:
+        - The difference in tree sizes, costed by the cheapest deletes or inserts.
+        - For the default costs only, the difference between the label histograms.
+        - If pq_gram_q is given, the halved pq_grams distance with p=1 and q=pq_gram_q.
+     - The keyroot dynamic program only fills cells whose forests' sizes are close
+       enough to be within the bound (a band around the diagonal).
+     - The root's forestdist table is abandoned once an entire row is over the bound.
+
+    Requires:
+    - Costs are non-negative.
+    - If pq_gram_q is given, the costs are at least the fanout weighted tree edit
+      distance costs for q (Section 7.3 of the pq-grams paper). The pq-gram bound is
+      otherwise not a lower bound.
+    """
+    label_table = LabelTable()
+    a_forest = SubForest.from_tree(a_tree_root, label_table)
+    b_forest = SubForest.from_tree(b_tree_root, label_table)
+    delete_costs = [cost_funcs.delete(node) for node in a_forest.post_ordered_nodes]
+    insert_costs = [cost_funcs.insert(node) for node in b_forest.post_ordered_nodes]
+
+    if _size_lower_bound(delete_costs, insert_costs) > max_distance:
+        return BOUND_EXCEEDED
+
+    is_unit_cost = (
+        cost_funcs.delete is unit_cost
+        and cost_funcs.insert is unit_cost
+        and cost_funcs.relabel is label_mismatch_cost
+    )
+    if is_unit_cost and _label_lower_bound(a_forest, b_forest) > max_distance:
+        return BOUND_EXCEEDED
+
+    if pq_gram_q is not None:
+        if pq_grams(a_tree_root, b_tree_root, p=1, q=pq_gram_q, halved=True) > max_distance:
+            return BOUND_EXCEEDED
+
+    distance = _bounded_keyroot_distance(
+        a_forest, b_forest, cost_funcs, max_distance, delete_costs, insert_costs
+    )
+    return distance if distance <= max_distance else BOUND_EXCEEDED
+
+
+def _size_lower_bound(delete_costs: list[float], insert_costs: list[float]) -> float:
+    """The larger tree needs at least the difference in sizes deleted or inserted."""
+    if len(delete_costs) > len(insert_costs):
+        return sum(sorted(delete_costs)[: len(delete_costs) - len(insert_costs)])
+    return sum(sorted(insert_costs)[: len(insert_costs) - len(delete_costs)])
+
+
+def _label_lower_bound(a_forest: SubForest, b_forest: SubForest) -> int:
+    """For unit costs, each node whose label has no match on the other side needs an edit.
+
+    Each edit deletes, inserts, or relabels a single node, so handles at most one
+    unmatched label on each side. This subsumes the difference in sizes.
+
+    Requires:
+    - The forests share a label table.
+    """
+    a_labels = Counter(a_forest.label_ids)
+    b_labels = Counter(b_forest.label_ids)
+    return max((a_labels - b_labels).total(), (b_labels - a_labels).total())
+
+
+def _recursive_distance(
+    a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions
 ) -> float:
-    a_forest = SubForest.from_tree(a_tree_root)
-    b_forest = SubForest.from_tree(b_tree_root)
 
     @cache
     def forestdist(a_forest: SubForest, b_forest: SubForest) -> float:
@@ -249,3 +575,558 @@ def zhang_shasha(
         return min(dist_delete, dist_insert, dist_relabel)
 
     return forestdist(a_forest, b_forest)
+
+
+def _keyroot_distance(a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions) -> float:
+    """The dynamic program as finally formalized by Zhang + Shasha (Section 3.2).
+
+    The recursive forestdist above explores the same subproblems, but discovers
+    them top-down. Here, they are filled bottom-up, one keyroot pair at a time.
+    See _KeyrootTables for the tables.
+    """
+    tables = _KeyrootTables(a_forest, b_forest, cost_funcs)
+    if tables.are_free_to_match():
+        return 0.0
+    tables.fill_keyroots()
+    return tables.treedist[-1][-1]
+
+
+class _KeyrootTables:
+    """The tables of the keyroot dynamic program:
+     - treedist[i][j] holds the distance between the full subtrees rooted at a's
+       node i and b's node j. It persists for the whole computation.
+     - forestdist[x][y] is scratch space for a single tree pair (i, j). It
+       holds the distance between a's forest, a[l(i)..l(i)+x-1], and b's forest,
+       b[l(j)..l(j)+y-1]. Row/column 0 are the empty forests.
+
+    Both tables are preallocated once and reused, so no recursion or per-step
+    allocation happens inside the loops.
+
+    Equal subtrees, by labels and shape, share a class across both trees. When
+    the costs only depend on the labels, the tree distances of subtree pairs only
+    depend on their classes, and so a keyroot pair whose classes were already
+    filled copies the tree distances along their left-most paths, rather than
+    filling forestdist again. Repetitive trees, such as generated code, have
+    many such pairs.
+    """
+
+    def __init__(self, a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions):
+        self.a_forest = a_forest
+        self.b_forest = b_forest
+        num_a = len(a_forest.post_ordered_nodes)
+        num_b = len(b_forest.post_ordered_nodes)
+
+        # The delete and insert costs only depend on a single node, so they can be
+        # computed upfront. Relabel costs are only needed once per (i, j) pair, so
+        # they are computed where they are used.
+        self.delete_costs = [cost_funcs.delete(node) for node in a_forest.post_ordered_nodes]
+        self.insert_costs = [cost_funcs.insert(node) for node in b_forest.post_ordered_nodes]
+        self.relabel = cost_funcs.relabel
+        self.label_costs = _label_relabel_costs(a_forest, b_forest, cost_funcs)
+
+        # array("d") keeps the tables compact: 8 bytes per cell, rather than a
+        # pointer to a boxed float.
+        self.treedist = [array("d", bytes(8 * num_b)) for _ in range(num_a)]
+        self.forestdist = [array("d", bytes(8 * (num_b + 1))) for _ in range(num_a + 1)]
+
+        #: The class of each node of each tree, in post-order.
+        self.a_classes, self.b_classes = _subtree_classes(a_forest, b_forest)
+        #: For each pair of keyroot classes, the first keyroot pair filled with them.
+        #: None if the tree distances can depend on more than the classes.
+        self.filled_classes: dict[tuple[int, int], tuple[int, int]] | None = None
+        if (
+            self.label_costs is not None
+            and _costs_follow_classes(self.a_classes, self.delete_costs)
+            and _costs_follow_classes(self.b_classes, self.insert_costs)
+        ):
+            self.filled_classes = {}
+
+    def are_free_to_match(self) -> bool:
+        """Return if the trees are equal, with costs such that their distance is 0.
+
+        Matching each node to its counterpart costs nothing, which is optimal when
+        no cost is negative.
+        """
+        if self.label_costs is None or self.a_classes[-1] != self.b_classes[-1]:
+            return False
+        a_label_rows, b_label_columns, label_cost_rows = self.label_costs
+        return (
+            min(self.delete_costs) >= 0
+            and min(self.insert_costs) >= 0
+            and min(min(row) for row in label_cost_rows) >= 0
+            and all(
+                label_cost_rows[row][column] == 0
+                for row, column in zip(a_label_rows, b_label_columns)
+            )
+        )
+
+    def fill_keyroots(self):
+        """Fill treedist for every pair of subtrees, one keyroot pair at a time."""
+        b_keyroots = self.b_forest.keyroot_indexes()
+        if self.filled_classes is None:
+            for i in self.a_forest.keyroot_indexes():
+                for j in b_keyroots:
+                    self.fill(i, j)
+            return
+
+        a_left_paths = _left_paths(self.a_forest)
+        b_left_paths = _left_paths(self.b_forest)
+        a_lefts = self.a_forest.subtree_start_index
+        b_lefts = self.b_forest.subtree_start_index
+        treedist = self.treedist
+        for i in self.a_forest.keyroot_indexes():
+            for j in b_keyroots:
+                filled = self.filled_classes.setdefault(
+                    (self.a_classes[i], self.b_classes[j]), (i, j)
+                )
+                if filled == (i, j):
+                    self.fill(i, j)
+                    continue
+
+                # Equal subtrees have equal left-most paths, so copy position by position.
+                i0, j0 = filled
+                b_path = b_left_paths[b_lefts[j]]
+                b_path0 = b_left_paths[b_lefts[j0]]
+                for i1, i01 in zip(a_left_paths[a_lefts[i]], a_left_paths[a_lefts[i0]]):
+                    treedist_i1 = treedist[i1]
+                    treedist_i01 = treedist[i01]
+                    for j1, j01 in zip(b_path, b_path0):
+                        treedist_i1[j1] = treedist_i01[j01]
+
+    def fill(self, i: int, j: int):
+        """Fill forestdist for the subtrees rooted at i and j, and treedist along their
+        left-most paths.
+
+        Requires:
+        - The tree distances of the other subtree pairs within (i, j) are in treedist.
+        """
+        a_nodes = self.a_forest.post_ordered_nodes
+        b_nodes = self.b_forest.post_ordered_nodes
+        a_lefts = self.a_forest.subtree_start_index
+        b_lefts = self.b_forest.subtree_start_index
+        delete_costs = self.delete_costs
+        insert_costs = self.insert_costs
+        relabel = self.relabel
+        label_costs = self.label_costs
+        a_label_rows, b_label_columns, label_cost_rows = label_costs or ([], [], [])
+        treedist = self.treedist
+        forestdist = self.forestdist
+
+        a_left = a_lefts[i]
+        b_left = b_lefts[j]
+        # Lemma 3(ii) and 3(iii): Only deletes or inserts against the empty forest.
+        first_row = forestdist[0]
+        first_row[0] = 0.0
+        for y, j1 in enumerate(range(b_left, j + 1), start=1):
+            first_row[y] = first_row[y - 1] + insert_costs[j1]
+
+        for x, i1 in enumerate(range(a_left, i + 1), start=1):
+            prev_row = forestdist[x - 1]
+            row = forestdist[x]
+            row[0] = prev_row[0] + delete_costs[i1]
+            cost_delete = delete_costs[i1]
+            i1_left = a_lefts[i1]
+            treedist_i1 = treedist[i1]
+            relabel_row = None
+            if label_costs is not None:
+                relabel_row = label_cost_rows[a_label_rows[i1]]
+
+            for y, j1 in enumerate(range(b_left, j + 1), start=1):
+                dist_delete = prev_row[y] + cost_delete
+                dist_insert = row[y - 1] + insert_costs[j1]
+
+                j1_left = b_lefts[j1]
+                if i1_left == a_left and j1_left == b_left:
+                    # Both forests are whole trees (Lemma 4(i) in the paper),
+                    # so this cell is also a tree distance worth keeping.
+                    if relabel_row is not None:
+                        cost_relabel = relabel_row[b_label_columns[j1]]
+                    else:
+                        cost_relabel = relabel(a_nodes[i1], b_nodes[j1])
+                    dist_relabel = prev_row[y - 1] + cost_relabel
+                    dist = min(dist_delete, dist_insert, dist_relabel)
+                    treedist_i1[j1] = dist
+                else:
+                    # Otherwise, reuse the tree distance of the last trees,
+                    # which an earlier keyroot pair already computed (Lemma 4(ii)).
+                    dist_relabel = (
+                        forestdist[i1_left - a_left][j1_left - b_left] + treedist_i1[j1]
+                    )
+                    dist = min(dist_delete, dist_insert, dist_relabel)
+                row[y] = dist
+
+
+def _subtree_classes(a_forest: SubForest, b_forest: SubForest) -> tuple[list[int], list[int]]:
+    """Number the subtrees of both forests, so that equal subtrees get the same class."""
+    classes: dict[tuple, int] = {}
+    shared_labels = a_forest.label_table is b_forest.label_table
+
+    def number(forest: SubForest) -> list[int]:
+        labels = forest.label_ids
+        if not shared_labels:
+            labels = [forest.label_table.label(label_id) for label_id in labels]
+        lefts = forest.subtree_start_index
+        node_classes = []
+        # The roots of the subtrees finished so far, which aren't yet a child of any
+        # node. In post-order, a node's children are those of them in its subtree.
+        roots: list[int] = []
+        for index, left in enumerate(lefts):
+            start = len(roots)
+            while start and roots[start - 1] >= left:
+                start -= 1
+            key = (labels[index], tuple(node_classes[child] for child in roots[start:]))
+            del roots[start:]
+            roots.append(index)
+            node_classes.append(classes.setdefault(key, len(classes)))
+        return node_classes
+
+    return number(a_forest), number(b_forest)
+
+
+def _costs_follow_classes(classes: list[int], costs: list[float]) -> bool:
+    """Return if every node of each class has the same cost."""
+    class_costs: dict[int, float] = {}
+    return all(
+        class_costs.setdefault(node_class, cost) == cost for node_class, cost in zip(classes, costs)
+    )
+
+
+def _left_paths(forest: SubForest) -> dict[int, list[int]]:
+    """Return the nodes of each keyroot's left-most path, ascending, by its left-most leaf."""
+    paths: dict[int, list[int]] = {}
+    for index, left in enumerate(forest.subtree_start_index):
+        paths.setdefault(left, []).append(index)
+    return paths
+
+
+def _label_relabel_costs(
+    a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions
+) -> tuple[list[int], list[int], list[list[float]]] | None:
+    """Return the relabel costs between the forests' distinct labels, if relabel costs
+    only depend on labels. Otherwise, None.
+
+    Returned are the row of each of a's nodes, the column of each of b's nodes, and
+    the table of costs. Looking up the table replaces a call to relabel per pair.
+    """
+    a_label_rows, a_labels = _distinct_labels(a_forest)
+    b_label_columns, b_labels = _distinct_labels(b_forest)
+    label_costs = cost_funcs.relabel_label_costs(a_labels, b_labels)
+    if label_costs is None:
+        return None
+    return a_label_rows, b_label_columns, label_costs.tolist()
+
+
+def _distinct_labels(forest: SubForest) -> tuple[list[int], list[str]]:
+    """Return the index of each node's label among the forest's distinct labels, and them."""
+    indexes: dict[int, int] = {}
+    label_indexes = [indexes.setdefault(label_id, len(indexes)) for label_id in forest.label_ids]
+    return label_indexes, [forest.label_table.label(label_id) for label_id in indexes]
+
+
+def _trace_mapping(tables: _KeyrootTables, mapping: EditMapping):
+    """Trace back the optimal path through the filled tables, recording it in mapping.
+
+    Each cell of forestdist is reached from whichever of its delete, insert or
+    relabel options it equals. The arithmetic is repeated exactly, so these are
+    exact float comparisons. Relabeling two trees that aren't the whole forests
+    jumps to their tree distance, and so the tree pair is traced separately.
+    """
+    a_lefts = tables.a_forest.subtree_start_index
+    b_lefts = tables.b_forest.subtree_start_index
+    delete_costs = tables.delete_costs
+    insert_costs = tables.insert_costs
+    forestdist = tables.forestdist
+
+    tree_pairs = [(len(a_lefts) - 1, len(b_lefts) - 1)]
+    while tree_pairs:
+        i, j = tree_pairs.pop()
+        tables.fill(i, j)
+        a_left = a_lefts[i]
+        b_left = b_lefts[j]
+
+        x = i + 1 - a_left
+        y = j + 1 - b_left
+        while x > 0 or y > 0:
+            i1 = a_left + x - 1
+            j1 = b_left + y - 1
+            if y == 0 or (x > 0 and forestdist[x][y] == forestdist[x - 1][y] + delete_costs[i1]):
+                mapping.deletes.append(i1)
+                x -= 1
+            elif x == 0 or forestdist[x][y] == forestdist[x][y - 1] + insert_costs[j1]:
+                mapping.inserts.append(j1)
+                y -= 1
+            elif a_lefts[i1] == a_left and b_lefts[j1] == b_left:
+                mapping.matches.append((i1, j1))
+                x -= 1
+                y -= 1
+            else:
+                # The rest of the forests are independent of the relabeled trees.
+                # Tracing the trees refills forestdist, so they are traced later.
+                tree_pairs.append((i1, j1))
+                x = a_lefts[i1] - a_left
+                y = b_lefts[j1] - b_left
+
+
+def _bounded_keyroot_distance(
+    a_forest: SubForest,
+    b_forest: SubForest,
+    cost_funcs: CostFunctions,
+    max_distance: float,
+    delete_costs: list[float],
+    insert_costs: list[float],
+) -> float:
+    """_keyroot_distance, but skipping work that can only lead to distances over max_distance.
+
+    A forest with x nodes and one with y nodes are at least |x - y| deletes or
+    inserts apart. So if the cheapest of those costs, c, is positive, only the
+    cells within a band of max_distance / c around the diagonal of each
+    forestdist table can be within the bound. Cells outside the band, and tree
+    distances that were never filled, are treated as infinite. This is safe
+    since every subproblem on an optimal path costs no more than the whole.
+
+    Returns a value greater than max_distance if the distance is over the bound.
+    """
+    a_nodes = a_forest.post_ordered_nodes
+    b_nodes = b_forest.post_ordered_nodes
+    a_lefts = a_forest.subtree_start_index
+    b_lefts = b_forest.subtree_start_index
+    num_a = len(a_nodes)
+    num_b = len(b_nodes)
+    relabel = cost_funcs.relabel
+    label_costs = _label_relabel_costs(a_forest, b_forest, cost_funcs)
+    a_label_rows, b_label_columns, label_cost_rows = label_costs or ([], [], [])
+
+    inf = math.inf
+    cheapest = min(delete_costs + insert_costs)
+    # No band is wider than the tables, which also covers an infinite max_distance.
+    band = num_a + num_b
+    if cheapest > 0 and max_distance < band * cheapest:
+        band = int(max_distance // cheapest)
+
+    treedist = [array("d", [inf]) * num_b for _ in range(num_a)]
+    forestdist = [array("d", bytes(8 * (num_b + 1))) for _ in range(num_a + 1)]
+
+    b_keyroots = b_forest.keyroot_indexes()
+    for i in a_forest.keyroot_indexes():
+        a_left = a_lefts[i]
+        a_size = i + 1 - a_left
+        for j in b_keyroots:
+            b_left = b_lefts[j]
+            b_size = j + 1 - b_left
+            is_root_pair = i == num_a - 1 and j == num_b - 1
+
+            # Lemma 3(iii), within the band. The cell just past the band is marked
+            # so the next row doesn't read a stale value.
+            first_row = forestdist[0]
+            first_row[0] = 0.0
+            for y in range(1, min(b_size, band) + 1):
+                first_row[y] = first_row[y - 1] + insert_costs[b_left + y - 1]
+            if band < b_size:
+                first_row[band + 1] = inf
+
+            for x, i1 in enumerate(range(a_left, i + 1), start=1):
+                prev_row = forestdist[x - 1]
+                row = forestdist[x]
+                cost_delete = delete_costs[i1]
+                row[0] = prev_row[0] + cost_delete if x <= band else inf
+                i1_left = a_lefts[i1]
+                treedist_i1 = treedist[i1]
+                split_x = i1_left - a_left
+                relabel_row = None
+                if label_costs is not None:
+                    relabel_row = label_cost_rows[a_label_rows[i1]]
+
+                y_start = max(1, x - band)
+                y_stop = min(b_size, x + band)
+                if y_start > 1:
+                    row[y_start - 1] = inf
+
+                for y in range(y_start, y_stop + 1):
+                    j1 = b_left + y - 1
+                    dist_delete = prev_row[y] + cost_delete
+                    dist_insert = row[y - 1] + insert_costs[j1]
+
+                    j1_left = b_lefts[j1]
+                    if i1_left == a_left and j1_left == b_left:
+                        if relabel_row is not None:
+                            cost_relabel = relabel_row[b_label_columns[j1]]
+                        else:
+                            cost_relabel = relabel(a_nodes[i1], b_nodes[j1])
+                        dist_relabel = prev_row[y - 1] + cost_relabel
+                        dist = min(dist_delete, dist_insert, dist_relabel)
+                        treedist_i1[j1] = dist
+                    else:
+                        split_y = j1_left - b_left
+                        if abs(split_x - split_y) > band:
+                            dist = min(dist_delete, dist_insert)
+                        else:
+                            dist_relabel = forestdist[split_x][split_y] + treedist_i1[j1]
+                            dist = min(dist_delete, dist_insert, dist_relabel)
+                    row[y] = dist
+
+                if y_stop < b_size:
+                    row[y_stop + 1] = inf
+
+                # Every mapping of the whole trees contains a mapping of a's first
+                # x nodes to some prefix of b, so costs at least the row's minimum.
+                row_minimum = min(row[0], min(row[y_start : y_stop + 1], default=inf))
+                if is_root_pair and row_minimum > max_distance:
+                    return inf
+
+    return treedist[num_a - 1][num_b - 1]
+
+
+def _vectorized_distance(
+    a_forest: SubForest, b_forest: SubForest, cost_funcs: CostFunctions
+) -> float:
+    """The keyroot dynamic program, with forestdist rows computed by NumPy.
+
+    See _keyroot_distance for the meaning of the tables. Within a row, x, every
+    cell only depends on earlier rows, except for the insert option which depends
+    on the cell to its left:
+        row[y] = min(c[y], row[y - 1] + insert[y])
+    where c[y] is the best of the delete and relabel options. Unrolling this
+    gives a prefix minimum that NumPy can scan:
+        row[y] = S[y] + min(c[y'] - S[y'] for y' <= y)
+    where S is the cumulative sum of the insert costs along the row.
+
+    A row for a single keyroot pair is usually too short to be worth a NumPy
+    call, so for each of a's keyroots, the rows of many of b's keyroots are laid
+    side by side and swept together. b's keyroots are grouped by how deeply
+    other keyroots nest inside them (see _keyroot_levels): keyroots of the same
+    level have disjoint subtrees, and only need tree distances from lower
+    levels, which are already complete by the time their level is swept.
+    """
+    a_nodes = a_forest.post_ordered_nodes
+    b_nodes = b_forest.post_ordered_nodes
+    a_lefts = a_forest.subtree_start_index
+    num_a = len(a_nodes)
+    num_b = len(b_nodes)
+
+    delete_costs = cost_funcs.delete_costs(a_nodes).tolist()
+    insert_costs = cost_funcs.insert_costs(b_nodes)
+    relabel_costs = cost_funcs.relabel_costs(a_nodes, b_nodes)
+
+    treedist = np.zeros((num_a, num_b), dtype=np.float64)
+    b_layouts = [
+        _RowLayout(keyroots, b_forest.subtree_start_index, insert_costs)
+        for keyroots in _keyroot_levels(b_forest)
+    ]
+    forestdist = np.zeros((num_a + 1, max(layout.width for layout in b_layouts)), dtype=np.float64)
+
+    for i in a_forest.keyroot_indexes():
+        a_left = a_lefts[i]
+        for layout in b_layouts:
+            width = layout.width
+            # Lemma 3(iii): Only inserts against the empty forest.
+            forestdist[0, :width] = layout.insert_sums
+
+            for x, i1 in enumerate(range(a_left, i + 1), start=1):
+                prev_row = forestdist[x - 1, :width]
+                row = forestdist[x, :width]
+                i1_left = a_lefts[i1]
+                treedist_row = treedist[i1]
+
+                # Lemma 4(ii): Reuse the tree distances from earlier keyroot pairs.
+                best = (
+                    forestdist[i1_left - a_left, layout.subtree_columns]
+                    + treedist_row[layout.nodes]
+                )
+                if i1_left == a_left:
+                    # Lemma 4(i): Both forests are whole trees along these columns.
+                    best[layout.tree_cells] = (
+                        prev_row[layout.tree_columns - 1] + relabel_costs[i1, layout.tree_nodes]
+                    )
+                np.minimum(best, prev_row[layout.node_columns] + delete_costs[i1], out=best)
+
+                # Lemma 3(ii) for the empty forest columns, then the insert scan.
+                row[layout.empty_columns] = prev_row[layout.empty_columns] + delete_costs[i1]
+                row[layout.node_columns] = best
+                row -= layout.insert_sums
+                layout.prefix_minimum(row)
+                row += layout.insert_sums
+
+                if i1_left == a_left:
+                    treedist_row[layout.tree_nodes] = row[layout.tree_columns]
+
+    return float(treedist[num_a - 1, num_b - 1])
+
+
+def _keyroot_levels(forest: SubForest) -> list[list[int]]:
+    """Group the keyroots of the forest by how deeply other keyroots nest inside them.
+
+    Keyroots with no other keyroots in their subtree are level 0, and every other
+    keyroot is one level above the highest keyroot inside its subtree.
+    """
+    lefts = forest.subtree_start_index
+    node_levels = np.full(len(lefts), -1, dtype=np.intp)
+    levels: list[list[int]] = []
+    for j in forest.keyroot_indexes():
+        level = int(node_levels[lefts[j] : j].max(initial=-1)) + 1
+        node_levels[j] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(j)
+    return levels
+
+
+class _RowLayout:
+    """The columns of several keyroots' forestdist tables, laid side by side.
+
+    Each keyroot, j, gets a segment of columns: one for the empty forest,
+    followed by one for each node, l(j)..j. The segments must not overlap in the
+    source tree, as each node's tree distance may only be written once per row.
+    """
+
+    def __init__(self, keyroots: list[int], lefts: list[int], insert_costs: np.ndarray):
+        empty_columns = []
+        nodes = []
+        for j in keyroots:
+            empty_columns.append(len(empty_columns) + len(nodes))
+            nodes.extend(range(lefts[j], j + 1))
+
+        #: Total number of columns in the layout.
+        self.width = len(empty_columns) + len(nodes)
+        #: The column of each segment's empty forest.
+        self.empty_columns = np.array(empty_columns, dtype=np.intp)
+        #: The post-ordered index of the node for each non-empty column.
+        self.nodes = np.array(nodes, dtype=np.intp)
+
+        segment_sizes = np.array([j + 2 - lefts[j] for j in keyroots], dtype=np.intp)
+        segment_starts = np.repeat(self.empty_columns, segment_sizes)
+        #: Position of each column in its segment (0 for the empty forest).
+        self.positions = np.arange(self.width, dtype=np.intp) - segment_starts
+
+        is_node = self.positions > 0
+        (self.node_columns,) = np.nonzero(is_node)
+        node_segment_starts = segment_starts[is_node]
+        node_lefts = np.array(lefts, dtype=np.intp)[self.nodes]
+        segment_lefts = self.nodes - self.positions[is_node] + 1
+        #: The column of the forest left of each node's subtree, ie. l(j1) - 1.
+        self.subtree_columns = node_segment_starts + node_lefts - segment_lefts
+
+        #: The (indexes into nodes of the) cells where both forests are whole trees.
+        (self.tree_cells,) = np.nonzero(node_lefts == segment_lefts)
+        self.tree_columns = self.node_columns[self.tree_cells]
+        self.tree_nodes = self.nodes[self.tree_cells]
+
+        #: Cumulative insert costs along each segment, S, starting from 0.
+        sums = np.zeros(self.width, dtype=np.float64)
+        sums[self.node_columns] = insert_costs[self.nodes]
+        sums = np.cumsum(sums)
+        self.insert_sums = sums - sums[segment_starts]
+
+        self._scan_masks = []
+        shift = 1
+        while shift < segment_sizes.max():
+            self._scan_masks.append((shift, self.positions[shift:] >= shift))
+            shift *= 2
+
+    def prefix_minimum(self, row: np.ndarray):
+        """In-place, replace each value with the minimum up to it within its segment.
+
+        A log-step scan (Hillis + Steele) with the masks stopping it from
+        crossing segment boundaries.
+        """
+        for shift, mask in self._scan_masks:
+            np.minimum(row[shift:], row[:-shift], out=row[shift:], where=mask)
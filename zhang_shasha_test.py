@@ -1,5 +1,17 @@
-from tree import TreeNode, tree_from_dict
-from zhang_shasha import CostFunctions, zhang_shasha
+import math
+import random
+
+import numpy as np
+
+from edit_tree import with_mapping_applied
+from tree import FlatTree, TreeInterner, TreeNode, random_tree, tree_from_dict
+from zhang_shasha import (
+    BOUND_EXCEEDED,
+    CostFunctions,
+    zhang_shasha,
+    zhang_shasha_bounded,
+    zhang_shasha_mapping,
+)
 
 
 def test_single_equal():
@@ -73,3 +85,177 @@ def test_medium_assymetric_costs():
     # Default deletes and inserts both cost 1.
     assert zhang_shasha(a_tree, single_tree, cost_funcs=costs_funcs) == 6
     assert zhang_shasha(single_tree, a_tree, cost_funcs=costs_funcs) == 12
+
+
+def test_engines_match_random():
+    random.seed(7)
+    for _ in range(30):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        recursive = zhang_shasha(a_tree, b_tree, engine="recursive")
+        assert zhang_shasha(a_tree, b_tree, engine="keyroot") == recursive
+        assert zhang_shasha(a_tree, b_tree, engine="vectorized") == recursive
+
+
+def test_vectorized_custom_costs():
+    class FanoutCosts(CostFunctions):
+        def delete_costs(self, nodes):
+            return np.array([len(node.children) + 1 for node in nodes], dtype=np.float64)
+
+    cost_funcs = FanoutCosts(
+        delete=lambda node: len(node.children) + 1,
+        insert=lambda node: 2,
+        relabel=lambda a, b: 3 * (a.label != b.label),
+    )
+    random.seed(8)
+    for _ in range(30):
+        a_tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=5, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        keyroot = zhang_shasha(a_tree, b_tree, cost_funcs, engine="keyroot")
+        assert zhang_shasha(a_tree, b_tree, cost_funcs, engine="vectorized") == keyroot
+
+
+def test_keyroot_repeated_subtrees():
+    # The keyroot engine reuses the tree distances of repeated subtree pairs, and
+    # returns early for equal trees, so check it against the vectorized engine.
+    class LabelCosts(CostFunctions):
+        def relabel_label_costs(self, a_labels, b_labels):
+            # Even relabeling to the same label costs, so equal trees aren't free.
+            return np.ones((len(a_labels), len(b_labels)))
+
+    random.seed(9)
+    parts = [random_tree(max_depth=3, fanouts=(1, 2), labels=("x", "+", "1")) for _ in range(4)]
+    costs = (
+        CostFunctions(),
+        CostFunctions(delete=lambda node: len(node.children) + 1, insert=lambda node: 2),
+        CostFunctions(delete=lambda node: node.depth + 1),
+        LabelCosts(),
+    )
+    for _ in range(5):
+        a_tree = TreeNode("m", tuple(random.choice(parts) for _ in range(8)))
+        b_tree = TreeNode("m", tuple(random.choice(parts) for _ in range(8)))
+        for cost_funcs in costs:
+            for b in (b_tree, a_tree):
+                vectorized = zhang_shasha(a_tree, b, cost_funcs, engine="vectorized")
+                assert zhang_shasha(a_tree, b, cost_funcs) == vectorized
+                assert zhang_shasha_mapping(a_tree, b, cost_funcs).distance == vectorized
+    assert zhang_shasha(a_tree, a_tree) == 0
+    assert zhang_shasha(a_tree, a_tree, LabelCosts()) == len(FlatTree.from_tree(a_tree))
+
+
+def test_keyroot_deep_chain():
+    # Deep enough that the recursive engine would exceed Python's recursion limit.
+    depth = 3000
+    a_tree = TreeNode("a", ())
+    for _ in range(depth):
+        a_tree = TreeNode("a", (a_tree,))
+    b_tree = TreeNode("b", (TreeNode("a", ()),))
+    assert zhang_shasha(a_tree, b_tree, engine="keyroot") == depth
+
+
+def test_flat_tree_input():
+    random.seed(9)
+    for _ in range(20):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        expected = zhang_shasha(a_tree, b_tree)
+        a_flat = FlatTree.from_tree(a_tree)
+        b_flat = FlatTree.from_tree(b_tree)
+        for engine in ("keyroot", "vectorized", "recursive"):
+            assert zhang_shasha(a_flat, b_flat, engine=engine) == expected
+        assert zhang_shasha(a_flat, b_tree) == expected
+
+
+def test_bounded_matches_exact():
+    random.seed(10)
+    for _ in range(40):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        exact = zhang_shasha(a_tree, b_tree)
+        for max_distance in range(int(exact) + 3):
+            bounded = zhang_shasha_bounded(a_tree, b_tree, max_distance)
+            assert bounded == (exact if exact <= max_distance else BOUND_EXCEEDED)
+
+
+def test_bounded_custom_costs():
+    cost_funcs = CostFunctions(
+        delete=lambda node: len(node.children) + 1,
+        insert=lambda node: 2,
+        relabel=lambda a, b: 3 * (a.label != b.label),
+    )
+    random.seed(11)
+    for _ in range(30):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        exact = zhang_shasha(a_tree, b_tree, cost_funcs)
+        for max_distance in (0, exact - 1, exact, exact + 1):
+            bounded = zhang_shasha_bounded(a_tree, b_tree, max_distance, cost_funcs)
+            assert bounded == (exact if exact <= max_distance else BOUND_EXCEEDED)
+
+
+def test_bounded_infinite_bound():
+    random.seed(14)
+    for _ in range(10):
+        a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+        assert zhang_shasha_bounded(a_tree, b_tree, math.inf) == zhang_shasha(a_tree, b_tree)
+
+
+def test_mapping_medium():
+    #       a                  a
+    #    b     c     =>     b     z
+    #  d e f     g        d f      g
+    a_tree = tree_from_dict({"a": {"b": {"d": {}, "e": {}, "f": {}}, "c": {"g": {}}}})
+    b_tree = tree_from_dict({"a": {"b": {"d": {}, "f": {}}, "z": {"g": {}}}})
+    mapping = zhang_shasha_mapping(a_tree, b_tree)
+    assert mapping.distance == 2
+    # Post-order: d e f b g c a  =>  d f b g z a
+    assert mapping.deletes == [1]
+    assert mapping.inserts == []
+    assert mapping.relabels() == [(5, 4)]
+    assert with_mapping_applied(a_tree, mapping) == b_tree
+
+
+def test_mapping_replays_random():
+    cost_funcs = CostFunctions(
+        delete=lambda node: len(node.children) + 1,
+        insert=lambda node: 2,
+        relabel=lambda a, b: 3 * (a.label != b.label),
+    )
+    random.seed(12)
+    for costs in (CostFunctions(), cost_funcs):
+        for _ in range(30):
+            a_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+            b_tree = random_tree(max_depth=4, fanouts=(0, 1, 2, 3), labels=("a", "b", "c"))
+            mapping = zhang_shasha_mapping(a_tree, b_tree, costs)
+            assert mapping.distance == zhang_shasha(a_tree, b_tree, costs)
+
+            a_nodes = mapping.a_nodes
+            b_nodes = mapping.b_nodes
+            total = (
+                sum(costs.delete(a_nodes[i]) for i in mapping.deletes)
+                + sum(costs.insert(b_nodes[j]) for j in mapping.inserts)
+                + sum(costs.relabel(a_nodes[i], b_nodes[j]) for i, j in mapping.matches)
+            )
+            assert total == mapping.distance
+            assert zhang_shasha(with_mapping_applied(a_tree, mapping), b_tree) == 0
+
+
+def test_mapping_replays_shared_subtrees():
+    # Interned trees repeat the same node objects, so nodes must be found by position.
+    random.seed(13)
+    interner = TreeInterner()
+    for _ in range(30):
+        a_tree = interner.intern(random_tree(max_depth=4, fanouts=(0, 2, 3), labels=("a", "b")))
+        b_tree = interner.intern(random_tree(max_depth=4, fanouts=(0, 2, 3), labels=("a", "b")))
+        mapping = zhang_shasha_mapping(a_tree, b_tree)
+        assert zhang_shasha(with_mapping_applied(a_tree, mapping), b_tree) == 0
+
+
+def test_mapping_replaces_root():
+    a_tree = tree_from_dict({"x": {"a": {}, "b": {}}})
+    b_tree = tree_from_dict({"y": {"z": {"a": {}, "b": {}}}})
+    cost_funcs = CostFunctions(relabel=lambda a, b: 3 * (a.label != b.label))
+    mapping = zhang_shasha_mapping(a_tree, b_tree, cost_funcs)
+    assert mapping.distance == 3
+    assert zhang_shasha(with_mapping_applied(a_tree, mapping), b_tree) == 0